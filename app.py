@@ -1,13 +1,48 @@
 # ============================================
 # CONFIGURATION VARIABLES
 # ============================================
-from openai import AzureOpenAI
+import openai
+from openai import AsyncAzureOpenAI
+from collections import deque
 from datetime import datetime
+try:
+    import httpx2 as httpx  # HTTP library used by openai>=3
+except ImportError:
+    import httpx
 import os
+import asyncio
+import difflib
+import email.utils
+import gzip
+import hmac
+import html
+import io
 import json
+import logging
+import queue
+import random
+import re
+import threading
+import time
+import uuid
 import urllib.error
 import urllib.request
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from portrait_qa.inbox import EvaluationInbox, missing_rerun_internals
+from portrait_qa.metrics import MetricsRegistry
+from portrait_qa.scheduler import DeploymentRateLimiter, DeploymentScheduler, QueueTicket
+from portrait_qa.stores import (
+    EvaluationStore, PipelineLogStore, ResponseCache, SessionActivity, SessionStore,
+    content_hash, fill_prompt_template,
+)
+from portrait_qa.tracing import OtlpTraceExporter, Trace
+try:
+    import tiktoken  # optional: exact prompt token counts for the context guard
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger("portrait_qa")
 
 AZURE_API_KEY = os.getenv("AZURE_API_KEY", "")
 AZURE_API_VERSION = "2025-04-01-preview"
@@ -25,8 +60,194 @@ FALLBACK_DEPLOYMENT_NAMES = [
     "gpt-5.4",
     "gpt-5.2",
     "gpt-4o",
+    "gpt-4o-mini",
 ]
+# Deployment list cache; refreshed in the background once older than the TTL.
+DEPLOYMENT_CACHE_TTL_S = 600
+DEPLOYMENT_REFRESH_BACKOFF_S = 60
+DEPLOYMENT_CACHE_PATH = os.path.join(".cache", "deployments.json")
 TEMPERATURE = 0.2
+# Retries of 429/5xx/connection failures, then the fallback deployments below.
+AZURE_MAX_RETRIES = 3
+AZURE_BACKOFF_BASE_S = 0.5
+AZURE_BACKOFF_MAX_S = 8.0
+# A Retry-After longer than this counts as "saturated": try the next deployment instead.
+AZURE_MAX_RETRY_AFTER_S = 10.0
+DEPLOYMENT_FALLBACKS = {
+    "gpt-4o": ["gpt-5-chat", "gpt-5-mini"],
+    "gpt-5-chat": ["gpt-4o", "gpt-5-mini"],
+    "gpt-5": ["gpt-5-mini", "gpt-4o"],
+    "gpt-5-mini": ["gpt-5-nano", "gpt-4o"],
+    "gpt-5-nano": ["gpt-5-mini"],
+    "gpt-5-pro": ["gpt-5", "gpt-4o"],
+    "gpt-5.4": ["gpt-5.2", "gpt-4o"],
+    "gpt-5.2": ["gpt-5", "gpt-4o"],
+}
+# Client-side budget per deployment, a little under the Azure quota; max_concurrency caps
+# open requests. "default" covers the rest.
+DEPLOYMENT_RATE_LIMITS = {
+    "default": {"requests_per_minute": 120, "tokens_per_minute": 200_000, "max_concurrency": 16},
+}
+# Queue priority for outbound requests, served in this order.
+REQUEST_PRIORITIES = ("turn", "greeting", "speculation")
+# If the local limiter would hold a request longer than this, the deployment is saturated.
+RATE_LIMIT_MAX_WAIT_S = 3.0
+# Connection pool of the shared Azure client.
+AZURE_MAX_CONNECTIONS = 100
+AZURE_MAX_KEEPALIVE_CONNECTIONS = 20
+AZURE_KEEPALIVE_EXPIRY_S = 120.0
+AZURE_CONNECT_TIMEOUT_S = 5.0
+AZURE_REQUEST_TIMEOUT_S = 120.0
+# Requests in flight to Azure at once, across all sessions (shared event loop).
+ASYNC_MAX_IN_FLIGHT = 64
+ASYNC_WAIT_POLL_S = 0.25
+# "compact" condenses older turns into the prompt; "full" sends the whole history twice.
+PROMPT_HISTORY_MODE = "compact"
+# Approximate token budget for the verbatim chat turns sent after the system prompt.
+HISTORY_TOKEN_BUDGET = 3000
+# User messages older than the verbatim window are shortened to this many characters.
+DIGEST_USER_MESSAGE_CHARS = 200
+# "prefix_stable" moves the evaluation and history to the end of the template (prompt caching).
+PROMPT_LAYOUT = "prefix_stable"
+# Prompts over a deployment's limit get their history compacted; "default" covers the rest.
+DEPLOYMENT_CONTEXT_LIMITS = {
+    "default": {"context_window": 128_000, "max_prompt_tokens": 16_000},
+    "gpt-5": {"context_window": 400_000, "max_prompt_tokens": 24_000},
+    "gpt-5-pro": {"context_window": 400_000, "max_prompt_tokens": 24_000},
+}
+# Visible answer cap (replies are 3–6 short sentences).
+RESPONSE_MAX_TOKENS = 800
+# Request parameters each deployment accepts, matched by longest name prefix.
+DEPLOYMENT_PROFILES = {
+    "default": {
+        "reasoning_effort": None, "temperature": True,
+        "max_tokens_param": "max_tokens", "stream_usage": True,
+    },
+    "gpt-4o": {},
+    "gpt-5-chat": {"max_tokens_param": "max_completion_tokens"},
+    "gpt-5": {
+        "reasoning_effort": "minimal", "temperature": False,
+        "max_tokens_param": "max_completion_tokens",
+    },
+    "gpt-5-pro": {
+        "reasoning_effort": "high", "temperature": False,
+        "max_tokens_param": "max_completion_tokens",
+    },
+    "gpt-5.2": {
+        "reasoning_effort": "none", "temperature": False,
+        "max_tokens_param": "max_completion_tokens",
+    },
+    "gpt-5.4": {
+        "reasoning_effort": "none", "temperature": False,
+        "max_tokens_param": "max_completion_tokens",
+    },
+}
+# Hidden reasoning tokens allowed on top of RESPONSE_MAX_TOKENS, per reasoning effort.
+REASONING_TOKEN_ALLOWANCE = {"none": 0, "minimal": 512, "low": 2048, "medium": 6000, "high": 16000}
+# Next lower effort to try when a deployment rejects one.
+REASONING_EFFORT_FALLBACK = {"none": "minimal", "minimal": "low", "low": "medium", "medium": "high"}
+TOKENIZER_ENCODING = "o200k_base"
+# The context guard halves the verbatim history budget no lower than this.
+MIN_HISTORY_TOKEN_BUDGET = 300
+# Summarize the tracked conversation state (follow-ups, variants, language) in the prompt.
+CONVERSATION_STATE_IN_PROMPT = True
+# Confident off-topic messages (Type D) are answered from the variant pool without Azure.
+INTENT_FAST_PATH_ENABLED = True
+INTENT_FAST_PATH_MIN_CONFIDENCE = 0.85
+# Deployment tier per user turn; "large" is the conversation's deployment, never exceeded.
+# "small" takes the fastest turns, so it is a non-reasoning model.
+MODEL_ROUTING_ENABLED = True
+MODEL_TIERS = {"small": "gpt-4o-mini", "medium": "gpt-5-mini", "large": None}
+INTENT_TIERS = {"A": "large", "B": "large", "C": "medium", "D": "small", "E": "medium", "F": "small"}
+# Relative size/cost by longest name prefix. A tier is used only if it ranks below the
+# conversation's deployment; unranked deployments are never routed to or from.
+DEPLOYMENT_SIZE_RANKS = {
+    "gpt-5-nano": 1, "gpt-4o-mini": 1, "gpt-5-mini": 2, "gpt-4o": 3, "gpt-5-chat": 4,
+    "gpt-5": 4, "gpt-5.2": 5, "gpt-5.4": 6, "gpt-5-pro": 7,
+}
+ROUTING_MIN_CONFIDENCE = 0.6
+# Follow-ups and off-topic replies of at most this many words ("ok", "danke!") go to "small".
+ROUTING_SHORT_MESSAGE_WORDS = 3
+ROUTING_SHORT_MESSAGE_INTENTS = ("D", "E")
+# From this many messages, "small" turns go to "medium" (more context to keep straight).
+ROUTING_LONG_HISTORY_MESSAGES = 40
+# A tier whose recent TTFT misses the SLO hands the turn one tier down.
+ROUTING_TTFT_SLO_S = 3.0
+ROUTING_SLO_QUANTILE = 0.9
+ROUTING_LATENCY_WINDOW = 50
+# Opt-in: pre-generate answers to the likeliest next user messages after each reply.
+SPECULATION_ENABLED = os.getenv("SPECULATION_ENABLED", "").lower() in ("1", "true", "yes")
+SPECULATION_TOP_K = 2
+SPECULATION_MATCH_THRESHOLD = 0.85
+SPECULATION_TOKEN_BUDGET = 40_000
+# Likely next user messages per language, most likely first.
+SPECULATION_CANDIDATES = {
+    "en": ("What should I improve?", "Tell me more", "Why?", "Yes", "What are my strengths?"),
+    "de": ("Was soll ich verbessern?", "Erzähl mir mehr", "Warum?", "Ja", "Was sind meine Stärken?"),
+    "uk": ("Що мені покращити?", "Розкажи більше", "Чому?", "Так", "Які мої сильні сторони?"),
+}
+# Follow-up pool lines whose question makes one candidate (index above) the likeliest reply.
+FOLLOW_UP_LIKELY_REPLY = {3: 1, 4: 0, 5: 0, 6: 1, 10: 4}
+# OpenTelemetry collector for per-turn traces (e.g. http://127.0.0.1:4318/v1/traces).
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT", "")
+OTLP_SERVICE_NAME = "portrait-qa-assistant"
+OTLP_EXPORT_BATCH = 50
+OTLP_EXPORT_INTERVAL_S = 2.0
+# Server-wide metrics: Prometheus text on METRICS_PORT (0 disables it; only bound by the
+# Streamlit app, not by scripts importing it) and ?view=metrics&token=<METRICS_PAGE_TOKEN>.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# The admin page is off while this is empty.
+METRICS_PAGE_TOKEN = os.getenv("METRICS_PAGE_TOKEN", "")
+METRICS_PREFIX = "portrait_qa"
+# Quantiles come from the most recent samples per deployment.
+METRICS_LATENCY_WINDOW = 1000
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+# A session counts as active when it was used within this many seconds.
+METRICS_ACTIVE_SESSION_S = 5 * 60
+METRICS_PAGE_REFRESH_S = 5.0
+# Opt-in cache of replies to repeated deterministic requests (memory LRU and disk).
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL_S = 24 * 3600
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+RESPONSE_CACHE_DIR = os.path.join(".cache", "responses")
+RESPONSE_CACHE_MAX_DISK_BYTES = 50 * 1024 * 1024
+# Finished evaluations: POST /evaluations/<session id> (port 0 disables it) or <session id>.json.
+EVALUATION_INGEST_HOST = "127.0.0.1"
+EVALUATION_INGEST_PORT = int(os.getenv("EVALUATION_INGEST_PORT", "8765"))
+EVALUATION_DROP_DIR = os.path.join(".cache", "evaluations")
+# Drop directory scan interval when watchdog is not installed.
+EVALUATION_DROP_SCAN_S = 1.0
+# Poll interval where sessions cannot be woken from another thread.
+EVALUATION_FALLBACK_POLL_S = 2.0
+EVALUATION_INBOX_MAX_PENDING = 1000
+EVALUATION_INGEST_MAX_BYTES = 1024 * 1024
+PORTRAIT_SWITCH_EVENT = (
+    "[App event] The user switched to another portrait. qa_scores_json now holds that "
+    "portrait's evaluation; earlier messages were about the previous one. Acknowledge the "
+    "switch briefly and invite the user to talk about this portrait."
+)
+# Evaluations per portrait; the user id comes from the ?user= query parameter.
+EVALUATION_DB_PATH = os.path.join(".cache", "evaluations.sqlite3")
+EVALUATION_PARSED_CACHE_ENTRIES = 256
+EVALUATION_LIST_LIMIT = 100
+DEFAULT_USER_ID = "local"
+EVALUATION_READY_EVENT = (
+    "[App event] The portrait evaluation has just finished and is now available in "
+    "qa_scores_json. Tell the user their results are ready and invite them to talk about them."
+)
+# Pipeline logs, one JSONL file per conversation; only the newest turns stay in memory.
+PIPELINE_LOG_DIR = os.path.join("logs", "pipeline")
+PIPELINE_LOG_MEMORY_TAIL = 20
+# Messages rendered at once; "Load older messages" adds as many.
+CHAT_WINDOW_SIZE = 30
+# Minimum delay between repaints of a streaming reply in the chat UI.
+STREAM_REPAINT_INTERVAL_S = 0.05
+# Sessions are saved every turn and resumed from ?session=<id>; idle ones leave memory.
+SESSION_DB_PATH = os.path.join(".cache", "sessions.sqlite3")
+SESSION_RESUME_TAIL_MESSAGES = 2 * CHAT_WINDOW_SIZE
+SESSION_IDLE_EVICT_S = 15 * 60
+SESSION_SWEEP_INTERVAL_S = 60
 
 # ============================================
 # PROMPT TEMPLATE (single assistant)
@@ -351,21 +572,166 @@ DEFAULT_QA_SCORES_JSON = {
     }
 }
 
+# ============================================
+# TRACING
+# ============================================
+
+@st.cache_resource
+def get_trace_exporter():
+    """The OTLP exporter, or None when OTLP_TRACES_ENDPOINT is not set."""
+    if not OTLP_TRACES_ENDPOINT:
+        return None
+    return OtlpTraceExporter(
+        OTLP_TRACES_ENDPOINT, OTLP_SERVICE_NAME, OTLP_EXPORT_BATCH, OTLP_EXPORT_INTERVAL_S)
+
+
+# ============================================
+# LIVE METRICS
+# ============================================
+
+@st.cache_resource
+def get_metrics_registry() -> MetricsRegistry:
+    return MetricsRegistry(
+        METRICS_LATENCY_WINDOW, METRICS_QUANTILES, METRICS_PREFIX, METRICS_ACTIVE_SESSION_S,
+        get_async_runtime(), get_scheduler(),
+    )
+
+
+@st.cache_resource
+def serve_metrics() -> MetricsRegistry:
+    """Session gauge and Prometheus endpoint; started from main() only."""
+    metrics = get_metrics_registry()
+    metrics.activity = get_session_activity()
+    if METRICS_PORT:
+        metrics.serve_http(METRICS_HOST, METRICS_PORT)
+    return metrics
+
+
 # ============================================
 # AZURE OPENAI API
 # ============================================
 
 
-def get_azure_client() -> AzureOpenAI:
-    return AzureOpenAI(
-        api_key=AZURE_API_KEY,
-        api_version=AZURE_API_VERSION,
-        azure_endpoint=AZURE_ENDPOINT
+class AsyncRuntime:
+    """One event loop on a daemon thread, shared by every session; `slots` caps requests
+    in flight to Azure."""
+
+    def __init__(self, max_in_flight: int):
+        self.loop = asyncio.new_event_loop()
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="azure-async-loop", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("AsyncRuntime.run called on the event loop thread; await instead")
+        return self.submit(coro).result()
+
+
+@st.cache_resource
+def get_async_runtime() -> AsyncRuntime:
+    return AsyncRuntime(ASYNC_MAX_IN_FLIGHT)
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and return its result (from any other thread)."""
+    return get_async_runtime().run(coro)
+
+
+def iterate_async(agen, on_wait=None):
+    """Iterate an async generator on the shared event loop from synchronous code; `on_wait`
+    runs every ASYNC_WAIT_POLL_S while no item has arrived."""
+    items = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put((True, item))
+        except Exception as e:
+            items.put((False, e))
+        else:
+            items.put((False, None))
+
+    future = get_async_runtime().submit(pump())
+    try:
+        while True:
+            try:
+                ok, item = items.get(timeout=ASYNC_WAIT_POLL_S if on_wait else None)
+            except queue.Empty:
+                on_wait()
+                continue
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        future.cancel()
+
+
+def make_async_azure_client(endpoint: str, api_key: str, api_version: str) -> AsyncAzureOpenAI:
+    """A client with its own keep-alive connection pool (AZURE_MAX_CONNECTIONS etc.)."""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=AZURE_MAX_CONNECTIONS,
+            max_keepalive_connections=AZURE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AZURE_KEEPALIVE_EXPIRY_S,
+        ),
+        timeout=httpx.Timeout(
+            AZURE_REQUEST_TIMEOUT_S, connect=AZURE_CONNECT_TIMEOUT_S
+        ),
     )
+    return AsyncAzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        azure_endpoint=endpoint,
+        http_client=http_client,
+        max_retries=0,  # retries, backoff and fallback live in stream_azure_api_async
+    )
+
+
+@st.cache_resource
+def get_shared_async_azure_client(
+    endpoint: str, api_key: str, api_version: str
+) -> AsyncAzureOpenAI:
+    """The process-wide client every chat request uses, on the shared event loop."""
+    return make_async_azure_client(endpoint, api_key, api_version)
+
+
+def get_async_azure_client() -> AsyncAzureOpenAI:
+    return get_shared_async_azure_client(AZURE_ENDPOINT, AZURE_API_KEY, AZURE_API_VERSION)
+
+
+def warm_up_azure_client() -> None:
+    """Open a pooled connection to AZURE_ENDPOINT in the background, so the first turn
+    skips the handshake."""
+    client = get_async_azure_client()
+
+    async def _warm():
+        try:
+            await client.models.list()
+        except Exception:
+            pass
+
+    get_async_runtime().submit(_warm())
 
 
 def fetch_azure_deployment_names(api_key: str, endpoint: str) -> list[str]:
     """List deployment ids from Azure OpenAI. Chat calls use deployment name as `model`."""
+    return sorted(fetch_azure_deployments(api_key, endpoint))
+
+
+def fetch_azure_deployments(api_key: str, endpoint: str) -> dict:
+    """Deployment id -> underlying model name (None if not reported) from Azure OpenAI."""
     base = endpoint.rstrip("/")
     url = (
         f"{base}/openai/deployments"
@@ -376,52 +742,1057 @@ def fetch_azure_deployment_names(api_key: str, endpoint: str) -> list[str]:
         with urllib.request.urlopen(req, timeout=20) as resp:
             payload = json.loads(resp.read().decode())
     except (urllib.error.URLError, urllib.error.HTTPError, json.JSONDecodeError, TimeoutError):
-        return []
+        return {}
     items = payload.get("data") or payload.get("value") or []
-    names = []
+    deployments = {}
     for d in items:
         if not isinstance(d, dict):
             continue
         name = d.get("id") or d.get("name")
         if name:
-            names.append(name)
-    return sorted(set(names))
-
-
-def merge_model_options(fetched: list[str]) -> list[str]:
-    """Prefer Azure list; ensure defaults exist for manual pick if API failed."""
+            model = d.get("model") or (d.get("properties") or {}).get("model") or None
+            if isinstance(model, dict):
+                model = model.get("name")
+            deployments[name] = model
+    return deployments
+
+
+class DeploymentCatalog:
+    """Deployment names per endpoint: TTL cache, background refresh and a disk snapshot.
+    `get` never touches the network."""
+
+    def __init__(self, snapshot_path: str, ttl_s: float):
+        self.snapshot_path = snapshot_path
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refreshing = set()
+        self._failed_at = {}
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        for endpoint, entry in snapshot.items():
+            if isinstance(entry, dict) and isinstance(entry.get("names"), list):
+                self._entries[endpoint] = {
+                    "names": entry["names"],
+                    "models": entry.get("models") or {},
+                    "fetched_at": float(entry.get("fetched_at", 0)),
+                }
+
+    def _save_snapshot(self):
+        with self._lock:
+            snapshot = dict(self._entries)
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError:
+            pass
+
+    def get(self, api_key: str, endpoint: str) -> list[str]:
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            failed_at = self._failed_at.get(endpoint, 0)
+        now = time.time()
+        stale = entry is None or now - entry["fetched_at"] > self.ttl_s
+        if stale and now - failed_at > DEPLOYMENT_REFRESH_BACKOFF_S:
+            self.refresh_in_background(api_key, endpoint)
+        return list(entry["names"]) if entry else []
+
+    def models(self, endpoint: str) -> dict:
+        """Deployment -> model name as last fetched (no refresh is scheduled)."""
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            return dict(entry["models"]) if entry else {}
+
+    def status(self, endpoint: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            return {
+                "fetched_at": entry["fetched_at"] if entry else None,
+                "refreshing": endpoint in self._refreshing,
+            }
+
+    def refresh(self, api_key: str, endpoint: str) -> list[str]:
+        """Fetch now. A failed fetch keeps the previous list instead of clearing it."""
+        deployments = fetch_azure_deployments(api_key, endpoint)
+        names = sorted(deployments)
+        with self._lock:
+            if names:
+                self._entries[endpoint] = {
+                    "names": names,
+                    "models": {k: v for k, v in deployments.items() if v},
+                    "fetched_at": time.time(),
+                }
+                self._failed_at.pop(endpoint, None)
+            else:
+                self._failed_at[endpoint] = time.time()
+        if names:
+            self._save_snapshot()
+        return names
+
+    def refresh_in_background(self, api_key: str, endpoint: str) -> None:
+        with self._lock:
+            if endpoint in self._refreshing:
+                return
+            self._refreshing.add(endpoint)
+
+        def _refresh():
+            try:
+                self.refresh(api_key, endpoint)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(endpoint)
+
+        threading.Thread(
+            target=_refresh, name="azure-deployments-refresh", daemon=True
+        ).start()
+
+
+@st.cache_resource
+def get_deployment_catalog() -> DeploymentCatalog:
+    return DeploymentCatalog(DEPLOYMENT_CACHE_PATH, DEPLOYMENT_CACHE_TTL_S)
+
+
+def merge_model_options(fetched: list[str] = None) -> list[str]:
+    """Prefer Azure list (the cached catalog by default); ensure defaults exist for manual pick if API failed."""
+    if fetched is None:
+        fetched = get_deployment_catalog().get(AZURE_API_KEY, AZURE_ENDPOINT)
     if fetched:
         merged = list(dict.fromkeys(fetched + FALLBACK_DEPLOYMENT_NAMES))
         return merged
     return list(FALLBACK_DEPLOYMENT_NAMES)
 
 
-def call_azure_api(
+class DeploymentProfiles:
+    """Capability profile per deployment: configured (DEPLOYMENT_PROFILES), matched via
+    the model the deployment catalog reports, and corrected from 400 responses."""
+
+    def __init__(self, profiles: dict, catalog: DeploymentCatalog = None):
+        self.profiles = profiles
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._learned = {}  # deployment -> overrides from rejected requests
+
+    def _configured(self, name: str):
+        matches = [key for key in self.profiles if key != "default" and name.startswith(key)]
+        return self.profiles[max(matches, key=len)] if matches else None
+
+    def get(self, deployment: str) -> dict:
+        configured = self.profiles.get(deployment)
+        source = "configured"
+        if configured is None:
+            model = self.catalog.models(AZURE_ENDPOINT).get(deployment) if self.catalog else None
+            configured = self._configured(model) if model else None
+            source = "deployment model"
+        if configured is None:
+            configured = self._configured(deployment)
+            source = "name"
+        with self._lock:
+            learned = dict(self._learned.get(deployment, {}))
+        profile = {**self.profiles["default"], **(configured or {}), **learned}
+        profile["source"] = "learned" if learned else (source if configured is not None else "default")
+        return profile
+
+    def learn(self, deployment: str, error: dict) -> bool:
+        """Adjust the profile from a 400 that names an unsupported parameter or value.
+        True if something changed (the request can be resent)."""
+        if error.get("status") != 400:
+            return False
+        message = (error.get("message") or "").lower()
+        profile = self.get(deployment)
+        change = {}
+        if "max_tokens" in message and "max_completion_tokens" in message:
+            change["max_tokens_param"] = (
+                "max_completion_tokens" if profile["max_tokens_param"] == "max_tokens"
+                else "max_tokens")
+        elif "temperature" in message and profile["temperature"]:
+            change["temperature"] = False
+        elif "reasoning_effort" in message and profile["reasoning_effort"]:
+            if "unsupported value" in message and profile["reasoning_effort"] in REASONING_EFFORT_FALLBACK:
+                change["reasoning_effort"] = REASONING_EFFORT_FALLBACK[profile["reasoning_effort"]]
+            else:
+                change["reasoning_effort"] = None
+        elif "stream_options" in message and profile["stream_usage"]:
+            change["stream_usage"] = False
+        if not change:
+            return False
+        with self._lock:
+            self._learned.setdefault(deployment, {}).update(change)
+        return True
+
+
+@st.cache_resource
+def get_deployment_profiles() -> DeploymentProfiles:
+    return DeploymentProfiles(DEPLOYMENT_PROFILES, get_deployment_catalog())
+
+
+def output_token_cap(profile: dict, max_tokens: int = None) -> int:
+    """Output tokens to allow: the visible answer plus the profile's reasoning allowance."""
+    if max_tokens is None:
+        max_tokens = RESPONSE_MAX_TOKENS
+    return max_tokens + REASONING_TOKEN_ALLOWANCE.get(profile["reasoning_effort"], 0)
+
+
+def completion_params(profile: dict, temperature: float, max_tokens: int = None) -> dict:
+    """The fastest valid chat completion parameters for a deployment with `profile`."""
+    params = {profile["max_tokens_param"]: output_token_cap(profile, max_tokens)}
+    if profile["temperature"]:
+        params["temperature"] = temperature
+    if profile["reasoning_effort"]:
+        params["reasoning_effort"] = profile["reasoning_effort"]
+    if profile["stream_usage"]:
+        params["stream_options"] = {"include_usage": True}
+    return params
+
+
+@st.cache_resource
+def get_rate_limiter() -> DeploymentRateLimiter:
+    return DeploymentRateLimiter(DEPLOYMENT_RATE_LIMITS)
+
+
+@st.cache_resource
+def get_scheduler() -> DeploymentScheduler:
+    return DeploymentScheduler(DEPLOYMENT_RATE_LIMITS, REQUEST_PRIORITIES)
+
+
+def fallback_deployments_for(model: str) -> list[str]:
+    return [
+        name for name in DEPLOYMENT_FALLBACKS.get(model, [])
+        if name != model and name in FALLBACK_DEPLOYMENT_NAMES
+    ]
+
+
+def parse_retry_after(error: Exception):
+    """Seconds from Retry-After / retry-after-ms on an API error response, if present."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def describe_api_error(error: Exception, deployment: str) -> dict:
+    """Structured error for log_entry; `retryable` marks 408/409/429/5xx and network errors."""
+    status = getattr(error, "status_code", None)
+    if isinstance(error, openai.APITimeoutError):
+        kind = "timeout"
+    elif isinstance(error, openai.APIConnectionError):
+        kind = "connection_error"
+    elif status == 429:
+        kind = "rate_limited"
+    elif status is not None and status >= 500:
+        kind = "server_error"
+    elif isinstance(error, openai.APIError):
+        kind = "api_error"
+    else:
+        kind = "unexpected_error"
+    retryable = kind in ("timeout", "connection_error", "rate_limited", "server_error") or (
+        status in (408, 409)
+    )
+    return {
+        "type": kind,
+        "status": status,
+        "message": str(error),
+        "deployment": deployment,
+        "retryable": retryable,
+        "retry_after_s": parse_retry_after(error),
+    }
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(AZURE_BACKOFF_MAX_S, AZURE_BACKOFF_BASE_S * 2 ** attempt))
+
+
+def estimate_request_tokens(messages: list, max_tokens: int) -> int:
+    """What a request counts against a tokens-per-minute quota: prompt plus max output."""
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages) + max_tokens
+
+
+def usage_to_dict(usage) -> dict:
+    """Token usage from the final stream chunk, including prompt-cache hits."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0),
+    }
+
+
+def stream_azure_api_async(
     messages: list,
     model: str,
     temperature: float = None,
-    max_tokens: int = 3000,
-) -> str:
+    max_tokens: int = None,
+    stats: dict = None,
+    ticket: QueueTicket = None,
+    fallbacks: list = None,
+    trace: Trace = None,
+):
+    """Async generator of content deltas, retrying and falling back before the first token.
+
+    `stats` gets timings, usage, the attempts and `error` (None on success); failures are
+    never yielded as text. Shared resources are looked up here, in the calling thread.
+    """
     if temperature is None:
         temperature = TEMPERATURE
-    client = get_azure_client()
+    if stats is None:
+        stats = {}
+    stats.update(
+        time_to_first_token_s=None, queue_wait_s=0.0, deployment=None, attempts=[], error=None,
+        chunks=0, tokens_per_s=None,
+    )
+    if fallbacks is None:
+        fallbacks = fallback_deployments_for(model)
+    if trace is None:
+        trace = Trace()
+    acquire_started = time.perf_counter()
+    resources = (
+        get_async_azure_client(), get_async_runtime(), get_scheduler(), get_rate_limiter(),
+        get_deployment_profiles(), get_metrics_registry(),
+    )
+    trace.add("client_acquire", acquire_started, time.perf_counter())
+    return _stream_with_retries(
+        messages, [model] + fallbacks, temperature, max_tokens, stats,
+        ticket or QueueTicket(), trace, *resources,
+    )
+
+
+async def _stream_with_retries(
+    messages, deployments, temperature, max_tokens, stats, ticket, trace,
+    client, runtime, scheduler, limiter, profiles, metrics,
+):
+    started = time.perf_counter()
     try:
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stream=True
-        )
-        full_content = ""
-        for chunk in stream:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if delta.content:
-                    full_content += delta.content
-        return full_content
-    except Exception as e:
-        return f"[ERROR: {str(e)}]"
+        for deployment in deployments:
+            for attempt in range(AZURE_MAX_RETRIES + 1):
+                params = completion_params(profiles.get(deployment), temperature, max_tokens)
+                request_tokens = estimate_request_tokens(
+                    messages, params.get("max_tokens") or params["max_completion_tokens"])
+                attempt_span = trace.begin("attempt", deployment=deployment, attempt=attempt + 1)
+                queued = time.perf_counter()
+                stats["queue_wait_s"] += round(await scheduler.acquire(deployment, ticket), 3)
+                trace.add("queue_wait", queued, time.perf_counter(), attempt_span)
+                retry_delay = None
+                try:
+                    wait = limiter.reserve(deployment, request_tokens, RATE_LIMIT_MAX_WAIT_S)
+                    if wait is None:
+                        stats["error"] = {
+                            "type": "local_rate_limit",
+                            "status": None,
+                            "message": "Client-side rate limit for this deployment is exhausted",
+                            "deployment": deployment,
+                            "retryable": True,
+                            "retry_after_s": None,
+                        }
+                        stats["attempts"].append(stats["error"])
+                        attempt_span["attributes"]["error"] = "local_rate_limit"
+                        metrics.record_request(deployment, "local_rate_limit")
+                        break
+                    if wait:
+                        waited = time.perf_counter()
+                        await asyncio.sleep(wait)
+                        trace.add("rate_limit_wait", waited, time.perf_counter(), attempt_span)
+                    try:
+                        async with runtime.slots:
+                            runtime.in_flight += 1
+                            try:
+                                sent = time.perf_counter()
+                                ticket.sent += 1
+                                stream = await client.chat.completions.create(
+                                    model=deployment,
+                                    messages=messages,
+                                    stream=True,
+                                    **params,
+                                )
+                                opened = time.perf_counter()
+                                trace.add("request_send", sent, opened, attempt_span,
+                                          request_tokens=request_tokens)
+                                first = None
+                                async with stream:
+                                    async for chunk in stream:
+                                        stats["chunks"] += 1
+                                        if getattr(chunk, "usage", None):
+                                            stats["usage"] = usage_to_dict(chunk.usage)
+                                        if chunk.choices and len(chunk.choices) > 0:
+                                            delta = chunk.choices[0].delta
+                                            if delta.content:
+                                                if first is None:
+                                                    first = time.perf_counter()
+                                                    trace.add("first_chunk", opened, first, attempt_span)
+                                                if stats["time_to_first_token_s"] is None:
+                                                    stats["time_to_first_token_s"] = round(
+                                                        first - started, 3)
+                                                yield delta.content
+                                last = time.perf_counter()
+                                if first is not None:
+                                    tokens = (stats.get("usage") or {}).get("completion_tokens")
+                                    if last > first and tokens:
+                                        stats["tokens_per_s"] = round(tokens / (last - first), 1)
+                                    trace.add("stream", first, last, attempt_span,
+                                              chunks=stats["chunks"], completion_tokens=tokens,
+                                              tokens_per_s=stats["tokens_per_s"])
+                                metrics.record_request(
+                                    deployment, "ok", first - sent if first is not None else None, last - sent)
+                            finally:
+                                runtime.in_flight -= 1
+                        stats["deployment"] = deployment
+                        stats["error"] = None
+                        return
+                    except Exception as e:
+                        error = describe_api_error(e, deployment)
+                        attempt_span["attributes"]["error"] = error["type"]
+                        attempt_span["attributes"]["status"] = error["status"]
+                        metrics.record_request(deployment, error["type"])
+                        stats["attempts"].append(error)
+                        stats["error"] = error
+                        if stats["time_to_first_token_s"] is not None:
+                            # Part of the answer is already on screen; a retry would repeat it.
+                            error["partial"] = True
+                            stats["deployment"] = deployment
+                            return
+                        if error["status"] == 404:
+                            break  # not deployed in this resource: try the next deployment
+                        if profiles.learn(deployment, error):
+                            error["profile_adjusted"] = True
+                            continue  # resend at once with the corrected parameters
+                        if not error["retryable"]:
+                            return
+                        retry_after = error["retry_after_s"]
+                        if error["type"] == "rate_limited":
+                            limiter.pause(deployment, retry_after or backoff_delay(attempt))
+                        if retry_after is not None and retry_after > AZURE_MAX_RETRY_AFTER_S:
+                            break
+                        if attempt < AZURE_MAX_RETRIES:
+                            retry_delay = (
+                                retry_after if retry_after is not None else backoff_delay(attempt))
+                finally:
+                    scheduler.release(deployment)
+                    trace.end(attempt_span)
+                if retry_delay is not None:
+                    # Back off without holding the deployment slot.
+                    with trace.span("backoff", delay_s=round(retry_delay, 3)):
+                        await asyncio.sleep(retry_delay)
+    finally:
+        stats["stream_total_s"] = round(time.perf_counter() - started, 3)
+
+
+def stream_azure_api(
+    messages: list,
+    model: str,
+    temperature: float = None,
+    max_tokens: int = None,
+    stats: dict = None,
+    ticket: QueueTicket = None,
+):
+    """Synchronous stream_azure_api_async: yields the same deltas and fills the same stats."""
+    return iterate_async(stream_azure_api_async(
+        messages, model, temperature=temperature, max_tokens=max_tokens, stats=stats,
+        ticket=ticket,
+    ))
+
+
+def call_azure_api(
+    messages: list,
+    model: str,
+    temperature: float = None,
+    max_tokens: int = None,
+    stats: dict = None,
+    ticket: QueueTicket = None,
+) -> str:
+    """Full reply text; empty if the request failed (see stats["error"])."""
+    return "".join(stream_azure_api(
+        messages, model, temperature=temperature, max_tokens=max_tokens,
+        stats=stats, ticket=ticket,
+    ))
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(
+        RESPONSE_CACHE_DIR, RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_MAX_DISK_BYTES
+    )
+
+
+# ============================================
+# CONVERSATION STATE
+# ============================================
+
+APP_EVENT_PREFIX = "[App event]"
+
+LANGUAGE_NAMES = {"en": "English", "de": "German", "uk": "Ukrainian"}
+
+# The off-topic variant pool of portrait_qa_system_prompt, with the German and
+# Ukrainian wording the model adapts it to, for recognizing which ones were used.
+OFF_TOPIC_VARIANTS = {
+    1: (
+        "I'm here to help you with your portrait :) Maybe you have a question about your drawing?",
+        "Ich bin hier, um dir bei deinem Porträt zu helfen :) Hast du vielleicht eine Frage zu deiner Zeichnung?",
+        "Я тут, щоб допомогти тобі з портретом :) Може, у тебе є питання про твій малюнок?",
+    ),
+    2: (
+        "Haha, that's interesting, but I'm more into portraits :D Want to know something about your work?",
+        "Haha, das ist interessant, aber ich stehe eher auf Porträts :D Möchtest du etwas über deine Arbeit wissen?",
+        "Ха-ха, це цікаво, але я більше про портрети :D Хочеш дізнатися щось про свою роботу?",
+    ),
+    3: (
+        "Oh, that's fun! But let's get back to your portrait :) What would you like to know?",
+        "Oh, das ist lustig! Aber lass uns zu deinem Porträt zurückkommen :) Was möchtest du wissen?",
+        "О, це весело! Але повернімося до твого портрета :) Що ти хочеш дізнатися?",
+    ),
+    4: (
+        "Sounds cool! But I'm a portrait specialist :) Maybe we can discuss something about your work?",
+        "Klingt cool! Aber ich bin Porträt-Spezialistin :) Vielleicht können wir etwas über deine Arbeit besprechen?",
+        "Звучить круто! Але я спеціалістка з портретів :) Може, обговоримо щось про твою роботу?",
+    ),
+    5: (
+        "Wow, interesting! But my superpower is portraits :D Is there something you want to ask about your drawing?",
+        "Wow, interessant! Aber meine Superkraft sind Porträts :D Möchtest du etwas zu deiner Zeichnung fragen?",
+        "Вау, цікаво! Але моя суперсила — портрети :D Хочеш щось запитати про свій малюнок?",
+    ),
+    6: (
+        "I'd love to talk about that, but I understand portraits best :) Maybe there's something about your work?",
+        "Darüber würde ich gern reden, aber mit Porträts kenne ich mich am besten aus :) Gibt es vielleicht etwas zu deiner Arbeit?",
+        "Я б залюбки про це поговорила, але найкраще я розуміюся на портретах :) Може, є щось про твою роботу?",
+    ),
+    7: (
+        "That's cool! But let's better talk about your portrait * What interests you?",
+        "Das ist cool! Aber lass uns lieber über dein Porträt sprechen * Was interessiert dich?",
+        "Це круто! Але краще поговорімо про твій портрет * Що тебе цікавить?",
+    ),
+    8: (
+        "Hah, okay! But I'm best at helping with drawings :) Want to discuss something about your portrait?",
+        "Hah, okay! Aber am besten helfe ich bei Zeichnungen :) Möchtest du etwas über dein Porträt besprechen?",
+        "Ха, гаразд! Але найкраще я допомагаю з малюнками :) Хочеш обговорити щось про свій портрет?",
+    ),
+}
+FOLLOW_UP_POOL_SIZE = 10
+# A reply counts as an off-topic variant if it contains this share of a variant's words.
+OFF_TOPIC_MATCH_THRESHOLD = 0.6
+
+# Word stems (English, German, Ukrainian) that mark a reply as discussing a category.
+# Categories not listed here (custom evaluations) are matched on the words of their name.
+CATEGORY_KEYWORDS = {
+    "Composition and Design": (
+        "composition", "background", "layout", "komposition", "hintergrund", "bildaufbau",
+        "композиц", "фон",
+    ),
+    "Proportions and Anatomy": (
+        "proportion", "anatom", "пропорц", "анатом",
+    ),
+    "Perspective and Depth": (
+        "perspective", "depth", "three-dimensional", "perspektive", "tiefe", "räumlich",
+        "перспектив", "глибин", "об'єм", "обʼєм",
+    ),
+    "Use of Light and Shadow": (
+        "light", "shadow", "shading", "licht", "schatten", "schattier",
+        "світл", "тін",
+    ),
+    "Color Theory and Application": (
+        "color", "colour", "palette", "farb", "колір", "кольор", "палітр",
+    ),
+    "Brushwork and Technique": (
+        "brush", "stroke", "technique", "pinsel", "strich", "technik", "мазк", "мазок", "пензл", "технік",
+    ),
+    "Expression and Emotion": (
+        "expression", "emotion", "ausdruck", "gefühl", "вираз", "емоці",
+    ),
+    "Creativity and Originality": (
+        "creativ", "original", "kreativ", "креатив", "оригінальн",
+    ),
+    "Attention to Detail": (
+        "attention to detail", "fine detail", "small detail", "eyelash", "feinheit", "kleine detail",
+        "wimpern", "дрібн", "вії",
+    ),
+    "Overall Impact": (
+        "overall impact", "overall impression", "gesamteindruck", "gesamtwirkung",
+        "загальне враження", "загальний вплив",
+    ),
+}
+
+_WORD = re.compile(r"[^\W\d_]+")
+_IDENTITY_QUESTION = re.compile(
+    r"\b(?:who are you|what are you|your name|are you (?:an? )?(?:ai|bot|robot|human|real)"
+    r"|who (?:rated|evaluated|scored|made)|whose (?:rating|evaluation|score)"
+    r"|wer bist du|wie heißt du|bist du (?:eine? )?(?:ki|bot|roboter|mensch|echt)"
+    r"|wer hat .{0,40}bewertet|хто ти|як тебе звати|ти (?:ші|бот|робот|людина)"
+    r"|хто (?:оцінив|оцінювал|ставив|поставив))",
+    re.IGNORECASE,
+)
+# Common words that are unambiguous between English and German (no "was", "die", "so").
+_LANGUAGE_WORDS = {
+    "en": frozenset((
+        "i", "you", "your", "my", "me", "is", "are", "the", "and", "what", "how", "why",
+        "can", "should", "please", "thanks", "thank", "not", "with", "this", "that",
+        "about", "would", "like", "yes", "it", "do", "does", "of", "to", "a", "an",
+    )),
+    "de": frozenset((
+        "ich", "du", "dein", "deine", "mein", "meine", "mir", "mich", "ist", "sind", "der",
+        "das", "und", "wie", "warum", "kann", "sollte", "bitte", "danke", "nicht", "mit",
+        "ja", "nein", "ein", "eine", "zu", "über", "auch", "noch", "habe", "bild",
+    )),
+}
+
+
+def detect_language(text: str):
+    """"en", "de" or "uk" for a user message, or None when it gives no clear signal."""
+    letters = _WORD.findall(text)
+    if not letters:
+        return None
+    joined = "".join(letters)
+    cyrillic = sum(1 for ch in joined if "Ѐ" <= ch <= "ӿ")
+    if cyrillic * 2 > len(joined):
+        return "uk"
+    words = [w.lower() for w in letters]
+    scores = {lang: sum(w in vocab for w in words) for lang, vocab in _LANGUAGE_WORDS.items()}
+    scores["de"] += 2 * sum(1 for ch in joined.lower() if ch in "äöüß")
+    if scores["de"] == scores["en"]:
+        return None
+    return "de" if scores["de"] > scores["en"] else "en"
+
+
+def is_identity_question(text: str) -> bool:
+    """Type F: the user asks about the assistant or whose rating this is."""
+    return bool(_IDENTITY_QUESTION.search(text))
+
+
+_OFF_TOPIC_VARIANT_WORDS = [
+    (number, frozenset(w.lower() for w in _WORD.findall(text)))
+    for number, texts in OFF_TOPIC_VARIANTS.items()
+    for text in texts
+]
+
+
+def match_off_topic_variant(reply: str):
+    """Number of the off-topic pool variant `reply` uses (in any language), or None."""
+    words = [w.lower() for w in _WORD.findall(reply)]
+    present = set(words)
+    best, best_share = None, 0.0
+    for number, variant_words in _OFF_TOPIC_VARIANT_WORDS:
+        if len(words) > 2 * len(variant_words) + 6:
+            continue
+        share = len(variant_words & present) / len(variant_words)
+        if share > best_share:
+            best, best_share = number, share
+    return best if best_share >= OFF_TOPIC_MATCH_THRESHOLD else None
+
+
+def evaluation_categories(qa_scores_json: dict) -> list:
+    return [name for name, value in qa_scores_json.items() if isinstance(value, dict)]
+
+
+def category_pattern(category: str):
+    """Regex that finds `category` discussed in a reply (word-start match of its stems)."""
+    stems = CATEGORY_KEYWORDS.get(category)
+    if stems is None:
+        stems = [w.lower() for w in _WORD.findall(category) if len(w) > 3] or [category.lower()]
+    return re.compile(
+        r"(?<!\w)(?:" + "|".join(re.escape(stem) for stem in stems) + ")", re.IGNORECASE)
+
+
+class ConversationState:
+    """What the prompt's sequencing rules need (language, follow-up position, variants and
+    categories used), updated one message at a time."""
+
+    def __init__(self, categories: list):
+        self.categories = list(categories)
+        self._patterns = [(name, category_pattern(name)) for name in self.categories]
+        self.reset()
+
+    @classmethod
+    def from_messages(cls, messages: list, qa_scores_json: dict) -> "ConversationState":
+        state = cls(evaluation_categories(qa_scores_json))
+        state.sync(messages)
+        return state
+
+    def reset(self) -> None:
+        self.messages_seen = 0
+        self.language = None
+        self.follow_ups_used = 0
+        self.off_topic_variants = []
+        self.categories_discussed = []
+        self._pending_user = None
+        self._last_key = None
+
+    @staticmethod
+    def _message_key(message: dict) -> str:
+        return content_hash(f"{message['role']}\n{message['content']}")
+
+    def sync(self, messages: list, offset: int = 0) -> "ConversationState":
+        """Fold in new messages. `offset` is the number of earlier messages not loaded in
+        `messages` (a resumed session); if the state has to start over, they are skipped."""
+        seen = self.messages_seen - offset
+        if seen < 0 or len(messages) < seen or (
+            seen and self._message_key(messages[seen - 1]) != self._last_key
+        ):
+            self.reset()
+            self.messages_seen = offset
+            seen = 0
+        for message in messages[seen:]:
+            self.update(message)
+        return self
+
+    def snapshot(self) -> dict:
+        """Everything needed to continue tracking without replaying the messages."""
+        pending = self._pending_user
+        return {
+            **self.to_dict(),
+            "language": self.language,
+            "off_topic_variants_used": list(self.off_topic_variants),
+            "categories": self.categories,
+            "pending_user": pending and {
+                k: pending[k] for k in ("role", "content", "intent") if k in pending},
+            "last_key": self._last_key,
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "ConversationState":
+        state = cls(snapshot["categories"])
+        state.messages_seen = snapshot["messages_seen"]
+        state.language = snapshot["language"]
+        state.follow_ups_used = snapshot["follow_ups_used"]
+        state.off_topic_variants = list(snapshot["off_topic_variants_used"])
+        state.categories_discussed = list(snapshot["categories_discussed"])
+        state._pending_user = snapshot["pending_user"]
+        state._last_key = snapshot["last_key"]
+        return state
+
+    def update(self, message: dict) -> None:
+        content = message["content"]
+        if message["role"] == "user":
+            self._pending_user = message
+            if content in (EVALUATION_READY_EVENT, PORTRAIT_SWITCH_EVENT):
+                self.categories_discussed = []  # a new evaluation from here on
+            if not content.startswith(APP_EVENT_PREFIX):
+                self.language = detect_language(content) or self.language
+        elif message["role"] == "assistant":
+            variant = match_off_topic_variant(content)
+            if variant is not None:
+                if variant not in self.off_topic_variants:
+                    self.off_topic_variants.append(variant)
+            else:
+                for name, pattern in self._patterns:
+                    if name not in self.categories_discussed and pattern.search(content):
+                        self.categories_discussed.append(name)
+                if self._pending_user is not None and not self._is_identity_turn(self._pending_user):
+                    self.follow_ups_used += 1
+            self._pending_user = None
+        self.messages_seen += 1
+        self._last_key = self._message_key(message)
+
+    @staticmethod
+    def _is_identity_turn(message: dict) -> bool:
+        if "intent" in message:
+            return message["intent"] == "F"
+        return is_identity_question(message["content"])
+
+    def to_dict(self) -> dict:
+        return {
+            "messages_seen": self.messages_seen,
+            "language": self.language or "en",
+            "follow_ups_used": self.follow_ups_used,
+            "off_topic_variants_used": sorted(self.off_topic_variants),
+            "categories_discussed": list(self.categories_discussed),
+        }
+
+    def prompt_summary(self, qa_scores_json: dict) -> str:
+        """Compact state block placed above the history in the {conversation_history} slot."""
+        language = LANGUAGE_NAMES.get(self.language or "en")
+        lines = [
+            "Conversation state (tracked by the app over the whole conversation; use these "
+            "values instead of re-counting them from conversation_history):",
+            f"- User's language: {language}"
+            + ("" if self.language else " (default; the user has not written yet)") + ".",
+        ]
+        next_line = self.follow_ups_used + 1
+        if next_line <= FOLLOW_UP_POOL_SIZE:
+            lines.append(
+                f"- Follow-up pool: {self.follow_ups_used} on-topic Type A/B/C/E replies so far; "
+                f"the next one uses line #{next_line}.")
+        else:
+            lines.append(
+                f"- Follow-up pool: all {FOLLOW_UP_POOL_SIZE} lines are used; write a new "
+                "unique question.")
+        used = sorted(self.off_topic_variants)
+        if len(used) >= len(OFF_TOPIC_VARIANTS):
+            lines.append("- Off-topic variants: all 8 are used; write a new one in the same style.")
+        else:
+            lines.append(
+                "- Off-topic variants already used: "
+                + (", ".join(str(n) for n in used) if used else "none") + ".")
+        lines.append(
+            "- Categories already discussed: "
+            + (", ".join(self.categories_discussed) if self.categories_discussed else "none") + ".")
+        scores = {
+            name: value["score"] for name, value in qa_scores_json.items()
+            if isinstance(value, dict) and isinstance(value.get("score"), (int, float))
+        }
+        open_scores = {n: s for n, s in scores.items() if n not in self.categories_discussed}
+        if open_scores:
+            lowest = min(open_scores, key=open_scores.get)
+            lines.append(f"- Lowest-scored category not yet discussed: {lowest}.")
+        elif scores:
+            lines.append("- Every category has been discussed; a general advice request goes "
+                         "deeper into the lowest-scored one.")
+        return "\n".join(lines)
+
+
+# ============================================
+# INTENT CLASSIFIER
+# ============================================
+
+INTENT_TYPES = {
+    "A": "information question",
+    "B": "advice request",
+    "C": "overall judgment or emotional reaction",
+    "D": "off-topic",
+    "E": "follow-up on the current topic",
+    "F": "identity or meta question",
+}
+# Order of OFF_TOPIC_VARIANTS translations.
+VARIANT_LANGUAGES = ("en", "de", "uk")
+
+
+def _stems(*stems) -> re.Pattern:
+    return re.compile(r"(?<!\w)(?:" + "|".join(stems) + ")", re.IGNORECASE)
+
+
+# Cues per message type, in English, German and Ukrainian (word-start matches).
+_INTENT_CUES = {
+    "A": _stems(
+        r"scores?\b", r"rating", r"rated", r"points", r"lowest", r"highest", r"which categor",
+        r"what is my", r"what's my", r"why is my", r"punkt", r"bewertung", r"note\b",
+        r"niedrigst", r"höchst", r"welche kategorie", r"warum ist mein", r"оцінк", r"бал",
+        r"найнижч", r"найвищ", r"яка категорі", r"чому в мене",
+    ),
+    "B": _stems(
+        r"improve", r"fix", r"tips?\b", r"advice", r"how can i", r"how do i", r"what should i",
+        r"better\b", r"verbesser", r"tipp", r"ratschlag", r"wie kann ich", r"was soll ich",
+        r"besser", r"покращ", r"виправ", r"порад", r"як мені", r"що мені", r"краще",
+    ),
+    "C": _stems(
+        r"is (?:my|it|this) (?:picture|portrait|drawing|painting|work) (?:good|bad|ok)",
+        r"am i\b", r"talent", r"frustrat", r"proud", r"sad\b", r"terrible", r"hopeless",
+        r"good enough", r"bin ich", r"schlecht", r"traurig", r"stolz", r"gut genug",
+        r"чи я\b", r"погано", r"сумно", r"пишаю", r"жахлив", r"достатньо добре",
+        r":\(", r"☹", r"😢", r"😞",
+    ),
+    "E": _stems(
+        r"tell me more", r"more\b", r"why\??$", r"i don't understand", r"what do you mean",
+        r"and\b", r"erklär", r"mehr\b", r"warum\??$", r"verstehe (?:ich )?nicht", r"und\b",
+        r"більше", r"чому\??$", r"не розумію", r"поясни", r"а\b",
+    ),
+}
+_ART_TOPIC = _stems(
+    r"portrait", r"drawing", r"draw", r"picture", r"paint", r"sketch", r"art", r"evaluation",
+    r"feedback", r"categor", r"face", r"eyes?\b", r"nose", r"mouth",
+    r"porträt", r"zeichn", r"bild", r"malen", r"malerei", r"gemälde", r"kunst", r"skizz",
+    r"gesicht", r"auge", r"nase", r"портрет", r"малю", r"карти", r"мистец", r"ескіз",
+    r"обличч", r"очі", r"ніс\b", r"носа",
+    *(stem for stems in CATEGORY_KEYWORDS.values() for stem in map(re.escape, stems)),
+)
+_OFF_TOPIC_CUES = _stems(
+    r"weather", r"party", r"joke", r"football", r"soccer", r"movie", r"film", r"music",
+    r"song", r"food", r"pizza", r"dinner", r"holiday", r"vacation", r"politic", r"news",
+    r"video ?game", r"stock", r"bitcoin", r"recipe", r"birthday", r"girlfriend", r"boyfriend",
+    r"wetter", r"witz", r"fußball", r"essen", r"urlaub", r"politik", r"nachrichten",
+    r"rezept", r"geburtstag", r"погод", r"вечірк", r"жарт", r"анекдот", r"футбол",
+    r"фільм", r"музик", r"пісн", r"їж", r"відпуст", r"канікул", r"політик", r"новин",
+    r"рецепт", r"день народження",
+)
+
+
+def classify_intent(text: str) -> tuple:
+    """(message type A–F, confidence) for a user message from keyword cues, or (None, 0.0)
+    for app events."""
+    if text.startswith(APP_EVENT_PREFIX):
+        return None, 0.0
+    if is_identity_question(text):
+        return "F", 0.9
+    cues = {t: len(pattern.findall(text)) for t, pattern in _INTENT_CUES.items()}
+    on_topic = bool(_ART_TOPIC.search(text))
+    if not on_topic and not (cues["A"] or cues["B"] or cues["C"]):
+        if _OFF_TOPIC_CUES.search(text):
+            return "D", 0.9
+        if not cues["E"] and len(_WORD.findall(text)) >= 5:
+            return "D", 0.6
+    total = sum(cues.values())
+    if not total:
+        return "E", 0.5
+    best = max(cues, key=cues.get)
+    return best, round(0.6 + 0.3 * cues[best] / total, 2)
+
+
+def has_finished_evaluation(qa_scores_json: dict) -> bool:
+    """Whether qa_scores_json holds scores (the prompt's waiting mode otherwise)."""
+    return any(
+        isinstance(value, dict) and isinstance(value.get("score"), (int, float))
+        for value in qa_scores_json.values()
+    )
+
+
+def off_topic_fast_reply(state: ConversationState):
+    """(variant number, text) of the next unused off-topic variant in the user's
+    language, or None when all are used (the model then writes a new one)."""
+    for number, texts in OFF_TOPIC_VARIANTS.items():
+        if number not in state.off_topic_variants:
+            return number, texts[VARIANT_LANGUAGES.index(state.language or "en")]
+    return None
+
+
+def intent_hint(intent: str, confidence: float) -> str:
+    return (
+        f"- Local pre-classification of the latest user message: Type {intent} "
+        f"({INTENT_TYPES[intent]}), confidence {confidence:.2f}. It is a hint; check it "
+        "against the type definitions."
+    )
+
+
+# ============================================
+# MODEL ROUTING
+# ============================================
+
+class LatencyTracker:
+    """Recent time-to-first-token samples per deployment, shared by all sessions."""
+
+    def __init__(self, window: int):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self.window = window
+
+    def record(self, deployment: str, ttft_s: float) -> None:
+        with self._lock:
+            self._samples.setdefault(deployment, deque(maxlen=self.window)).append(ttft_s)
+
+    def quantile(self, deployment: str, q: float):
+        """The q-quantile of the recent samples, or None without samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(deployment, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+@st.cache_resource
+def get_latency_tracker() -> LatencyTracker:
+    return LatencyTracker(ROUTING_LATENCY_WINDOW)
+
+
+def _by_name_prefix(table: dict, name: str):
+    matches = [key for key in table if key != "default" and name.startswith(key)]
+    return table[max(matches, key=len)] if matches else table.get("default")
+
+
+def _is_reasoning(deployment: str) -> bool:
+    return bool((_by_name_prefix(DEPLOYMENT_PROFILES, deployment) or {}).get("reasoning_effort"))
+
+
+def tier_deployments(model: str, deployed=None) -> list:
+    """(tier, deployment) from small to large, ending at the conversation's `model`. Tiers
+    must rank below `model` in DEPLOYMENT_SIZE_RANKS, be reasoning models only under one,
+    and be among `deployed` (the resource's deployment names) if given."""
+    rank = _by_name_prefix(DEPLOYMENT_SIZE_RANKS, model)
+    tiers = []
+    for tier, deployment in MODEL_TIERS.items():
+        if deployment is None or deployment == model:
+            break
+        tier_rank = _by_name_prefix(DEPLOYMENT_SIZE_RANKS, deployment)
+        if rank is None or tier_rank is None or tier_rank >= rank:
+            continue
+        if _is_reasoning(deployment) and not _is_reasoning(model):
+            continue
+        if not deployed or deployment in deployed:
+            tiers.append((tier, deployment))
+    return tiers + [(tier, model)]
+
+
+def route_turn(
+    model: str, message: str, intent: str, confidence: float, history_length: int,
+    latency: LatencyTracker = None, deployed=None,
+) -> dict:
+    """The routing record (tier, deployment, reasons) for the user `message`: a tier from its
+    intent and length, adjusted for history length, the TTFT SLO and what is deployed."""
+    tiers = tier_deployments(model, deployed)
+    names = [tier for tier, _ in tiers]
+    words = len(_WORD.findall(message))
+    if words <= ROUTING_SHORT_MESSAGE_WORDS and intent in ROUTING_SHORT_MESSAGE_INTENTS:
+        tier = "small"
+        reasons = [f"short message ({words} words)"]
+    elif intent is None or confidence < ROUTING_MIN_CONFIDENCE:
+        tier = "large"
+        reasons = ["no confident intent"]
+    else:
+        tier = INTENT_TIERS.get(intent, "large")
+        reasons = [f"intent {intent}"]
+    order = list(MODEL_TIERS)
+    index = next(
+        (i for i, name in enumerate(names) if order.index(name) >= order.index(tier)),
+        len(tiers) - 1)
+    if names[index] != tier:
+        if order.index(tier) > order.index(names[-1]):
+            reasons.append(f"capped at {model}")
+        elif deployed and MODEL_TIERS[tier] not in deployed:
+            reasons.append(f"{tier} not deployed")
+        else:
+            reasons.append(f"{tier} not below {model}")
+    if history_length >= ROUTING_LONG_HISTORY_MESSAGES and names[index] == "small" and len(tiers) > 1:
+        index = 1
+        reasons.append(f"history {history_length} messages")
+    observed = None
+    if latency is not None:
+        observed = latency.quantile(tiers[index][1], ROUTING_SLO_QUANTILE)
+        if observed is not None and observed > ROUTING_TTFT_SLO_S and index > 0:
+            lower = latency.quantile(tiers[index - 1][1], ROUTING_SLO_QUANTILE)
+            if lower is None or lower <= ROUTING_TTFT_SLO_S:
+                reasons.append(
+                    f"{tiers[index][1]} TTFT p{round(ROUTING_SLO_QUANTILE * 100)} "
+                    f"{observed:.2f}s over SLO")
+                index -= 1
+                observed = lower
+    tier, deployment = tiers[index]
+    return {
+        "tier": tier,
+        "deployment": deployment,
+        "conversation_model": model,
+        "reasons": reasons,
+        "slo_ttft_s": ROUTING_TTFT_SLO_S,
+        "expected_ttft_s": observed,
+    }
+
+
+def record_routing_outcome(routing: dict, log_entry: dict, latency: LatencyTracker) -> None:
+    """Add what happened to the routed request to `routing` and feed the latency tracker."""
+    ttft = (log_entry.get("timings") or {}).get("time_to_first_token_s")
+    used = log_entry.get("deployment_used")
+    routing["outcome"] = {
+        "deployment_used": used,
+        "fell_back": used is not None and used != routing["deployment"],
+        "ttft_s": ttft,
+        "within_slo": ttft is not None and ttft <= routing["slo_ttft_s"],
+        "error": (log_entry.get("error") or {}).get("type"),
+    }
+    if used and ttft is not None and not log_entry.get("cached"):
+        latency.record(used, ttft)
 
 
 # ============================================
@@ -429,6 +1800,91 @@ def call_azure_api(
 # ============================================
 
 
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?…])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (about 4 characters per token) used for budgeting."""
+    return len(text) // 4 + 1
+
+
+@st.cache_resource
+def get_token_encoder():
+    """tiktoken encoding for TOKENIZER_ENCODING, or None (not installed / not downloadable)."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoder = get_token_encoder()
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+_PROMPT_INPUT_BLOCK = """### Conversation History
+{conversation_history}
+
+### Input
+qa_scores_json:
+{qa_scores_json}
+
+---
+
+"""
+_PROMPT_INPUT_NOTE = (
+    "(qa_scores_json and conversation_history are provided at the end of this prompt.)"
+    "\n\n---\n\n"
+)
+
+
+@st.cache_resource
+def compile_prompt_template(template: str) -> str:
+    """Prefix-stable template: the static instructions first, then the session-constant
+    {qa_scores_json} slot, then the per-turn {conversation_history} slot."""
+    if _PROMPT_INPUT_BLOCK not in template:
+        raise ValueError("Prompt template no longer contains the expected input block")
+    prefix = template.replace(_PROMPT_INPUT_BLOCK, _PROMPT_INPUT_NOTE)
+    return (
+        f"{prefix}\n\n"
+        "---\n\n### Input\nqa_scores_json:\n{qa_scores_json}\n\n"
+        "---\n\n### Conversation History\n{conversation_history}"
+    )
+
+
+def prompt_template() -> str:
+    """System prompt template for PROMPT_LAYOUT."""
+    if PROMPT_LAYOUT == "inline":
+        return portrait_qa_system_prompt
+    return compile_prompt_template(portrait_qa_system_prompt)
+
+
+@st.cache_resource
+def _qa_json_cache() -> dict:
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def serialize_qa_scores(qa_scores_json: dict) -> str:
+    """qa_scores_json as prompt text, serialized once per (never mutated) evaluation object."""
+    cache = _qa_json_cache()
+    key = id(qa_scores_json)
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is not None and entry[0] is qa_scores_json:
+            return entry[1]
+    qa_json = json.dumps(qa_scores_json, ensure_ascii=False, indent=2)
+    with cache["lock"]:
+        entries = cache["entries"]
+        entries[key] = (qa_scores_json, qa_json)
+        while len(entries) > 256:
+            entries.pop(next(iter(entries)))
+    return qa_json
+
+
 def build_system_prompt(qa_scores_json: dict, messages: list) -> str:
     """Fill portrait_qa_system_prompt with conversation_history and qa_scores_json."""
     conversation_history = [
@@ -436,119 +1892,1621 @@ def build_system_prompt(qa_scores_json: dict, messages: list) -> str:
         for m in messages
     ]
     history_json = json.dumps(conversation_history, ensure_ascii=False, indent=2)
-    qa_json = json.dumps(qa_scores_json, ensure_ascii=False, indent=2)
-    return (
-        portrait_qa_system_prompt.replace("{conversation_history}", history_json)
-        .replace("{qa_scores_json}", qa_json)
+    return fill_prompt_template(
+        prompt_template(), history_json, serialize_qa_scores(qa_scores_json)
     )
 
 
-def generate_response(
-    qa_scores_json: dict, messages: list, model: str
+def split_history(messages: list, token_budget: int) -> tuple:
+    """Split messages into (older, recent): recent is the newest run within token_budget and
+    always holds the last message."""
+    used = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        cost = estimate_tokens(messages[i]["content"]) + 4
+        if start < len(messages) and used + cost > token_budget:
+            break
+        used += cost
+        start = i
+    return messages[:start], messages[start:]
+
+
+def digest_message(number: int, message: dict) -> str:
+    """One line per older turn; replies keep their opening and closing sentences."""
+    content = " ".join(message["content"].split())
+    if message["role"] == "user":
+        if len(content) > DIGEST_USER_MESSAGE_CHARS:
+            content = content[:DIGEST_USER_MESSAGE_CHARS].rstrip() + " …"
+    else:
+        sentences = _SENTENCE_BREAK.split(content)
+        if len(sentences) > 4:
+            content = f"{sentences[0]} … {' '.join(sentences[-3:])}"
+    return f"#{number} {message['role']}: {content}"
+
+
+def format_history_section(older: list, recent_count: int, omitted: int = 0) -> str:
+    """Text for the {conversation_history} slot in compact mode; `omitted` older messages
+    were dropped by the context guard."""
+    if not older and not recent_count and not omitted:
+        return "(no messages yet)"
+    lines = []
+    if omitted:
+        lines.append(f"(Messages #1–#{omitted} are omitted to fit the context window.)")
+    if older:
+        lines.append(
+            "Earlier turns, condensed (user messages shortened; assistant replies "
+            "show the opening sentence and the closing unit):"
+        )
+        lines.extend(digest_message(omitted + i + 1, m) for i, m in enumerate(older))
+    if recent_count:
+        lines.append(
+            f"The {recent_count} most recent message(s), #{omitted + len(older) + 1} onwards, "
+            "follow verbatim as chat messages after this prompt. Together with any "
+            "lines above they are the complete conversation_history, oldest first."
+        )
+    return "\n".join(lines)
+
+
+def build_prompt_messages(
+    qa_scores_json: dict,
+    messages: list,
+    history_mode: str = None,
+    history_token_budget: int = None,
+    digest_lines: int = None,
+    state_summary: str = None,
 ) -> tuple:
-    """Call the model with the single portrait QA system prompt. Returns (response, log_entry)."""
-    system_prompt = build_system_prompt(qa_scores_json, messages)
-    api_messages = [{"role": "system", "content": system_prompt}]
-    api_messages.extend(
-        [{"role": m["role"], "content": m["content"]} for m in messages]
+    """(system_prompt, chat_messages, prompt_parts, older_turn_count) for one request."""
+    if history_mode is None:
+        history_mode = PROMPT_HISTORY_MODE
+    if history_token_budget is None:
+        history_token_budget = HISTORY_TOKEN_BUDGET
+    chat_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+    if history_mode == "full":
+        older, recent = [], chat_messages
+        history_text = json.dumps(chat_messages, ensure_ascii=False, indent=2)
+    else:
+        older, recent = split_history(chat_messages, history_token_budget)
+        kept = older if digest_lines is None else older[max(0, len(older) - digest_lines):]
+        history_text = format_history_section(kept, len(recent), len(older) - len(kept))
+    if state_summary:
+        history_text = f"{state_summary}\n\n{history_text}"
+    prompt_parts = {
+        "template": prompt_template(),
+        "conversation_history": history_text,
+        "qa_scores_json": serialize_qa_scores(qa_scores_json),
+    }
+    system_prompt = fill_prompt_template(
+        prompt_parts["template"],
+        prompt_parts["conversation_history"],
+        prompt_parts["qa_scores_json"],
+    )
+    return system_prompt, recent, prompt_parts, len(older)
+
+
+@st.cache_resource
+def template_instruction_tokens(template: str) -> int:
+    """Tokens of the template without its two slots (the static instructions)."""
+    return count_tokens(
+        template.replace("{conversation_history}", "").replace("{qa_scores_json}", "")
+    )
+
+
+def prompt_token_breakdown(prompt_parts: dict, chat_messages: list) -> dict:
+    """Local token count of one request by section; `messages` includes per-message overhead."""
+    tokens = {
+        "instructions": template_instruction_tokens(prompt_parts["template"]),
+        "evaluation": count_tokens(prompt_parts["qa_scores_json"]),
+        "history": count_tokens(prompt_parts["conversation_history"]),
+        "messages": 4 + sum(count_tokens(m["content"]) + 4 for m in chat_messages),
+    }
+    tokens["total"] = sum(tokens.values())
+    tokens["counter"] = "tiktoken" if get_token_encoder() is not None else "estimate"
+    return tokens
+
+
+def prompt_token_limit(model: str) -> int:
+    """Prompt token limit for a request to `model`, including its fallback deployments."""
+    limits = []
+    for name in [model, *fallback_deployments_for(model)]:
+        limit = DEPLOYMENT_CONTEXT_LIMITS.get(name) or DEPLOYMENT_CONTEXT_LIMITS["default"]
+        output = output_token_cap(get_deployment_profiles().get(name))
+        limits.append(min(
+            limit["context_window"] - output, limit["max_prompt_tokens"]
+        ))
+    return min(limits)
+
+
+def fit_prompt_to_limit(
+    qa_scores_json: dict, messages: list, limit: int, state_summary: str = None
+) -> tuple:
+    """build_prompt_messages, with the history compacted until the prompt fits `limit` tokens.
+    Returns (built, tokens, guard)."""
+    history_mode, budget, digest_lines = PROMPT_HISTORY_MODE, HISTORY_TOKEN_BUDGET, None
+    actions = []
+    while True:
+        built = build_prompt_messages(
+            qa_scores_json, messages, history_mode, budget, digest_lines, state_summary
+        )
+        tokens = prompt_token_breakdown(built[2], built[1])
+        if tokens["total"] <= limit:
+            break
+        condensed = built[3] if digest_lines is None else min(digest_lines, built[3])
+        if history_mode == "full":
+            history_mode = "compact"
+            actions.append("history_mode=compact")
+        elif condensed:
+            digest_lines = condensed // 2
+            actions.append(f"digest_lines={digest_lines}")
+        elif budget > MIN_HISTORY_TOKEN_BUDGET:
+            budget = max(MIN_HISTORY_TOKEN_BUDGET, budget // 2)
+            actions.append(f"history_token_budget={budget}")
+        else:
+            break
+    guard = {
+        "limit": limit,
+        "history_mode": history_mode,
+        "actions": actions,
+        "fits": tokens["total"] <= limit,
+    }
+    return built, tokens, guard
+
+
+def generate_response_stream_async(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, state: ConversationState = None, intent: tuple = None,
+    fallbacks: list = None, trace: Trace = None,
+) -> tuple:
+    """Streaming variant of generate_response_async. Returns (chunks, log_entry); log_entry
+    is complete once chunks is exhausted."""
+    if trace is None:
+        trace = Trace()
+    build_span = trace.begin("build_prompt")
+    if state is None:
+        state = ConversationState.from_messages(messages, qa_scores_json)
+    summary_lines = []
+    if CONVERSATION_STATE_IN_PROMPT:
+        summary_lines.append(state.prompt_summary(qa_scores_json))
+    if intent is not None:
+        summary_lines.append(intent_hint(*intent))
+    state_summary = "\n".join(summary_lines) or None
+    built, prompt_tokens, guard = fit_prompt_to_limit(
+        qa_scores_json, messages, prompt_token_limit(model), state_summary
     )
-    response = call_azure_api(api_messages, model=model)
+    system_prompt, chat_messages, prompt_parts, older_turns = built
+    api_messages = [{"role": "system", "content": system_prompt}]
+    api_messages.extend(chat_messages)
     log_entry = {
         "step": "response_generation",
         "model": model,
+        "history_mode": guard["history_mode"],
+        "prompt_layout": PROMPT_LAYOUT,
+        "condensed_turns": older_turns,
+        "prompt_tokens": prompt_tokens,
+        "conversation_state": state.to_dict(),
         "system_prompt": system_prompt,
-        "conversation_messages": [
-            {"role": m["role"], "content": m["content"]} for m in messages
-        ],
-        "response": response,
+        "prompt_parts": prompt_parts,
+        "conversation_messages": chat_messages,
+        "response": "",
     }
+    if guard["actions"] or not guard["fits"]:
+        log_entry["context_guard"] = guard
+    trace.end(build_span, prompt_tokens=prompt_tokens["total"], history_mode=guard["history_mode"])
+
+    # Resolved in the calling thread, like the shared resources in stream_azure_api_async.
+    cache = get_response_cache() if RESPONSE_CACHE_ENABLED else None
+    stats = {}
+    upstream = stream_azure_api_async(
+        api_messages, model=model, stats=stats, ticket=ticket, fallbacks=fallbacks,
+        trace=trace,
+    )
+    profile = get_deployment_profiles().get(model)
+    log_entry["request_params"] = {
+        **completion_params(profile, TEMPERATURE), "profile_source": profile["source"]}
+
+    async def chunks():
+        cache_key = None
+        if cache is not None:
+            cache_key = ResponseCache.make_key(
+                model, api_messages, completion_params(profile, TEMPERATURE))
+            with trace.span("cache_lookup") as lookup_span:
+                cached, tier = cache.get(cache_key)
+                lookup_span["attributes"]["hit"] = cached is not None
+            log_entry["cache"] = {"hit": cached is not None, "tier": tier, "key": cache_key}
+            if cached is not None:
+                yield cached
+                log_entry["response"] = cached
+                log_entry["deployment_used"] = model
+                log_entry["timings"] = {
+                    "queue_wait_s": 0.0, "time_to_first_token_s": 0.0, "stream_total_s": 0.0}
+                log_entry["error"] = None
+                return
+        parts = []
+        async for piece in upstream:
+            parts.append(piece)
+            yield piece
+        log_entry["response"] = "".join(parts)
+        if cache_key and log_entry["response"] and not stats["error"]:
+            cache.put(cache_key, log_entry["response"], RESPONSE_CACHE_TTL_S)
+        log_entry["deployment_used"] = stats["deployment"]
+        log_entry["timings"] = {
+            "queue_wait_s": stats["queue_wait_s"],
+            "time_to_first_token_s": stats["time_to_first_token_s"],
+            "stream_total_s": stats["stream_total_s"],
+            "chunks": stats["chunks"],
+            "tokens_per_s": stats["tokens_per_s"],
+        }
+        if stats.get("usage"):
+            log_entry["usage"] = stats["usage"]
+        if stats["attempts"]:
+            log_entry["attempts"] = stats["attempts"]
+        log_entry["error"] = stats["error"]
+
+    return chunks(), log_entry
+
+
+def generate_response_stream(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, on_wait=None, state: ConversationState = None,
+) -> tuple:
+    """Synchronous generate_response_stream_async. Returns (chunks, log_entry)."""
+    chunks, log_entry = generate_response_stream_async(
+        qa_scores_json, messages, model, ticket, state)
+    return iterate_async(chunks, on_wait), log_entry
+
+
+async def generate_response_async(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, state: ConversationState = None,
+) -> tuple:
+    """Call the model with the single portrait QA system prompt. Returns (response, log_entry)."""
+    chunks, log_entry = generate_response_stream_async(
+        qa_scores_json, messages, model, ticket, state)
+    response = "".join([piece async for piece in chunks])
     return response, log_entry
 
 
-def process_user_message(
-    qa_scores_json: dict, messages: list, model: str
+def generate_response(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, state: ConversationState = None,
 ) -> tuple:
-    """Returns (response, log_entry)."""
-    response, response_log = generate_response(qa_scores_json, messages, model)
+    """Call the model with the single portrait QA system prompt. Returns (response, log_entry)."""
+    chunks, log_entry = generate_response_stream(
+        qa_scores_json, messages, model, ticket, state=state)
+    response = "".join(chunks)
+    return response, log_entry
+
+
+def answer_off_topic_locally(
+    messages: list, model: str, state: ConversationState, confidence: float
+):
+    """Type D fast path: (chunks, log_entry) from the off-topic variant pool, or None when
+    every variant is used."""
+    reply = off_topic_fast_reply(state)
+    if reply is None:
+        return None
+    variant, text = reply
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "model": model,
+        "user_message": messages[-1]["content"],
+        "steps": [{
+            "step": "intent_fast_path",
+            "intent": "D",
+            "confidence": confidence,
+            "variant": variant,
+            "language": state.language or "en",
+            "response": text,
+        }],
+        "conversation_state": state.to_dict(),
+        "intent": {"type": "D", "confidence": confidence, "fast_path": True},
+        "assistant_response": text,
+        "deployment_used": None,
+        "timings": {"queue_wait_s": 0.0, "time_to_first_token_s": 0.0, "stream_total_s": 0.0},
+        "error": None,
+    }
+
+    async def chunks():
+        yield text
+
+    return chunks(), log_entry
+
+
+def process_user_message_stream_async(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, state: ConversationState = None, trace: Trace = None,
+) -> tuple:
+    """Returns (chunks, log_entry) for the latest message, answered locally, by the routed
+    deployment or by `model`; log_entry is complete once chunks is exhausted."""
+    started = time.perf_counter()
+    metrics = get_metrics_registry()
+    priority = ticket.priority if ticket else "turn"
+    if trace is None:
+        trace = Trace()
+    if state is None:
+        state = ConversationState.from_messages(messages, qa_scores_json)
+    intent, confidence = None, 0.0
+    if messages and messages[-1]["role"] == "user":
+        with trace.span("classify_intent") as classify_span:
+            intent, confidence = classify_intent(messages[-1]["content"])
+            classify_span["attributes"].update(intent=intent, confidence=confidence)
+    if (
+        INTENT_FAST_PATH_ENABLED
+        and intent == "D"
+        and confidence >= INTENT_FAST_PATH_MIN_CONFIDENCE
+        and has_finished_evaluation(qa_scores_json)
+    ):
+        with trace.span("local_reply"):
+            local = answer_off_topic_locally(messages, model, state, confidence)
+        if local is not None:
+            local[1]["trace"] = trace.data
+            trace.finish()
+            metrics.record_turn(priority, "local", time.perf_counter() - started)
+            return local
+    routing = latency = None
+    deployment, fallbacks = model, None
+    if MODEL_ROUTING_ENABLED and messages and messages[-1]["role"] == "user":
+        latency = get_latency_tracker()
+        deployed = get_deployment_catalog().models(AZURE_ENDPOINT)
+        with trace.span("route_turn") as route_span:
+            routing = route_turn(
+                model, messages[-1]["content"], intent, confidence, len(messages), latency,
+                deployed)
+            route_span["attributes"].update(tier=routing["tier"], deployment=routing["deployment"])
+        if routing["deployment"] != model:
+            deployment = routing["deployment"]
+            # A tier missing from this resource ends up on the conversation's deployment.
+            fallbacks = [
+                name for name in dict.fromkeys(
+                    fallback_deployments_for(deployment) + [model] + fallback_deployments_for(model))
+                if name != deployment
+            ]
+    response_chunks, response_log = generate_response_stream_async(
+        qa_scores_json, messages, deployment, ticket, state,
+        (intent, confidence) if intent else None, fallbacks, trace,
+    )
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "model": model,
         "user_message": messages[-1]["content"] if messages else "",
         "steps": [response_log],
-        "assistant_response": response,
+        "prompt_tokens": response_log["prompt_tokens"],
+        "conversation_state": response_log["conversation_state"],
+        "assistant_response": "",
+        "trace": trace.data,
     }
+    if "context_guard" in response_log:
+        log_entry["context_guard"] = response_log["context_guard"]
+    if intent:
+        log_entry["intent"] = {"type": intent, "confidence": confidence, "fast_path": False}
+    if routing:
+        log_entry["routing"] = routing
+
+    async def chunks():
+        async for piece in response_chunks:
+            yield piece
+        log_entry["assistant_response"] = response_log["response"]
+        log_entry["deployment_used"] = response_log["deployment_used"]
+        log_entry["timings"] = response_log["timings"]
+        if "usage" in response_log:
+            log_entry["usage"] = response_log["usage"]
+        log_entry["error"] = response_log["error"]
+        if response_log.get("cache", {}).get("hit"):
+            log_entry["cached"] = response_log["cache"]["tier"]
+        if routing:
+            record_routing_outcome(routing, log_entry, latency)
+        trace.finish()
+        outcome = "error" if log_entry["error"] else ("cached" if "cached" in log_entry else "model")
+        metrics.record_turn(priority, outcome, time.perf_counter() - started)
+
+    return chunks(), log_entry
+
+
+def process_user_message_stream(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, on_wait=None, state: ConversationState = None,
+    trace: Trace = None,
+) -> tuple:
+    """Returns (chunks, log_entry); log_entry is completed once chunks is exhausted."""
+    chunks, log_entry = process_user_message_stream_async(
+        qa_scores_json, messages, model, ticket, state, trace)
+    return iterate_async(chunks, on_wait), log_entry
+
+
+async def _collect_response(chunks, log_entry) -> tuple:
+    return "".join([piece async for piece in chunks]), log_entry
+
+
+async def process_user_message_async(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, state: ConversationState = None,
+) -> tuple:
+    """Returns (response, log_entry). Await it on the shared event loop (run_async); the
+    prompt is built on a worker thread so other streams on the loop keep going."""
+    chunks, log_entry = await asyncio.to_thread(
+        process_user_message_stream_async, qa_scores_json, messages, model, ticket, state
+    )
+    return await _collect_response(chunks, log_entry)
+
+
+def process_user_message(
+    qa_scores_json: dict, messages: list, model: str,
+    ticket: QueueTicket = None, state: ConversationState = None,
+) -> tuple:
+    """Returns (response, log_entry)."""
+    chunks, log_entry = process_user_message_stream(
+        qa_scores_json, messages, model, ticket, state=state
+    )
+    response = "".join(chunks)
     return response, log_entry
 
 
+# ============================================
+# SPECULATIVE PRE-GENERATION
+# ============================================
+
+def normalize_message(text: str) -> str:
+    return " ".join(w.lower() for w in re.findall(r"\w+", text))
+
+
+def predict_next_messages(state: ConversationState, k: int) -> list:
+    """The `k` likeliest next user messages in the conversation's language."""
+    candidates = list(SPECULATION_CANDIDATES.get(state.language or "en", SPECULATION_CANDIDATES["en"]))
+    likely = FOLLOW_UP_LIKELY_REPLY.get(state.follow_ups_used)
+    if likely is not None:
+        candidates.insert(0, candidates.pop(likely))
+    return candidates[:k]
+
+
+async def _speculate(
+    qa_scores_json: dict, messages: list, model: str, state_snapshot: dict, ticket: QueueTicket,
+) -> tuple:
+    """One speculative turn for the user message at the end of `messages`. The prompt is
+    built on a worker thread, so neither the script thread nor the event loop waits on it."""
+
+    def build():
+        state = ConversationState.from_snapshot(state_snapshot)
+        state.update(messages[-1])
+        return process_user_message_stream_async(qa_scores_json, messages, model, ticket, state)
+
+    chunks, log_entry = await asyncio.to_thread(build)
+    return await _collect_response(chunks, log_entry)
+
+
+class Speculator:
+    """A session's background answers to its likeliest next messages, with a token budget
+    and hit/waste counters."""
+
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+        self.launched = 0
+        self.hits = 0
+        self.misses = 0
+        self.late = 0           # matched, but the answer was not ready yet
+        self.tokens_spent = 0   # prompt + completion tokens (the prompt estimate if cancelled
+                                # after the request went out)
+        self.tokens_wasted = 0  # of which never served
+        self._prefix = None
+        self._prompt_estimate = 0
+        self._pending = []      # (candidate, normalized, estimated tokens, future, ticket)
+
+    def metrics(self) -> dict:
+        served = self.hits + self.misses
+        return {
+            "launched": self.launched,
+            "hits": self.hits,
+            "misses": self.misses,
+            "late": self.late,
+            "hit_rate": round(self.hits / served, 3) if served else None,
+            "tokens_spent": self.tokens_spent,
+            "tokens_wasted": self.tokens_wasted,
+            "token_budget": self.token_budget,
+        }
+
+    @staticmethod
+    def _prefix_key(qa_scores_json: dict, messages: list, model: str) -> tuple:
+        last = messages[-1]["content"] if messages else ""
+        return id(qa_scores_json), len(messages), content_hash(last), model
+
+    def start(
+        self, qa_scores_json: dict, messages: list, model: str, state: ConversationState,
+        session_id: str, estimated_prompt_tokens: int,
+    ) -> None:
+        """Pre-generate answers to the messages predicted after `messages`, within the budget."""
+        self.discard()
+        self._prefix = self._prefix_key(qa_scores_json, messages, model)
+        self._prompt_estimate = estimated_prompt_tokens
+        estimate = estimated_prompt_tokens + output_token_cap(get_deployment_profiles().get(model))
+        snapshot = state.snapshot()
+        runtime = get_async_runtime()
+        if MODEL_ROUTING_ENABLED:
+            get_latency_tracker()  # create it on the script thread, not a build thread
+        for candidate in predict_next_messages(state, SPECULATION_TOP_K):
+            reserved = sum(entry[2] for entry in self._pending)
+            if self.tokens_spent + reserved + estimate > self.token_budget:
+                break
+            ticket = QueueTicket(session_id, "speculation")
+            future = runtime.submit(_speculate(
+                qa_scores_json, messages + [{"role": "user", "content": candidate}], model,
+                snapshot, ticket,
+            ))
+            self._pending.append((candidate, normalize_message(candidate), estimate, future, ticket))
+            self.launched += 1
+
+    def take(self, qa_scores_json: dict, messages: list, model: str):
+        """A ready speculative (response, log_entry) for the user message at the end of
+        `messages`, or None. Every other speculation is discarded."""
+        if not self._pending:
+            return None
+        served = None
+        if self._prefix_key(qa_scores_json, messages[:-1], model) == self._prefix:
+            text = normalize_message(messages[-1]["content"])
+            best, best_ratio = None, 0.0
+            for entry in self._pending:
+                ratio = 1.0 if entry[1] == text else difflib.SequenceMatcher(
+                    None, entry[1], text).ratio()
+                if ratio > best_ratio:
+                    best, best_ratio = entry, ratio
+            if best is not None and best_ratio >= SPECULATION_MATCH_THRESHOLD:
+                future = best[3]
+                if not future.done():
+                    self.late += 1
+                elif not future.cancelled() and future.exception() is None:
+                    response, log_entry = future.result()
+                    if response and not log_entry.get("error"):
+                        served = best
+                        log_entry["speculation"] = {
+                            "hit": True,
+                            "candidate": best[0],
+                            "similarity": round(best_ratio, 3),
+                            "generation_timings": log_entry.get("timings"),
+                        }
+        self.discard(keep=served)
+        if served is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return served[3].result()
+
+    def discard(self, keep=None) -> None:
+        """Cancel or write off the pending speculations (except `keep`, which was served)."""
+        for entry in self._pending:
+            future = entry[3]
+            if not future.done():
+                future.cancel()
+                if entry[4].sent:
+                    # Azure bills the prompt of a request cancelled mid-stream.
+                    self.tokens_spent += self._prompt_estimate
+                    if entry is not keep:
+                        self.tokens_wasted += self._prompt_estimate
+                continue
+            if future.cancelled() or future.exception() is not None:
+                continue
+            usage = future.result()[1].get("usage") or {}
+            tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+            self.tokens_spent += tokens
+            if entry is not keep:
+                self.tokens_wasted += tokens
+        self._pending = []
+        self._prefix = None
+
+
+# ============================================
+# PIPELINE LOG STORE
+# ============================================
+
+def resume_pipeline_log_store(conversation_id: str) -> PipelineLogStore:
+    return PipelineLogStore.resume(PIPELINE_LOG_DIR, conversation_id, PIPELINE_LOG_MEMORY_TAIL)
+
+
+def new_pipeline_log_store() -> PipelineLogStore:
+    return PipelineLogStore(PIPELINE_LOG_DIR, uuid.uuid4().hex, PIPELINE_LOG_MEMORY_TAIL)
+
+
+# ============================================
+# EVALUATION INGESTION
+# ============================================
+
+@st.cache_resource
+def get_evaluation_store() -> EvaluationStore:
+    return EvaluationStore(EVALUATION_DB_PATH, EVALUATION_PARSED_CACHE_ENTRIES)
+
+
+@st.cache_resource
+def warn_missing_rerun_internals(missing: tuple) -> None:
+    """Logged once per process (the script's globals are reset on every run)."""
+    logger.warning(
+        "Streamlit %s lacks %s: sessions poll for evaluations instead of being woken",
+        st.__version__, ", ".join(missing))
+
+
+def session_push_supported() -> bool:
+    """Whether request_session_rerun can reach the current session. Logs once if a
+    Streamlit upgrade removed the internals it uses (sessions then poll instead)."""
+    try:
+        from streamlit.runtime import Runtime
+
+        ctx = get_script_run_ctx()
+        if ctx is None or not Runtime.exists():
+            return False
+        info = Runtime.instance()._session_mgr.get_active_session_info(ctx.session_id)
+        missing = missing_rerun_internals(info.session if info else None)
+    except Exception as e:
+        missing = [repr(e)]
+    if missing:
+        warn_missing_rerun_internals(tuple(missing))
+        return False
+    return info is not None
+
+
+@st.cache_resource
+def get_evaluation_inbox() -> EvaluationInbox:
+    inbox = EvaluationInbox(EVALUATION_INBOX_MAX_PENDING, get_evaluation_store())
+    if EVALUATION_INGEST_PORT:
+        inbox.serve_http(
+            EVALUATION_INGEST_HOST, EVALUATION_INGEST_PORT, EVALUATION_INGEST_MAX_BYTES)
+    inbox.watch_directory(EVALUATION_DROP_DIR, EVALUATION_DROP_SCAN_S)
+    return inbox
+
+
+# ============================================
+# SESSION STORE
+# ============================================
+
+@st.cache_resource
+def get_session_store() -> SessionStore:
+    return SessionStore(SESSION_DB_PATH)
+
+
+@st.cache_resource
+def get_session_activity() -> SessionActivity:
+    activity = SessionActivity(SESSION_IDLE_EVICT_S)
+    activity.start(SESSION_SWEEP_INTERVAL_S)
+    return activity
+
+
 # ============================================
 # STREAMLIT APPLICATION
 # ============================================
 
 def init_session_state():
+    if "session_id" not in st.session_state:
+        requested = st.query_params.get("session") or ""
+        if not restore_session(requested):
+            # An unknown id of the generated form is kept, so the URL stays stable.
+            st.session_state.session_id = (
+                requested if re.fullmatch(r"[0-9a-f]{12}", requested) else uuid.uuid4().hex[:12])
+    if st.query_params.get("session") != st.session_state.session_id:
+        st.query_params["session"] = st.session_state.session_id
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "messages_offset" not in st.session_state:
+        st.session_state.messages_offset = 0  # stored messages before st.session_state.messages
+    if "persisted_messages" not in st.session_state:
+        st.session_state.persisted_messages = 0
     if "conversation_started" not in st.session_state:
         st.session_state.conversation_started = False
     if "qa_scores_json" not in st.session_state:
         st.session_state.qa_scores_json = DEFAULT_QA_SCORES_JSON
-    if "pipeline_logs" not in st.session_state:
-        st.session_state.pipeline_logs = []
+    if "user_id" not in st.session_state:
+        st.session_state.user_id = st.query_params.get("user") or DEFAULT_USER_ID
+    if "active_portrait_id" not in st.session_state:
+        # The user's newest portrait, if the evaluation store has any.
+        st.session_state.active_portrait_id = None
+        latest = get_evaluation_store().latest(st.session_state.user_id)
+        qa_scores_json = get_evaluation_store().get(latest) if latest else None
+        if qa_scores_json is not None:
+            select_evaluation(qa_scores_json, latest)
+    if "pipeline_log_store" not in st.session_state:
+        st.session_state.pipeline_log_store = new_pipeline_log_store()
     if "azure_deployment" not in st.session_state:
         st.session_state.azure_deployment = DEFAULT_MODEL
     if "resolved_model" not in st.session_state:
         st.session_state.resolved_model = None
     if st.session_state.conversation_started and not st.session_state.resolved_model:
         st.session_state.resolved_model = DEFAULT_MODEL
+    if "chat_window" not in st.session_state:
+        st.session_state.chat_window = CHAT_WINDOW_SIZE
+    if "turn_error" not in st.session_state:
+        st.session_state.turn_error = None
+    if "failed_message" not in st.session_state:
+        st.session_state.failed_message = None
+    if "conversation_state" not in st.session_state:
+        st.session_state.conversation_state = ConversationState(
+            evaluation_categories(st.session_state.qa_scores_json))
+    if "pending_app_event" not in st.session_state:
+        st.session_state.pending_app_event = None
+    if "azure_client_warmed" not in st.session_state:
+        st.session_state.azure_client_warmed = True
+        warm_up_azure_client()
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        get_evaluation_inbox().register(st.session_state.session_id, ctx.session_id)
+
+
+def restore_session(session_id: str) -> bool:
+    """Load a stored session: its settings and the newest SESSION_RESUME_TAIL_MESSAGES
+    messages. False if the session store does not know `session_id`."""
+    store = get_session_store()
+    row = store.load(session_id) if session_id else None
+    if row is None:
+        return False
+    messages, first_seq = store.load_messages(session_id, limit=SESSION_RESUME_TAIL_MESSAGES)
+    st.session_state.session_id = session_id
+    st.session_state.messages = messages
+    st.session_state.messages_offset = first_seq
+    st.session_state.persisted_messages = first_seq + len(messages)
+    st.session_state.conversation_started = bool(row["conversation_started"])
+    st.session_state.resolved_model = row["resolved_model"]
+    st.session_state.user_id = row["user_id"] or DEFAULT_USER_ID
+    portrait_id = row["portrait_id"]
+    qa_scores_json = get_evaluation_store().get(portrait_id) if portrait_id else None
+    if qa_scores_json is None:
+        portrait_id = None
+        qa_scores_json = (
+            json.loads(row["qa_scores_json"]) if row["qa_scores_json"] else DEFAULT_QA_SCORES_JSON)
+    select_evaluation(qa_scores_json, portrait_id)
+    st.session_state.persisted_qa = qa_scores_json
+    st.session_state.pipeline_log_store = (
+        resume_pipeline_log_store(row["log_id"]) if row["log_id"] else new_pipeline_log_store())
+    st.session_state.conversation_state = (
+        ConversationState.from_snapshot(json.loads(row["conversation_state"]))
+        if row["conversation_state"]
+        else ConversationState(evaluation_categories(qa_scores_json)))
+    st.session_state.chat_window = CHAT_WINDOW_SIZE
+    return True
+
+
+def persist_session(replace: bool = False) -> None:
+    """Write the messages added since the last save and the session's settings to the
+    session store; `replace` rewrites the stored conversation (reset, loaded file)."""
+    offset = st.session_state.messages_offset
+    saved = 0 if replace else st.session_state.persisted_messages - offset
+    qa_scores_json = st.session_state.qa_scores_json
+    fields = {
+        "user_id": st.session_state.user_id,
+        "conversation_started": int(st.session_state.conversation_started),
+        "resolved_model": st.session_state.resolved_model,
+        "portrait_id": st.session_state.active_portrait_id,
+        "log_id": st.session_state.pipeline_log_store.conversation_id,
+        "conversation_state": json.dumps(sync_conversation_state().snapshot(), ensure_ascii=False),
+    }
+    if replace or st.session_state.get("persisted_qa") is not qa_scores_json:
+        # Evaluations from the evaluation store are referenced by portrait_id only.
+        stored = st.session_state.active_portrait_id or qa_scores_json is DEFAULT_QA_SCORES_JSON
+        fields["qa_scores_json"] = None if stored else json.dumps(qa_scores_json, ensure_ascii=False)
+        st.session_state.persisted_qa = qa_scores_json
+    get_session_store().save(
+        st.session_state.session_id, fields,
+        st.session_state.messages[saved:], offset + saved, replace=replace)
+    st.session_state.persisted_messages = offset + len(st.session_state.messages)
+
+
+def conversation_history_loader():
+    """Zero-argument callable returning the whole conversation: the messages not loaded
+    since a resume (read from the session store on call), then st.session_state.messages."""
+    session_id = st.session_state.session_id
+    offset = st.session_state.messages_offset
+    loaded = list(st.session_state.messages)
+    if not offset:
+        return lambda: loaded
+
+    def load():
+        return get_session_store().load_messages(session_id, before=offset)[0] + loaded
+
+    return load
+
+
+def evict_session() -> None:
+    """Drop an idle session's conversation from memory; it stays in the session store."""
+    persist_session()
+    speculator = st.session_state.pop("speculator", None)
+    if speculator is not None:
+        speculator.discard()
+    for key in ("messages", "unloaded_shown", "pipeline_log_store", "conversation_state",
+                "messages_offset", "persisted_messages", "persisted_qa"):
+        st.session_state.pop(key, None)
+    st.session_state.evicted = True
+
+
+def resume_evicted_session() -> None:
+    st.session_state.evicted = False
+    restore_session(st.session_state.session_id)
+
+
+def touch_session_activity() -> None:
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        get_session_activity().touch(st.session_state.session_id, ctx.session_id)
+
+
+def select_evaluation(qa_scores_json: dict, portrait_id: str = None) -> None:
+    """Make `qa_scores_json` the session's active evaluation."""
+    st.session_state.qa_scores_json = qa_scores_json
+    st.session_state.active_portrait_id = portrait_id
+    st.session_state.pop("cfg_qa", None)  # the debug text area re-reads it
+
+
+def switch_portrait() -> None:
+    """on_change of the portrait picker; mid-conversation, the switch gets an [App event] turn."""
+    portrait_id = st.session_state.portrait_picker
+    if portrait_id is None:
+        qa_scores_json = DEFAULT_QA_SCORES_JSON
+    else:
+        qa_scores_json = get_evaluation_store().get(portrait_id)
+        if qa_scores_json is None:
+            return
+    select_evaluation(qa_scores_json, portrait_id)
+    if st.session_state.conversation_started:
+        st.session_state.pending_app_event = PORTRAIT_SWITCH_EVENT
+        st.session_state.portrait_switched = True
+
+
+def render_portrait_picker():
+    """Select the active evaluation among the user's portraits in the evaluation store."""
+    portraits = get_evaluation_store().list_portraits(
+        st.session_state.user_id, EVALUATION_LIST_LIMIT)
+    created = dict(portraits)
+    options = [None] + [portrait_id for portrait_id, _ in portraits]
+    active = st.session_state.active_portrait_id
+    if active not in options:
+        options.insert(1, active)
+    if st.session_state.get("portrait_picker") != active:
+        st.session_state.portrait_picker = active  # follow deliveries and resets
+
+    def label(portrait_id):
+        if portrait_id is None:
+            return "Example evaluation (built-in)"
+        if portrait_id in created:
+            return f"{portrait_id} · {datetime.fromtimestamp(created[portrait_id]).strftime('%Y-%m-%d %H:%M')}"
+        return portrait_id
+
+    st.selectbox(
+        "Portrait", options, format_func=label, key="portrait_picker", on_change=switch_portrait)
+    st.caption(
+        f"User `{st.session_state.user_id}` · {len(portraits)} portrait(s) in the evaluation store")
+    if st.session_state.pop("portrait_switched", False):
+        st.rerun()
+
+
+def apply_delivered_evaluation(delivered: dict) -> None:
+    """Swap a delivered evaluation into the session; a started conversation gets an
+    [App event] turn on this run."""
+    select_evaluation(delivered["qa_scores_json"], delivered["portrait_id"])
+    if st.session_state.conversation_started:
+        st.session_state.pending_app_event = EVALUATION_READY_EVENT
+    st.toast("📬 The portrait evaluation has arrived.")
+
+
+@st.fragment(run_every=EVALUATION_FALLBACK_POLL_S)
+def watch_evaluation_inbox():
+    """Fallback where sessions cannot be woken from another thread: look for a
+    delivered evaluation every EVALUATION_FALLBACK_POLL_S."""
+    if get_evaluation_inbox().has_pending(st.session_state.session_id):
+        st.rerun(scope="app")
+
+
+def sync_conversation_state(qa_scores_json: dict = None) -> ConversationState:
+    """The session's ConversationState caught up with the messages; rebuilt when the
+    evaluation changed."""
+    if qa_scores_json is None:
+        qa_scores_json = st.session_state.qa_scores_json
+    state = st.session_state.conversation_state
+    if state.categories != evaluation_categories(qa_scores_json):
+        state = ConversationState(evaluation_categories(qa_scores_json))
+        st.session_state.conversation_state = state
+    return state.sync(st.session_state.messages, st.session_state.messages_offset)
+
+
+def record_intent(message: dict, log_entry: dict) -> None:
+    """Copy the classifier's result onto the user message (kept in conversation exports)."""
+    intent = log_entry.get("intent")
+    if intent:
+        message["intent"] = intent["type"]
+        message["confidence"] = intent["confidence"]
+
+
+def render_message_html(role: str, content: str) -> str:
+    if role == "user":
+        return f'''
+                        <div class="chat-message user-message">
+                            <strong>👤 User:</strong><br>{content}
+                        </div>
+                        '''
+    return f'''
+                        <div class="chat-message assistant-message">
+                            <strong>🤖 Assistant:</strong><br>{content}
+                        </div>
+                        '''
+
+
+def show_older_messages():
+    """Widen the window; past the loaded messages, read the next page from the session store."""
+    st.session_state.chat_window += CHAT_WINDOW_SIZE
+    offset = st.session_state.messages_offset
+    if offset and st.session_state.chat_window > len(st.session_state.messages):
+        older, first_seq = get_session_store().load_messages(
+            st.session_state.session_id, before=offset, limit=CHAT_WINDOW_SIZE)
+        st.session_state.messages[:0] = older
+        st.session_state.messages_offset = first_seq
+
+
+def unloaded_shown_count() -> int:
+    """Shown messages still in the session store only (before messages_offset)."""
+    offset = st.session_state.messages_offset
+    if not offset:
+        return 0
+    memo = st.session_state.get("unloaded_shown")
+    if memo is None or memo[0] != offset:
+        memo = st.session_state.unloaded_shown = (
+            offset, get_session_store().count_shown(
+                st.session_state.session_id, offset, APP_EVENT_PREFIX))
+    return memo[1]
+
+
+def render_chat_transcript():
+    """Render the newest chat_window messages."""
+    messages = [
+        m for m in st.session_state.messages
+        if m["role"] == "assistant"
+        or (m["role"] == "user" and not m["content"].startswith(APP_EVENT_PREFIX))
+    ]
+    shown = max(0, len(messages) - st.session_state.chat_window)
+    hidden = shown + unloaded_shown_count()
+    if hidden:
+        st.button(
+            f"⬆️ Load older messages ({hidden} hidden)",
+            on_click=show_older_messages,
+            key="load_older_messages",
+        )
+    for msg in messages[shown:]:
+        st.markdown(render_message_html(msg["role"], msg["content"]), unsafe_allow_html=True)
+
+
+def stream_assistant_reply(chunks, placeholder=None) -> str:
+    """Render the reply progressively in an assistant bubble and return the full text."""
+    if placeholder is None:
+        placeholder = st.empty()
+    parts = []
+    last_paint = 0.0
+    for piece in chunks:
+        parts.append(piece)
+        now = time.perf_counter()
+        if now - last_paint >= STREAM_REPAINT_INTERVAL_S:
+            placeholder.markdown(
+                render_message_html("assistant", "".join(parts) + " ▌"),
+                unsafe_allow_html=True,
+            )
+            last_paint = now
+    response = "".join(parts)
+    placeholder.markdown(
+        render_message_html("assistant", response), unsafe_allow_html=True
+    )
+    return response
+
+
+def stream_turn(
+    qa_scores_json: dict, messages: list, model: str, priority: str, trace: Trace,
+) -> tuple:
+    """Run one pipeline turn into an assistant bubble (with the queue position while it
+    waits). Returns (response, log_entry)."""
+    state = sync_conversation_state(qa_scores_json)
+    placeholder = st.empty()
+    ticket = QueueTicket(st.session_state.session_id, priority)
+
+    def show_queue_position():
+        if ticket.position:
+            placeholder.markdown(
+                render_message_html(
+                    "assistant",
+                    f"⏳ Busy right now — you are number {ticket.position} of "
+                    f"{ticket.queued} in the queue…",
+                ),
+                unsafe_allow_html=True,
+            )
+
+    speculator = st.session_state.get("speculator")
+    if speculator is not None and messages and messages[-1]["role"] == "user":
+        started = time.perf_counter()
+        with trace.span("speculation_lookup") as lookup_span:
+            hit = speculator.take(qa_scores_json, messages, model)
+            lookup_span["attributes"]["hit"] = hit is not None
+        if hit is not None:
+            response, log_entry = hit
+            placeholder.markdown(render_message_html("assistant", response), unsafe_allow_html=True)
+            served_s = time.perf_counter() - started
+            get_metrics_registry().record_turn(priority, "speculation", served_s)
+            # No time to first token: nothing was requested for this turn.
+            log_entry = {
+                **log_entry,
+                "user_message": messages[-1]["content"],
+                "timings": {"queue_wait_s": 0.0, "speculation_served_s": round(served_s, 3)},
+                "trace": trace.data,
+            }
+            return response, log_entry
+
+    inbox = get_evaluation_inbox()
+    inbox.turn_started(st.session_state.session_id)
+    try:
+        chunks, log_entry = process_user_message_stream(
+            qa_scores_json, messages, model,
+            ticket=ticket, on_wait=show_queue_position, state=state, trace=trace,
+        )
+        response = stream_assistant_reply(chunks, placeholder)
+    finally:
+        inbox.turn_finished(st.session_state.session_id)
+    return response, log_entry
+
+
+def finish_turn(trace: Trace, log_entry: dict, messages_for_api: list) -> None:
+    """Close the turn's trace, store the log entry and hand the trace to the OTLP exporter."""
+    trace.finish()
+    st.session_state.pipeline_log_store.append(log_entry, messages_for_api)
+    exporter = get_trace_exporter()
+    if exporter is not None:
+        exporter.export(trace.data)
+
+
+def start_speculation(qa_scores_json: dict, messages: list, model: str, log_entry: dict) -> None:
+    """After a reply, pre-generate the likely next turns (SPECULATION_ENABLED).
+    `messages` ends with that reply."""
+    if not SPECULATION_ENABLED:
+        return
+    speculator = st.session_state.get("speculator")
+    if speculator is None:
+        speculator = st.session_state.speculator = Speculator(SPECULATION_TOKEN_BUDGET)
+    if log_entry.get("error") or not messages or messages[-1]["role"] != "assistant":
+        speculator.discard()
+        return
+    prompt_tokens = log_entry.get("prompt_tokens") or {}
+    speculator.start(
+        qa_scores_json, messages, model, sync_conversation_state(qa_scores_json),
+        st.session_state.session_id, prompt_tokens.get("total") or estimate_tokens(
+            json.dumps(messages, ensure_ascii=False)),
+    )
+
+
+def run_chat_turn(content: str) -> None:
+    """Append a user message (or a hidden [App event]), stream the reply and rerun; a
+    message that got no reply is kept in failed_message."""
+    st.session_state.failed_message = None
+    st.session_state.messages.append({
+        "role": "user",
+        "content": content
+    })
+    messages_for_api = [
+        {"role": m["role"], "content": m["content"]}
+        for m in conversation_history_loader()()
+    ]
+    qa_scores_json = st.session_state.get(
+        "qa_scores_json", DEFAULT_QA_SCORES_JSON)
 
+    if not content.startswith(APP_EVENT_PREFIX):
+        st.markdown(
+            render_message_html("user", content),
+            unsafe_allow_html=True,
+        )
+    trace = Trace()
+    response, log_entry = stream_turn(
+        qa_scores_json,
+        messages_for_api,
+        st.session_state.resolved_model or DEFAULT_MODEL,
+        "turn",
+        trace,
+    )
+    with trace.span("session_state_update"):
+        record_intent(st.session_state.messages[-1], log_entry)
+        if response:
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": response,
+            })
+        else:
+            # Keep user and assistant turns alternating; the message is neither sent
+            # as history nor saved until it gets a reply.
+            st.session_state.messages.pop()
+            st.session_state.failed_message = content
+        st.session_state.turn_error = log_entry["error"]
+        persist_session()
+    speculator = st.session_state.get("speculator")
+    if speculator is not None:
+        log_entry["speculation_metrics"] = speculator.metrics()
+    finish_turn(trace, log_entry, messages_for_api)
+    start_speculation(
+        qa_scores_json,
+        messages_for_api + ([{"role": "assistant", "content": response}] if response else []),
+        st.session_state.resolved_model or DEFAULT_MODEL,
+        log_entry,
+    )
+    st.rerun()
+
+
+def describe_turn_error(error: dict) -> str:
+    """Short user-facing text for a structured request error from log_entry."""
+    if error.get("partial"):
+        return "The answer was cut off because the connection to the model dropped. Please send your message again."
+    if error["type"] in ("rate_limited", "local_rate_limit"):
+        return "The assistant is very busy right now. Please wait a moment and send your message again."
+    if error["type"] in ("timeout", "connection_error", "server_error"):
+        return "The assistant could not be reached. Please try again in a moment."
+    return f"The request failed ({error.get('status') or error['type']}): {error['message']}"
+
+
+def trace_waterfall_html(trace: dict) -> str:
+    """The turn's spans as horizontal bars on a shared time axis, children under parents."""
+    spans = [span for span in trace["spans"] if span["duration_ms"] is not None]
+    if not spans:
+        return ""
+    total = max(span["start_ms"] + span["duration_ms"] for span in spans) or 1.0
+    depth = {}
+    for span in spans:  # parents are always recorded before their children
+        depth[span["span_id"]] = depth.get(span["parent_id"], -1) + 1
+    rows = []
+    for span in sorted(spans, key=lambda span: (span["start_ms"], -span["duration_ms"])):
+        left = span["start_ms"] / total * 100
+        width = max(span["duration_ms"] / total * 100, 0.4)
+        attributes = span["attributes"]
+        detail = ", ".join(
+            f"{key}={value}" for key, value in attributes.items() if value is not None)
+        color = "#c0504d" if attributes.get("error") else "#4a90a4"
+        rows.append(
+            f'<div style="display:flex;align-items:center;font-size:0.8rem;line-height:1.4" '
+            f'title="{html.escape(detail)}">'
+            f'<div style="width:38%;padding-left:{depth[span["span_id"]] * 0.8}rem;'
+            f'white-space:nowrap;overflow:hidden">{html.escape(span["name"])}</div>'
+            f'<div style="width:47%;position:relative;height:0.7rem;background:#eef2f5">'
+            f'<div style="position:absolute;left:{left:.2f}%;width:{width:.2f}%;height:100%;'
+            f'background:{color}"></div></div>'
+            f'<div style="width:15%;text-align:right">{span["duration_ms"]:.0f} ms</div></div>'
+        )
+    return "".join(rows)
 
-def get_download_conversation_json() -> str:
+
+def prompt_cache_summary(store: PipelineLogStore) -> dict:
+    """Conversation-wide prompt-cache hit rate plus one row per recent turn (with TTFT for comparison)."""
+    rows = []
+    for log in store.tail():
+        usage = log.get("usage")
+        if not usage:
+            continue
+        rows.append({
+            "turn": log["turn"],
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "local_estimate": (log.get("prompt_tokens") or {}).get("total"),
+            "cached_tokens": usage.get("cached_tokens", 0),
+            "ttft_s": (log.get("timings") or {}).get("time_to_first_token_s"),
+        })
+    totals = store.usage_totals
+    return {
+        **totals,
+        "hit_rate": (
+            totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+        ),
+        "rows": rows,
+    }
+
+
+# Download formats: (file extension, MIME type). "JSON" is the original message array;
+# CONVERSATION_STATE_FORMAT wraps it as {"messages": [...], "conversation_state": {...}}
+# and NDJSON conversation exports end with a {"conversation_state": {...}} record.
+CONVERSATION_STATE_FORMAT = "JSON with conversation state"
+EXPORT_FORMATS = {
+    "JSON": (".json", "application/json"),
+    CONVERSATION_STATE_FORMAT: (".json", "application/json"),
+    "NDJSON": (".ndjson", "application/x-ndjson"),
+    "NDJSON (gzip)": (".ndjson.gz", "application/gzip"),
+    "Compact deltas (gzip)": (".jsonl.gz", "application/gzip"),
+}
+
+
+def conversation_export_messages(messages: list) -> list:
     download_msgs = []
-    for m in st.session_state.messages:
+    for m in messages:
         msg = {"role": m["role"], "content": m["content"]}
         for field in ("intent", "confidence"):
             if field in m:
                 msg[field] = m[field]
         download_msgs.append(msg)
-    return json.dumps(download_msgs, ensure_ascii=False, indent=2)
-
-
-def get_download_pipeline_logs_json() -> str:
-    return json.dumps(st.session_state.pipeline_logs, ensure_ascii=False, indent=2)
+    return download_msgs
+
+
+def get_download_conversation_json(messages: list = None, state: dict = None) -> str:
+    """The original array of messages; with `state` (ConversationState.to_dict), the
+    CONVERSATION_STATE_FORMAT object."""
+    if messages is None:
+        messages = st.session_state.messages
+    exported = conversation_export_messages(messages)
+    if state is not None:
+        exported = {"messages": exported, "conversation_state": state}
+    return json.dumps(exported, ensure_ascii=False, indent=2)
+
+
+def get_download_pipeline_logs_json(store: PipelineLogStore = None) -> str:
+    if store is None:
+        store = st.session_state.pipeline_log_store
+    entries = list(store.iter_full_entries())
+    return json.dumps(entries, ensure_ascii=False, indent=2)
+
+
+def write_ndjson(records, fileobj) -> None:
+    for record in records:
+        fileobj.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        fileobj.write(b"\n")
+
+
+def export_records(records, fmt: str) -> io.BytesIO:
+    """NDJSON export of `records` (any iterable), optionally gzip-compressed as it is written."""
+    buffer = io.BytesIO()
+    if fmt == "NDJSON (gzip)" or fmt == "Compact deltas (gzip)":
+        with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz:
+            write_ndjson(records, gz)
+    else:
+        write_ndjson(records, buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def make_conversation_export(messages, fmt: str, state: dict = None):
+    """Zero-argument callable for st.download_button, so the export is only built on click."""
+    messages = messages if callable(messages) else list(messages)
+
+    def build():
+        nonlocal messages
+        if callable(messages):
+            messages = messages()
+        if fmt == "JSON":
+            return get_download_conversation_json(messages)
+        if fmt == CONVERSATION_STATE_FORMAT:
+            return get_download_conversation_json(messages, state)
+        records = conversation_export_messages(messages)
+        if state is not None:
+            records.append({"conversation_state": state})
+        return export_records(records, fmt)
+
+    return build
+
+
+def make_pipeline_logs_export(store: PipelineLogStore, fmt: str):
+    """Zero-argument callable for st.download_button, so the export is only built on click."""
+
+    def build():
+        if fmt == "JSON":
+            return get_download_pipeline_logs_json(store)
+        if fmt == "Compact deltas (gzip)":
+            return export_records(store.iter_records(), fmt)
+        return export_records(store.iter_full_entries(), fmt)
+
+    return build
+
+
+def parse_conversation_json(json_str: str) -> list:
+    """Messages from a conversation export (the array, or the CONVERSATION_STATE_FORMAT
+    object). Raises ValueError (or JSONDecodeError) if unusable."""
+    loaded = json.loads(json_str)
+    if isinstance(loaded, dict) and "messages" in loaded:
+        loaded = loaded["messages"]
+    if not isinstance(loaded, list) or len(loaded) == 0:
+        raise ValueError("Invalid format: expected a non-empty JSON array.")
+
+    msgs = []
+    for m in loaded:
+        if m.get("role") in ("user", "assistant"):
+            msg = {"role": m["role"], "content": m["content"]}
+            for field in ("intent", "confidence"):
+                if field in m:
+                    msg[field] = m[field]
+            msgs.append(msg)
+
+    if not msgs:
+        raise ValueError("No user/assistant messages found.")
+    return msgs
 
 
 def load_conversation_from_json(json_str: str) -> bool:
     try:
-        loaded = json.loads(json_str)
-        if not isinstance(loaded, list) or len(loaded) == 0:
-            st.error("Invalid format: expected a non-empty JSON array.")
-            return False
-
-        msgs = []
-        for m in loaded:
-            if m.get("role") in ("user", "assistant"):
-                msg = {"role": m["role"], "content": m["content"]}
-                for field in ("intent", "confidence"):
-                    if field in m:
-                        msg[field] = m[field]
-                msgs.append(msg)
-
-        if not msgs:
-            st.error("No user/assistant messages found.")
-            return False
-
+        msgs = parse_conversation_json(json_str)
         st.session_state.messages = msgs
+        st.session_state.messages_offset = 0
         st.session_state.conversation_started = True
         if not st.session_state.resolved_model:
             st.session_state.resolved_model = DEFAULT_MODEL
+        persist_session(replace=True)
         return True
     except json.JSONDecodeError as e:
         st.error(f"Invalid JSON: {e}")
         return False
+    except ValueError as e:
+        st.error(str(e))
+        return False
     except Exception as e:
         st.error(f"Error loading conversation: {e}")
         return False
 
 
+@st.fragment(run_every=METRICS_PAGE_REFRESH_S)
+def render_metrics_page():
+    """?view=metrics: live metrics of the whole server process (all sessions)."""
+    metrics = get_metrics_registry()
+    snapshot = metrics.snapshot()
+    gauges = snapshot["gauges"]
+    st.markdown('<div class="main-header">📈 Live metrics</div>', unsafe_allow_html=True)
+    cols = st.columns(4)
+    cols[0].metric("Active sessions", gauges["active_sessions"])
+    cols[1].metric("Requests in flight", f"{gauges['in_flight']} / {gauges['max_in_flight']}")
+    cols[2].metric("Queued requests", gauges["queued"])
+    cols[3].metric("Uptime", f"{snapshot['uptime_s'] // 3600}h {snapshot['uptime_s'] % 3600 // 60}m")
+    st.markdown("#### Azure requests per deployment")
+    if snapshot["deployments"]:
+        st.dataframe(snapshot["deployments"], hide_index=True)
+    else:
+        st.caption("No requests yet.")
+    st.markdown("#### Turns")
+    if snapshot["turns"]:
+        st.dataframe(snapshot["turns"], hide_index=True)
+    else:
+        st.caption("No turns yet.")
+    if metrics.http_endpoint:
+        st.caption(f"Prometheus: `{metrics.http_endpoint}`")
+    elif metrics.http_error:
+        st.caption(f"Prometheus endpoint unavailable: {metrics.http_error}")
+    st.caption(
+        f"Active sessions: used within the last {METRICS_ACTIVE_SESSION_S // 60} minutes. "
+        f"Quantiles over the last {METRICS_LATENCY_WINDOW} samples; refreshed every "
+        f"{METRICS_PAGE_REFRESH_S:g} s."
+    )
+
+
+@st.fragment
+def render_side_panel():
+    """Configuration, pipeline monitor, downloads and loading. Runs as a fragment, so
+    interacting with these widgets reruns only this panel, not the chat transcript."""
+    touch_session_activity()
+    st.markdown("### ⚙️ QA Scores Configuration")
+    disabled = st.session_state.conversation_started
+    render_portrait_picker()
+    with st.expander("🛠️ Debug: QA Scores JSON"):
+        st.toggle(
+            "Start with pasted JSON instead of the selected portrait",
+            key="qa_debug_input", disabled=disabled,
+        )
+        if st.session_state.qa_debug_input:
+            st.text_area(
+                "QA Scores JSON",
+                value=serialize_qa_scores(st.session_state.qa_scores_json),
+                height=300, disabled=disabled, key="cfg_qa"
+            )
+    session_id = st.session_state.session_id
+    inbox = get_evaluation_inbox()
+    delivery = [f"`{os.path.join(inbox.drop_dir, session_id)}.json`"]
+    if inbox.http_endpoint:
+        delivery.insert(0, f"POST `{inbox.http_endpoint}{session_id}`")
+    st.caption(
+        f"Session ID: `{session_id}` — a finished evaluation can be delivered with "
+        + " or ".join(delivery) + "."
+    )
+
+    st.markdown("---")
+
+    # ---- PIPELINE MONITOR ----
+    st.markdown("### 📊 Pipeline")
+    if METRICS_PAGE_TOKEN:
+        st.caption("This session only; metrics of the whole server are at `?view=metrics&token=…`.")
+    else:
+        st.caption("This session only.")
+    log_store = st.session_state.pipeline_log_store
+    if len(log_store):
+        latest_log = log_store.latest()
+        cache_stats = prompt_cache_summary(log_store)
+        if cache_stats["turns"]:
+            st.caption(
+                f"Prompt cache: {cache_stats['cached_tokens']:,} of "
+                f"{cache_stats['prompt_tokens']:,} prompt tokens cached "
+                f"({cache_stats['hit_rate']:.0%}) over {cache_stats['turns']} turn(s)"
+            )
+            with st.expander("Prompt cache per turn"):
+                st.dataframe(cache_stats["rows"], hide_index=True)
+        with st.expander("Latest request details"):
+            st.markdown(
+                f"**Model (deployment):** {latest_log.get('model', '—')}")
+            st.markdown(
+                f"**Timestamp:** {latest_log.get('timestamp', '—')}")
+            intent = latest_log.get("intent")
+            if intent:
+                st.markdown(
+                    f"**Intent:** Type {intent['type']} ({INTENT_TYPES[intent['type']]}), "
+                    f"confidence {intent['confidence']:.2f}"
+                    + (" · **answered locally, no model request**" if intent["fast_path"] else ""))
+            routing = latest_log.get("routing")
+            if routing:
+                outcome = routing.get("outcome") or {}
+                st.markdown(
+                    f"**Routing:** {routing['tier']} tier → `{routing['deployment']}` "
+                    f"({'; '.join(routing['reasons'])})"
+                    + (f" · answered by `{outcome['deployment_used']}`" if outcome.get("fell_back") else "")
+                    + (f" · TTFT {outcome['ttft_s']} s "
+                       f"{'within' if outcome['within_slo'] else 'over'} the {routing['slo_ttft_s']} s SLO"
+                       if outcome.get("ttft_s") is not None else ""))
+            if latest_log.get("cached"):
+                st.markdown(
+                    f"**Served from response cache** ({latest_log['cached']} tier)")
+            speculation = latest_log.get("speculation")
+            if speculation:
+                st.markdown(
+                    f"**Served from speculation** (pre-generated for “{speculation['candidate']}”, "
+                    f"similarity {speculation['similarity']:.2f})")
+            spec_metrics = latest_log.get("speculation_metrics")
+            if spec_metrics:
+                hit_rate = spec_metrics["hit_rate"]
+                st.markdown(
+                    f"**Speculation:** {spec_metrics['hits']} hit(s) / "
+                    f"{spec_metrics['hits'] + spec_metrics['misses']} turn(s)"
+                    + (f" ({hit_rate:.0%})" if hit_rate is not None else "")
+                    + f" · {spec_metrics['launched']} pre-generated · "
+                    f"tokens {spec_metrics['tokens_spent']:,} spent, "
+                    f"{spec_metrics['tokens_wasted']:,} wasted of {spec_metrics['token_budget']:,}")
+            timings = latest_log.get("timings") or {}
+            if "speculation_served_s" in timings:
+                st.markdown(
+                    f"**Served from a pre-generated answer** in {timings['speculation_served_s']} s")
+            elif timings:
+                st.markdown(
+                    f"**Queued:** {timings.get('queue_wait_s', 0)} s · "
+                    f"**Time to first token:** {timings.get('time_to_first_token_s', '—')} s · "
+                    f"**Stream total:** {timings.get('stream_total_s', '—')} s"
+                    + (f" · **{timings['tokens_per_s']} tokens/s** in {timings['chunks']} chunks"
+                       if timings.get("tokens_per_s") else ""))
+            trace = latest_log.get("trace")
+            if trace:
+                st.markdown("**Waterfall** (hover a bar for its attributes)")
+                st.markdown(trace_waterfall_html(trace), unsafe_allow_html=True)
+            prompt_tokens = latest_log.get("prompt_tokens")
+            if prompt_tokens:
+                st.markdown(
+                    f"**Prompt size ({prompt_tokens['counter']}):** "
+                    f"instructions {prompt_tokens['instructions']:,} · "
+                    f"evaluation {prompt_tokens['evaluation']:,} · "
+                    f"history {prompt_tokens['history']:,} · "
+                    f"messages {prompt_tokens['messages']:,} · "
+                    f"**total {prompt_tokens['total']:,}**")
+            tracked = latest_log.get("conversation_state")
+            if tracked:
+                st.markdown(
+                    f"**Tracked state:** language {tracked['language']} · "
+                    f"follow-ups used {tracked['follow_ups_used']} · "
+                    f"off-topic variants {', '.join(map(str, tracked['off_topic_variants_used'])) or '—'} · "
+                    f"categories discussed {len(tracked['categories_discussed'])}")
+            guard = latest_log.get("context_guard")
+            if guard:
+                st.warning(
+                    f"Context guard (limit {guard['limit']:,} tokens): "
+                    f"{', '.join(guard['actions']) or 'no compaction possible'}"
+                    + ("" if guard["fits"] else " — prompt still over the limit"))
+            usage = latest_log.get("usage") or {}
+            if usage:
+                st.markdown(
+                    f"**Prompt tokens:** {usage.get('prompt_tokens', 0):,} · "
+                    f"**Cached:** {usage.get('cached_tokens', 0):,} · "
+                    f"**Completion tokens:** {usage.get('completion_tokens', 0):,}")
+            st.markdown(
+                f"**User message:** {latest_log.get('user_message', '—')}")
+            st.markdown("---")
+            for i, step in enumerate(latest_log.get("steps", [])):
+                step_label = step.get(
+                    "step", "unknown").replace("_", " ").title()
+                with st.expander(f"Step {i + 1}: {step_label}"):
+                    st.json(step)
+                    if st.toggle(
+                        "Show exact prompt",
+                        key=f"show_prompt_{log_store.conversation_id}_{latest_log['turn']}_{i}",
+                    ):
+                        full_entry = log_store.reconstruct(latest_log["turn"])
+                        full_step = full_entry["steps"][i]
+                        st.json({
+                            "system_prompt": full_step.get("system_prompt"),
+                            "conversation_messages": full_step.get("conversation_messages"),
+                        })
+    else:
+        st.caption("No messages processed yet")
+    queues = get_scheduler().snapshot()
+    if queues:
+        st.caption("Azure requests (server-wide): " + " · ".join(
+            f"{name}: {q['active']} running, {q['queued']} queued"
+            for name, q in queues.items()
+        ))
+    if RESPONSE_CACHE_ENABLED:
+        response_cache_stats = get_response_cache().stats()
+        st.caption(
+            f"Response cache: {response_cache_stats['memory_hits']} memory hits · "
+            f"{response_cache_stats['disk_hits']} disk hits · "
+            f"{response_cache_stats['misses']} misses "
+            f"({response_cache_stats['hit_rate']:.0%} hit rate, server-wide)"
+        )
+
+    # ---- DOWNLOAD PIPELINE LOGS ----
+    export_stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if len(log_store):
+        logs_fmt = st.selectbox(
+            "Pipeline logs format", [f for f in EXPORT_FORMATS if f != CONVERSATION_STATE_FORMAT],
+            key="logs_export_format")
+        logs_ext, logs_mime = EXPORT_FORMATS[logs_fmt]
+        st.download_button(
+            label="📥 Download Pipeline Logs",
+            data=make_pipeline_logs_export(log_store, logs_fmt),
+            file_name=f"pipeline_logs_{export_stamp}{logs_ext}",
+            mime=logs_mime,
+            on_click="ignore",
+            use_container_width=True
+        )
+
+    st.markdown("---")
+
+    # ---- DOWNLOAD CONVERSATION ----
+    if st.session_state.messages:
+        st.markdown("### 📥 Download Conversation")
+        conversation_formats = [f for f in EXPORT_FORMATS if f != "Compact deltas (gzip)"]
+        conversation_fmt = st.selectbox(
+            "Conversation format", conversation_formats, key="conversation_export_format")
+        conversation_ext, conversation_mime = EXPORT_FORMATS[conversation_fmt]
+        st.download_button(
+            label=f"📥 Download {conversation_fmt}",
+            data=make_conversation_export(
+                conversation_history_loader(), conversation_fmt,
+                sync_conversation_state().to_dict(),
+            ),
+            file_name=f"conversation_{export_stamp}{conversation_ext}",
+            mime=conversation_mime,
+            on_click="ignore",
+            use_container_width=True
+        )
+        st.markdown("---")
+
+    # ---- LOAD EXISTING CONVERSATION ----
+    st.markdown("### 📤 Load Existing Conversation")
+    uploaded_file = st.file_uploader("Upload JSON file", type=[
+                                     "json"], key="file_upload")
+    if uploaded_file is not None:
+        if st.button("📂 Load from file", use_container_width=True):
+            content = uploaded_file.read().decode('utf-8')
+            if load_conversation_from_json(content):
+                st.success("Conversation loaded!")
+                st.rerun()
+
+    paste_json = st.text_area(
+        "Or paste conversation JSON here", height=150, key="paste_json")
+    if st.button("📋 Load from pasted JSON", use_container_width=True):
+        if paste_json.strip():
+            if load_conversation_from_json(paste_json):
+                st.success("Conversation loaded!")
+                st.rerun()
+        else:
+            st.warning("Please paste JSON first.")
+
+    st.markdown("---")
+
+    # ---- RESET ----
+    if st.session_state.conversation_started:
+        if st.button("🔄 Reset Conversation", use_container_width=True):
+            st.session_state.messages = []
+            st.session_state.conversation_started = False
+            portrait_id = st.session_state.active_portrait_id
+            qa_scores_json = get_evaluation_store().get(portrait_id) if portrait_id else None
+            select_evaluation(
+                qa_scores_json or DEFAULT_QA_SCORES_JSON, portrait_id if qa_scores_json else None)
+            st.session_state.pipeline_log_store = new_pipeline_log_store()
+            st.session_state.turn_error = None
+            st.session_state.failed_message = None
+            st.session_state.pending_app_event = None
+            st.session_state.conversation_state = ConversationState(
+                evaluation_categories(st.session_state.qa_scores_json))
+            st.session_state.chat_window = CHAT_WINDOW_SIZE
+            st.session_state.azure_deployment = DEFAULT_MODEL
+            st.session_state.resolved_model = None
+            st.session_state.messages_offset = 0
+            if "speculator" in st.session_state:
+                st.session_state.speculator.discard()
+            persist_session(replace=True)
+            st.rerun()
+
+
 def main():
     st.set_page_config(
         page_title="Portrait QA Assistant - Curaay",
@@ -654,101 +3612,39 @@ def main():
         )
         st.stop()
 
+    serve_metrics()
+    if st.query_params.get("view") == "metrics":
+        if not METRICS_PAGE_TOKEN or not hmac.compare_digest(
+                st.query_params.get("token", "").encode(), METRICS_PAGE_TOKEN.encode()):
+            st.error("Live metrics need `&token=` with the server's METRICS_PAGE_TOKEN.")
+            st.stop()
+        render_metrics_page()
+        st.stop()
+
+    if "session_id" in st.session_state and get_session_activity().take_eviction(
+            st.session_state.session_id):
+        evict_session()
+    if st.session_state.get("evicted"):
+        st.info(
+            f"This conversation was paused after {SESSION_IDLE_EVICT_S // 60} minutes "
+            "without activity. It is saved and continues where it stopped.")
+        st.button("▶️ Continue conversation", on_click=resume_evicted_session)
+        st.stop()
+
     init_session_state()
+    touch_session_activity()
+    get_metrics_registry()
+    delivered = get_evaluation_inbox().take(st.session_state.session_id)
+    if delivered is not None:
+        apply_delivered_evaluation(delivered)
+    if not session_push_supported():
+        watch_evaluation_inbox()
 
     col_chat, col_side = st.columns([2, 1])
 
     # ---- RIGHT COLUMN ----
     with col_side:
-        st.markdown("### ⚙️ QA Scores Configuration")
-        disabled = st.session_state.conversation_started
-        qa_scores_json_str = st.text_area(
-            "QA Scores JSON",
-            value=json.dumps(
-                st.session_state.qa_scores_json, ensure_ascii=False, indent=2
-            ),
-            height=300, disabled=disabled, key="cfg_qa"
-        )
-
-        st.markdown("---")
-
-        # ---- PIPELINE MONITOR ----
-        st.markdown("### 📊 Pipeline")
-        if st.session_state.pipeline_logs:
-            latest_log = st.session_state.pipeline_logs[-1]
-            with st.expander("Latest request details"):
-                st.markdown(
-                    f"**Model (deployment):** {latest_log.get('model', '—')}")
-                st.markdown(
-                    f"**Timestamp:** {latest_log.get('timestamp', '—')}")
-                st.markdown(
-                    f"**User message:** {latest_log.get('user_message', '—')}")
-                st.markdown("---")
-                for i, step in enumerate(latest_log.get("steps", [])):
-                    step_label = step.get(
-                        "step", "unknown").replace("_", " ").title()
-                    with st.expander(f"Step {i + 1}: {step_label}"):
-                        st.json(step)
-        else:
-            st.caption("No messages processed yet")
-
-        # ---- DOWNLOAD PIPELINE LOGS ----
-        if st.session_state.pipeline_logs:
-            st.download_button(
-                label="📥 Download Pipeline Logs",
-                data=get_download_pipeline_logs_json(),
-                file_name=f"pipeline_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                mime="application/json",
-                use_container_width=True
-            )
-
-        st.markdown("---")
-
-        # ---- DOWNLOAD CONVERSATION ----
-        if st.session_state.messages:
-            st.markdown("### 📥 Download Conversation")
-            st.download_button(
-                label="📥 Download JSON",
-                data=get_download_conversation_json(),
-                file_name=f"conversation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                mime="application/json",
-                use_container_width=True
-            )
-            st.markdown("---")
-
-        # ---- LOAD EXISTING CONVERSATION ----
-        st.markdown("### 📤 Load Existing Conversation")
-        uploaded_file = st.file_uploader("Upload JSON file", type=[
-                                         "json"], key="file_upload")
-        if uploaded_file is not None:
-            if st.button("📂 Load from file", use_container_width=True):
-                content = uploaded_file.read().decode('utf-8')
-                if load_conversation_from_json(content):
-                    st.success("Conversation loaded!")
-                    st.rerun()
-
-        paste_json = st.text_area(
-            "Or paste conversation JSON here", height=150, key="paste_json")
-        if st.button("📋 Load from pasted JSON", use_container_width=True):
-            if paste_json.strip():
-                if load_conversation_from_json(paste_json):
-                    st.success("Conversation loaded!")
-                    st.rerun()
-            else:
-                st.warning("Please paste JSON first.")
-
-        st.markdown("---")
-
-        # ---- RESET ----
-        if st.session_state.conversation_started:
-            if st.button("🔄 Reset Conversation", use_container_width=True):
-                st.session_state.messages = []
-                st.session_state.conversation_started = False
-                st.session_state.qa_scores_json = DEFAULT_QA_SCORES_JSON
-                st.session_state.pipeline_logs = []
-                st.session_state.azure_deployment = DEFAULT_MODEL
-                st.session_state.resolved_model = None
-                st.rerun()
+        render_side_panel()
 
     # ---- LEFT COLUMN: CHAT ----
     with col_chat:
@@ -761,7 +3657,8 @@ def main():
             unsafe_allow_html=True
         )
 
-        deployment_fetch = fetch_azure_deployment_names(AZURE_API_KEY, AZURE_ENDPOINT)
+        deployment_catalog = get_deployment_catalog()
+        deployment_fetch = deployment_catalog.get(AZURE_API_KEY, AZURE_ENDPOINT)
         model_options = merge_model_options(deployment_fetch)
         if st.session_state.azure_deployment not in model_options:
             model_options = [st.session_state.azure_deployment] + model_options
@@ -782,12 +3679,26 @@ def main():
             f"({AZURE_ENDPOINT}). Список з **List deployments** API; інакше — типові назви. "
             "Власне ім’я deployment у порталі Azure може відрізнятися (наприклад, `my-gpt-4o`)."
         )
+        catalog_status = deployment_catalog.status(AZURE_ENDPOINT)
         if deployment_fetch:
-            st.caption(f"Знайдено deployments у ресурсі: **{len(deployment_fetch)}**.")
+            fetched_at = datetime.fromtimestamp(catalog_status["fetched_at"])
+            refreshing = " Оновлюється у фоні…" if catalog_status["refreshing"] else ""
+            st.caption(
+                f"Знайдено deployments у ресурсі: **{len(deployment_fetch)}** "
+                f"(оновлено {fetched_at.strftime('%H:%M:%S')}).{refreshing}"
+            )
+        elif catalog_status["refreshing"]:
+            st.caption("Список deployments завантажується у фоні — поки показано **fallback**-назви.")
         else:
             st.caption(
                 "Список з API не отримано (перевірте ключ і `api-version`) — показано **fallback**-назви."
             )
+        st.button(
+            "🔄 Refresh deployments",
+            on_click=deployment_catalog.refresh_in_background,
+            args=(AZURE_API_KEY, AZURE_ENDPOINT),
+            disabled=st.session_state.conversation_started,
+        )
         c1, c2 = st.columns([2, 1])
         with c1:
             st.selectbox(
@@ -828,12 +3739,16 @@ def main():
             )
 
             if st.button("🎬 Start Conversation", use_container_width=True):
-                try:
-                    qa_scores_json = json.loads(qa_scores_json_str)
-                    st.session_state.qa_scores_json = qa_scores_json
-                except json.JSONDecodeError as e:
-                    st.error(f"Invalid JSON in QA Scores: {e}")
-                    st.stop()
+                qa_scores_json = st.session_state.qa_scores_json
+                if st.session_state.get("qa_debug_input") and "cfg_qa" in st.session_state:
+                    try:
+                        qa_scores_json = json.loads(st.session_state.cfg_qa)
+                    except json.JSONDecodeError as e:
+                        st.error(f"Invalid JSON in QA Scores: {e}")
+                        st.stop()
+                    if qa_scores_json != st.session_state.qa_scores_json:
+                        st.session_state.qa_scores_json = qa_scores_json
+                        st.session_state.active_portrait_id = None
 
                 if first_message.strip():
                     st.session_state.messages.append({
@@ -844,81 +3759,76 @@ def main():
                         {"role": m["role"], "content": m["content"]}
                         for m in st.session_state.messages
                     ]
-                    with st.spinner("Thinking..."):
-                        response, log_entry = process_user_message(
-                            qa_scores_json, messages_for_api, api_model
-                        )
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": response,
-                    })
-                    st.session_state.pipeline_logs.append(log_entry)
+                    st.markdown(
+                        render_message_html("user", first_message.strip()),
+                        unsafe_allow_html=True,
+                    )
+                    trace = Trace()
+                    response, log_entry = stream_turn(
+                        qa_scores_json, messages_for_api, api_model, "greeting", trace
+                    )
+                    record_intent(st.session_state.messages[-1], log_entry)
                 else:
-                    with st.spinner("Starting conversation..."):
-                        response, log_entry = process_user_message(
-                            qa_scores_json, [], api_model
-                        )
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": response,
-                    })
+                    messages_for_api = []
+                    trace = Trace()
+                    response, log_entry = stream_turn(
+                        qa_scores_json, [], api_model, "greeting", trace
+                    )
                     log_entry = {
                         **log_entry,
                         "user_message": None,
                         "note": "Initial greeting — no user message yet",
                     }
-                    st.session_state.pipeline_logs.append(log_entry)
 
-                st.session_state.resolved_model = api_model
-                st.session_state.conversation_started = True
+                st.session_state.turn_error = log_entry["error"]
+                if not response:
+                    # Nothing to show: stay on the start screen so it can be retried.
+                    finish_turn(trace, log_entry, messages_for_api)
+                    st.session_state.messages = []
+                    st.rerun()
+                with trace.span("session_state_update"):
+                    st.session_state.messages.append({
+                        "role": "assistant",
+                        "content": response,
+                    })
+                    st.session_state.resolved_model = api_model
+                    st.session_state.conversation_started = True
+                    persist_session()
+                finish_turn(trace, log_entry, messages_for_api)
+                start_speculation(
+                    qa_scores_json,
+                    [{"role": m["role"], "content": m["content"]}
+                     for m in st.session_state.messages],
+                    api_model, log_entry,
+                )
                 st.rerun()
 
         # ---- DISPLAY CHAT ----
         if st.session_state.messages:
             chat_container = st.container()
             with chat_container:
-                for msg in st.session_state.messages:
-                    if msg["role"] == "user":
-                        st.markdown(f'''
-                        <div class="chat-message user-message">
-                            <strong>👤 User:</strong><br>{msg["content"]}
-                        </div>
-                        ''', unsafe_allow_html=True)
-                    elif msg["role"] == "assistant":
-                        st.markdown(f'''
-                        <div class="chat-message assistant-message">
-                            <strong>🤖 Assistant:</strong><br>{msg["content"]}
-                        </div>
-                        ''', unsafe_allow_html=True)
+                render_chat_transcript()
+
+        if st.session_state.turn_error:
+            st.error(describe_turn_error(st.session_state.turn_error))
+            failed = st.session_state.failed_message
+            if failed and not failed.startswith(APP_EVENT_PREFIX):
+                st.caption(f"Not answered: “{failed}”")
+            if failed and st.button("🔁 Send again"):
+                st.session_state.turn_error = None
+                run_chat_turn(failed)
+
+        # ---- DELIVERED EVALUATION ----
+        if st.session_state.conversation_started and st.session_state.pending_app_event:
+            app_event = st.session_state.pending_app_event
+            st.session_state.pending_app_event = None
+            run_chat_turn(app_event)
 
         # ---- USER INPUT ----
         if st.session_state.conversation_started:
             user_input = st.chat_input("Type your message...")
             if user_input:
-                st.session_state.messages.append({
-                    "role": "user",
-                    "content": user_input
-                })
-                messages_for_api = [
-                    {"role": m["role"], "content": m["content"]}
-                    for m in st.session_state.messages
-                ]
-                qa_scores_json = st.session_state.get(
-                    "qa_scores_json", DEFAULT_QA_SCORES_JSON)
-
-                with st.spinner("Thinking..."):
-                    response, log_entry = process_user_message(
-                        qa_scores_json,
-                        messages_for_api,
-                        st.session_state.resolved_model or DEFAULT_MODEL,
-                    )
-
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response,
-                })
-                st.session_state.pipeline_logs.append(log_entry)
-                st.rerun()
+                run_chat_turn(user_input)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+"""Replay conversation files through the response pipeline without the Streamlit UI.
+
+Reads every *.json file in a directory (the format the "Download JSON" button
+writes and "Load Existing Conversation" accepts), sends each user turn through
+process_user_message and writes the new replies and per-turn timings to disk.
+
+    python batch_runner.py conversations/ --qa-scores qa.json --concurrency 8
+    python batch_runner.py conversations/ --history generated --mode asyncio
+
+History modes:
+    recorded   each user turn is answered against the conversation as it was
+               recorded, so turns are independent and run in parallel.
+    generated  the new replies replace the recorded ones as the conversation is
+               replayed, so turns of one conversation run in order.
+
+Modes:
+    threads    one worker thread per concurrent turn (the sync pipeline API).
+    asyncio    turns are coroutines on app's shared event loop, next to the async
+               client; --concurrency caps them on top of ASYNC_MAX_IN_FLIGHT.
+
+Output (in --output):
+    <name>.result.json  one file per conversation, every turn with both replies
+    logs/               compact pipeline logs (PipelineLogStore) per conversation
+    timings.csv         one row per turn
+    summary.json        counts and latency percentiles for the run
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit.logger
+
+streamlit.logger.set_log_level("error")  # no ScriptRunContext warnings outside `streamlit run`
+
+import app  # noqa: E402
+
+
+def load_conversations(directory: str) -> list:
+    conversations = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        try:
+            messages = app.parse_conversation_json(text)
+        except ValueError as e:
+            print(f"skip {path}: {e}", file=sys.stderr)
+            continue
+        conversations.append({
+            "name": os.path.splitext(os.path.basename(path))[0],
+            "source": path,
+            "messages": messages,
+        })
+    return conversations
+
+
+def run_turn(qa_scores_json: dict, history: list, model: str) -> dict:
+    """One process_user_message call; returns the reply, its log entry and wall time."""
+    started = time.perf_counter()
+    response, log_entry = app.process_user_message(qa_scores_json, history, model)
+    return {
+        "response": response,
+        "log_entry": log_entry,
+        "wall_s": round(time.perf_counter() - started, 3),
+    }
+
+
+async def run_turn_async(qa_scores_json: dict, history: list, model: str) -> dict:
+    started = time.perf_counter()
+    response, log_entry = await app.process_user_message_async(qa_scores_json, history, model)
+    return {
+        "response": response,
+        "log_entry": log_entry,
+        "wall_s": round(time.perf_counter() - started, 3),
+    }
+
+
+def turn_result(index: int, messages: list, history: list, outcome: dict) -> dict:
+    recorded = messages[index + 1]["content"] if (
+        index + 1 < len(messages) and messages[index + 1]["role"] == "assistant"
+    ) else None
+    log_entry = outcome["log_entry"]
+    return {
+        "index": index,
+        "user_message": messages[index]["content"],
+        "recorded_response": recorded,
+        "response": outcome["response"],
+        "history_length": len(history) - 1,
+        "deployment_used": log_entry.get("deployment_used"),
+        "timings": {**log_entry.get("timings", {}), "wall_s": outcome["wall_s"]},
+        "usage": log_entry.get("usage"),
+        "intent": log_entry.get("intent"),
+        "routing": log_entry.get("routing"),
+        "conversation_state": log_entry.get("conversation_state"),
+        "error": log_entry.get("error"),
+    }
+
+
+def recorded_jobs(conversation: dict) -> list:
+    """(conversation, message index, history) for every user turn, using the recorded replies."""
+    messages = conversation["messages"]
+    return [
+        (conversation, i, [{"role": m["role"], "content": m["content"]} for m in messages[:i + 1]])
+        for i, m in enumerate(messages) if m["role"] == "user"
+    ]
+
+
+async def replay_generated_async(qa_scores_json: dict, conversation: dict, model: str) -> list:
+    """Replay one conversation in order, feeding the new replies back as history."""
+    messages = conversation["messages"]
+    transcript = []
+    results = []
+    for i, m in enumerate(messages):
+        if m["role"] == "assistant":
+            if not any(t["role"] == "user" for t in transcript):
+                transcript.append({"role": "assistant", "content": m["content"]})
+            continue
+        transcript.append({"role": "user", "content": m["content"]})
+        history = list(transcript)
+        outcome = await run_turn_async(qa_scores_json, history, model)
+        results.append((i, history, outcome))
+        if outcome["response"]:
+            transcript.append({"role": "assistant", "content": outcome["response"]})
+    return results
+
+
+def replay_generated(qa_scores_json: dict, conversation: dict, model: str) -> list:
+    return app.run_async(replay_generated_async(qa_scores_json, conversation, model))
+
+
+def run_threads(qa_scores_json, conversations, model, history_mode, concurrency) -> dict:
+    results = {c["name"]: [] for c in conversations}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if history_mode == "recorded":
+            jobs = [job for c in conversations for job in recorded_jobs(c)]
+            futures = [
+                (conversation, index, history,
+                 pool.submit(run_turn, qa_scores_json, history, model))
+                for conversation, index, history in jobs
+            ]
+            for conversation, index, history, future in futures:
+                results[conversation["name"]].append((index, history, future.result()))
+        else:
+            futures = {
+                c["name"]: pool.submit(replay_generated, qa_scores_json, c, model)
+                for c in conversations
+            }
+            for name, future in futures.items():
+                results[name] = future.result()
+    return results
+
+
+async def run_asyncio(qa_scores_json, conversations, model, history_mode, concurrency) -> dict:
+    """Runs on app's shared event loop (app.run_async), next to the async client."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(func, *args):
+        async with semaphore:
+            return await func(*args)
+
+    results = {c["name"]: [] for c in conversations}
+    if history_mode == "recorded":
+        jobs = [job for c in conversations for job in recorded_jobs(c)]
+        outcomes = await asyncio.gather(*(
+            limited(run_turn_async, qa_scores_json, history, model) for _, _, history in jobs
+        ))
+        for (conversation, index, history), outcome in zip(jobs, outcomes):
+            results[conversation["name"]].append((index, history, outcome))
+    else:
+        replays = await asyncio.gather(*(
+            limited(replay_generated_async, qa_scores_json, c, model) for c in conversations
+        ))
+        for conversation, replay in zip(conversations, replays):
+            results[conversation["name"]] = replay
+    return results
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def write_outputs(output_dir, conversations, results, args, wall_s) -> dict:
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for conversation in conversations:
+        messages = conversation["messages"]
+        store = app.PipelineLogStore(
+            os.path.join(output_dir, "logs"), conversation["name"], memory_tail=1
+        )
+        turns = []
+        for index, history, outcome in sorted(results[conversation["name"]], key=lambda r: r[0]):
+            store.append(outcome["log_entry"], history)
+            turn = turn_result(index, messages, history, outcome)
+            turns.append(turn)
+            rows.append({
+                "conversation": conversation["name"],
+                "index": index,
+                "history_length": turn["history_length"],
+                "deployment_used": turn["deployment_used"],
+                "time_to_first_token_s": turn["timings"].get("time_to_first_token_s"),
+                "stream_total_s": turn["timings"].get("stream_total_s"),
+                "wall_s": turn["timings"]["wall_s"],
+                "prompt_tokens": (turn["usage"] or {}).get("prompt_tokens"),
+                "cached_tokens": (turn["usage"] or {}).get("cached_tokens"),
+                "error": (turn["error"] or {}).get("type"),
+            })
+        with open(os.path.join(output_dir, f"{conversation['name']}.result.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "source": conversation["source"],
+                "model": args.model,
+                "history": args.history,
+                "turns": turns,
+            }, f, ensure_ascii=False, indent=2)
+
+    with open(os.path.join(output_dir, "timings.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=[
+            "conversation", "index", "history_length", "deployment_used",
+            "time_to_first_token_s", "stream_total_s", "wall_s",
+            "prompt_tokens", "cached_tokens", "error",
+        ])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    ttfts = [r["time_to_first_token_s"] for r in rows if r["time_to_first_token_s"] is not None]
+    totals = [r["stream_total_s"] for r in rows if not r["error"]]
+    summary = {
+        "conversations": len(conversations),
+        "turns": len(rows),
+        "errors": sum(1 for r in rows if r["error"]),
+        "model": args.model,
+        "history": args.history,
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "wall_s": round(wall_s, 3),
+        "time_to_first_token_s": {"p50": percentile(ttfts, 0.5), "p95": percentile(ttfts, 0.95)},
+        "stream_total_s": {"p50": percentile(totals, 0.5), "p95": percentile(totals, 0.95)},
+    }
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("conversations", help="directory of conversation *.json files")
+    parser.add_argument("--qa-scores", help="QA scores JSON file (default: DEFAULT_QA_SCORES_JSON)")
+    parser.add_argument("--model", default=app.DEFAULT_MODEL, help="deployment name")
+    parser.add_argument("--endpoint", default=app.AZURE_ENDPOINT, help="Azure OpenAI endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mode", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--history", choices=("recorded", "generated"), default="recorded")
+    parser.add_argument("--output", default=os.path.join("batch_results", time.strftime("%Y%m%d_%H%M%S")))
+    args = parser.parse_args(argv)
+    app.AZURE_ENDPOINT = args.endpoint
+
+    if not app.AZURE_API_KEY:
+        print("AZURE_API_KEY is not set.", file=sys.stderr)
+        return 2
+    qa_scores_json = app.DEFAULT_QA_SCORES_JSON
+    if args.qa_scores:
+        with open(args.qa_scores, encoding="utf-8") as f:
+            qa_scores_json = json.load(f)
+    conversations = load_conversations(args.conversations)
+    if not conversations:
+        print(f"No conversation files found in {args.conversations}", file=sys.stderr)
+        return 1
+
+    started = time.perf_counter()
+    if args.mode == "asyncio":
+        results = app.run_async(run_asyncio(
+            qa_scores_json, conversations, args.model, args.history, args.concurrency))
+    else:
+        results = run_threads(
+            qa_scores_json, conversations, args.model, args.history, args.concurrency)
+    summary = write_outputs(
+        args.output, conversations, results, args, time.perf_counter() - started)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0 if summary["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
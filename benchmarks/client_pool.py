@@ -0,0 +1,118 @@
+"""Per-turn client overhead: a new Azure client per call vs. the app's pooled client.
+
+Runs the local mock Azure server (benchmarks/mock_azure.py) with a profile that
+answers instantly, so the measured time is client construction plus connection setup
+(TCP, and TLS with --tls) rather than model time. The pooled turns go through
+app.call_azure_api, the path chat turns take, and must share one connection.
+
+    python benchmarks/client_pool.py --turns 50
+    python benchmarks/client_pool.py --turns 50 --tls
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from benchmarks.mock_azure import MockAzureServer  # noqa: E402
+
+# Answer instantly so the measurement is client and connection overhead only.
+INSTANT_PROFILE = {"ttft_s": 0, "tokens_per_second": 0, "reply": "ok"}
+
+
+def make_self_signed_cert(directory: str) -> tuple:
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def fresh_client_turn() -> float:
+    # Behaviour before pooling: a new client (and connection pool) per call.
+    async def turn():
+        async with app.AsyncAzureOpenAI(
+            api_key=app.AZURE_API_KEY,
+            api_version=app.AZURE_API_VERSION,
+            azure_endpoint=app.AZURE_ENDPOINT,
+        ) as client:
+            stream = await client.chat.completions.create(
+                model="bench", messages=MESSAGES, stream=True)
+            async for _ in stream:
+                pass
+
+    started = time.perf_counter()
+    app.run_async(turn())
+    return (time.perf_counter() - started) * 1000
+
+
+def pooled_turn() -> float:
+    stats = {}
+    started = time.perf_counter()
+    app.call_azure_api(MESSAGES, "bench", stats=stats)
+    elapsed = (time.perf_counter() - started) * 1000
+    if stats["error"]:
+        raise RuntimeError(f"pooled turn failed: {stats['error']}")
+    return elapsed
+
+
+def summarize(samples: list, connections: int) -> dict:
+    ordered = sorted(samples)
+    return {
+        "connections_opened": connections,
+        "mean_ms": round(statistics.mean(ordered), 2),
+        "p50_ms": round(ordered[len(ordered) // 2], 2),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--tls", action="store_true",
+                        help="serve HTTPS with a throwaway self-signed certificate")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile = keyfile = None
+        if args.tls:
+            certfile, keyfile = make_self_signed_cert(tmp)
+            os.environ["SSL_CERT_FILE"] = certfile
+        server = MockAzureServer({"*": INSTANT_PROFILE}, certfile=certfile, keyfile=keyfile)
+        endpoint = app.AZURE_ENDPOINT = server.start()
+        app.AZURE_API_KEY = "bench"
+        app.get_rate_limiter().limits = {
+            "default": {"requests_per_minute": 1_000_000, "tokens_per_minute": 1_000_000_000}}
+
+        per_call = [fresh_client_turn() for _ in range(args.turns)]
+        per_call_connections = server.connections_opened
+        server.reset_stats()
+        pooled = [pooled_turn() for _ in range(args.turns)]
+        pooled_connections = server.connections_opened
+        server.stop()
+    assert pooled_connections == 1, (
+        f"pooled client opened {pooled_connections} connections for {args.turns} turns")
+
+    print(json.dumps({
+        "endpoint": endpoint,
+        "turns": args.turns,
+        "client_per_call": summarize(per_call, per_call_connections),
+        "pooled_client": summarize(pooled, pooled_connections),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""End-to-end latency of process_user_message against the local mock Azure server.
+
+For each history length and concurrency level, sends a batch of turns through the
+full pipeline (prompt build, pooled client, retries, streaming) and records prompt
+build time, request bytes, time to first token and total latency. Results go to a
+JSON file; pass an earlier one with --compare to print the change per cell.
+
+    python benchmarks/e2e_latency.py
+    python benchmarks/e2e_latency.py --history-lengths 0,20,80 --concurrency 1,8 --requests 24
+    python benchmarks/e2e_latency.py --compare benchmarks/results/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import streamlit.logger  # noqa: E402
+
+streamlit.logger.set_log_level("error")  # no ScriptRunContext warnings outside `streamlit run`
+
+import app  # noqa: E402
+from benchmarks.mock_azure import DEFAULT_PROFILE, MockAzureServer  # noqa: E402
+
+OPENING = "Hallo! Deine Bewertung ist fertig. Was möchtest du über dein Porträt wissen?"
+USER_TURNS = (
+    "Warum ist meine Bewertung für Proportionen so niedrig?",
+    "Was soll ich beim Licht und Schatten verbessern?",
+    "Wie kann ich die Komposition üben?",
+    "Und die Linienführung, was fällt dir da auf?",
+)
+ASSISTANT_TURN = (
+    "Die Augen sitzen etwas zu hoch, und die Schatten am Hals sind sehr hart. "
+    "Übe mit einem Raster und weichen Übergängen. Möchtest du mehr dazu wissen? (Antwort {n})"
+)
+COMPARED = ("prompt_build_ms", "request_bytes", "ttft_p50_ms", "total_p50_ms", "total_p95_ms")
+
+
+def make_conversation(history_length: int, request_number: int) -> list:
+    """Opening message, `history_length` alternating messages, then a new user question.
+
+    Every user turn is an on-topic question about the evaluation (intent A or B), so the
+    off-topic fast path never answers locally.
+    """
+    messages = [{"role": "assistant", "content": OPENING}]
+    for n in range(history_length):
+        if n % 2 == 0:
+            messages.append({"role": "user", "content": USER_TURNS[n // 2 % len(USER_TURNS)]})
+        else:
+            messages.append({"role": "assistant", "content": ASSISTANT_TURN.format(n=n)})
+    if messages and messages[-1]["role"] == "user":
+        messages.append({"role": "assistant", "content": ASSISTANT_TURN.format(n=history_length)})
+    question = USER_TURNS[request_number % len(USER_TURNS)]
+    messages.append({"role": "user", "content": f"{question} (Frage {request_number})"})
+    return messages
+
+
+def percentile_ms(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000, 2)
+
+
+def time_prompt_build(qa_scores_json: dict, messages: list, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        app.build_prompt_messages(qa_scores_json, messages)
+        samples.append(time.perf_counter() - started)
+    return round(statistics.median(samples) * 1000, 3)
+
+
+def one_request(qa_scores_json: dict, messages: list, model: str) -> dict:
+    started = time.perf_counter()
+    _, log_entry = app.process_user_message(qa_scores_json, messages, model)
+    timings = log_entry.get("timings") or {}
+    return {
+        "wall_s": time.perf_counter() - started,
+        "ttft_s": timings.get("time_to_first_token_s"),
+        "error": (log_entry.get("error") or {}).get("type"),
+        "deployment": log_entry.get("deployment_used"),
+    }
+
+
+def run_cell(server, qa_scores_json, model, history_length, concurrency, requests) -> dict:
+    conversations = [make_conversation(history_length, i) for i in range(requests)]
+    prompt_build_ms = time_prompt_build(qa_scores_json, conversations[0])
+    server.reset_stats()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(
+            lambda messages: one_request(qa_scores_json, messages, model), conversations))
+    elapsed = time.perf_counter() - started
+    ok = [o for o in outcomes if not o["error"]]
+    sent = [r["request_bytes"] for r in server.requests]
+    return {
+        "history_length": history_length,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": len(outcomes) - len(ok),
+        "deployments": sorted({o["deployment"] for o in outcomes if o["deployment"]}),
+        "http_requests": len(server.requests),
+        "connections_opened": server.connections_opened,
+        "prompt_build_ms": prompt_build_ms,
+        "request_bytes": round(statistics.mean(sent)) if sent else None,
+        "ttft_p50_ms": percentile_ms([o["ttft_s"] for o in ok if o["ttft_s"] is not None], 0.5),
+        "ttft_p95_ms": percentile_ms([o["ttft_s"] for o in ok if o["ttft_s"] is not None], 0.95),
+        "total_p50_ms": percentile_ms([o["wall_s"] for o in ok], 0.5),
+        "total_p95_ms": percentile_ms([o["wall_s"] for o in ok], 0.95),
+        "throughput_rps": round(len(outcomes) / elapsed, 2),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(current: dict, baseline: dict) -> list:
+    """Per-cell change of the COMPARED metrics, in percent of the baseline."""
+    previous = {(r["history_length"], r["concurrency"]): r for r in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        before = previous.get((result["history_length"], result["concurrency"]))
+        if not before:
+            continue
+        row = {"history_length": result["history_length"], "concurrency": result["concurrency"]}
+        for metric in COMPARED:
+            old, new = before.get(metric), result.get(metric)
+            if old and new is not None:
+                row[metric] = f"{new} ({(new - old) / old * 100:+.1f}%)"
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history-lengths", default="0,10,40,120",
+                        help="comma-separated message counts before the new user message")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated worker counts")
+    parser.add_argument("--requests", type=int, default=16, help="turns per cell")
+    parser.add_argument("--model", default=app.DEFAULT_MODEL)
+    parser.add_argument("--ttft", type=float, default=DEFAULT_PROFILE["ttft_s"])
+    parser.add_argument("--tps", type=float, default=DEFAULT_PROFILE["tokens_per_second"])
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--history-mode", choices=("compact", "full"), default=app.PROMPT_HISTORY_MODE)
+    parser.add_argument("--prompt-layout", choices=("prefix_stable", "inline"), default=app.PROMPT_LAYOUT)
+    parser.add_argument("--output", help="result file (default: benchmarks/results/e2e-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    profile = {"ttft_s": args.ttft, "tokens_per_second": args.tps, "throttle_rate": args.throttle_rate}
+    server = MockAzureServer({"*": profile})
+    app.AZURE_ENDPOINT = server.start()
+    app.AZURE_API_KEY = "bench"
+    app.RESPONSE_CACHE_ENABLED = False
+    # Routing would send some turns to a smaller tier; every turn must go to --model.
+    app.MODEL_ROUTING_ENABLED = False
+    app.PROMPT_HISTORY_MODE = args.history_mode
+    app.PROMPT_LAYOUT = args.prompt_layout
+    # The client-side limiter would cap the higher concurrency levels; measure the pipeline.
+    app.get_rate_limiter().limits = {
+        "default": {"requests_per_minute": 1_000_000, "tokens_per_minute": 1_000_000_000}}
+    app.warm_up_azure_client()
+    qa_scores_json = app.DEFAULT_QA_SCORES_JSON
+
+    results = []
+    for history_length in [int(v) for v in args.history_lengths.split(",")]:
+        for concurrency in [int(v) for v in args.concurrency.split(",")]:
+            cell = run_cell(server, qa_scores_json, args.model, history_length,
+                            concurrency, args.requests)
+            print(json.dumps(cell), file=sys.stderr)
+            results.append(cell)
+    server.stop()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "openai": app.openai.__version__,
+            "history_mode": args.history_mode,
+            "prompt_layout": args.prompt_layout,
+            "model": args.model,
+            "mock_profile": {**DEFAULT_PROFILE, **profile, "reply": None},
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"e2e-{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(json.dumps(compare(report, json.load(f)), indent=2, ensure_ascii=False))
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
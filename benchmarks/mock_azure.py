@@ -0,0 +1,328 @@
+"""Local stand-in for an Azure OpenAI resource.
+
+Speaks the two calls app.py makes: streaming (and non-streaming) chat completions
+on /openai/deployments/<name>/chat/completions, and the /openai/deployments
+listing read by fetch_azure_deployment_names. Each deployment gets a profile with
+time-to-first-token, tokens per second and error/429 injection, so the pipeline can
+be run and timed without a live resource.
+
+    python benchmarks/mock_azure.py --port 8000 --ttft 0.4 --tps 60
+    python benchmarks/mock_azure.py --port 8000 --profiles profiles.json
+
+profiles.json maps deployment names to profile overrides ("*" applies to any
+deployment not listed), e.g. {"gpt-4o": {"ttft_s": 0.6}, "gpt-4o-mini": {"throttle_rate": 0.2}}.
+Point the app at it with AZURE_ENDPOINT = "http://127.0.0.1:8000" and any API key.
+
+In-process use (benchmarks): MockAzureServer(...).start() returns the endpoint URL.
+"""
+import argparse
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PROFILE = {
+    "ttft_s": 0.3,              # delay before the first content chunk
+    "tokens_per_second": 50,    # pace of the following chunks (0 = all at once)
+    "reply": (
+        "Das ist eine Antwort aus dem lokalen Teststand. Sie hat ungefähr die Länge "
+        "einer typischen Nachricht im Gespräch und wird Wort für Wort gestreamt."
+    ),
+    "error_rate": 0.0,          # share of requests answered with error_status
+    "error_status": 500,
+    "throttle_rate": 0.0,       # share of requests answered with 429
+    "retry_after_s": 1,
+    "unsupported_params": [],   # request parameters answered with a 400, like Azure does
+}
+
+CACHE_MIN_TOKENS = 1024         # Azure caches prompt prefixes from 1024 tokens,
+CACHE_BLOCK_TOKENS = 128        # in 128-token increments
+
+_COMPLETIONS_PATH = re.compile(r"^/openai/deployments/([^/]+)/chat/completions$")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def common_prefix_len(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.server.mock.record_connection()
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path.rstrip("/") in ("/openai/deployments", "/openai/models"):
+            self.send_json(200, {"data": [
+                {"id": name, "model": name, "object": "deployment", "status": "succeeded"}
+                for name in self.server.mock.deployment_names()
+            ]})
+        else:
+            self.send_json(404, {"error": {"code": "404", "message": "Resource not found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        match = _COMPLETIONS_PATH.match(self.path.split("?", 1)[0])
+        if not match:
+            self.send_json(404, {"error": {"code": "404", "message": "Resource not found"}})
+            return
+        deployment = match.group(1)
+        mock = self.server.mock
+        profile = mock.profile_for(deployment)
+        if profile is None:
+            mock.record_request(deployment, len(body), 404)
+            self.send_json(404, {"error": {
+                "code": "DeploymentNotFound",
+                "message": f"The API deployment {deployment} does not exist.",
+            }})
+            return
+        status = mock.injected_status(profile)
+        if status:
+            mock.record_request(deployment, len(body), status)
+            headers = {"Retry-After": str(profile["retry_after_s"])} if status == 429 else None
+            self.send_json(status, {"error": {
+                "code": str(status),
+                "message": "Rate limit exceeded." if status == 429 else "Injected server error.",
+            }}, headers)
+            return
+
+        payload = json.loads(body or b"{}")
+        rejected = [name for name in profile["unsupported_params"] if name in payload]
+        if rejected:
+            mock.record_request(deployment, len(body), 400)
+            self.send_json(400, {"error": {
+                "code": "unsupported_parameter",
+                "message": f"Unsupported parameter: '{rejected[0]}' is not supported with this model.",
+                "param": rejected[0],
+            }})
+            return
+        usage = mock.usage_for(deployment, payload, profile)
+        mock.record_request(deployment, len(body), 200)
+        words = re.findall(r"\S+\s*", profile["reply"])
+        limit = payload.get("max_completion_tokens") or payload.get("max_tokens")
+        if limit:
+            words = words[:limit]
+        usage["completion_tokens"] = len(words)
+        usage["total_tokens"] = usage["prompt_tokens"] + len(words)
+
+        time.sleep(profile["ttft_s"])
+        if not payload.get("stream"):
+            self.send_json(200, {
+                "id": "mock", "object": "chat.completion", "created": int(time.time()),
+                "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                    "role": "assistant", "content": "".join(words)}}],
+                "usage": usage,
+            })
+            return
+
+        events = [
+            {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": deployment,
+             "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            for word in words
+        ]
+        events.append({"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": deployment,
+                       "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            events.append({"id": "mock", "object": "chat.completion.chunk", "created": 0,
+                           "model": deployment, "choices": [], "usage": usage})
+        events.append("[DONE]")
+        encoded = [sse_event(event) for event in events]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        if not profile["tokens_per_second"]:
+            # Unpaced: one sized body, which also lets the client reuse the connection.
+            body = b"".join(encoded)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        delay = 1 / profile["tokens_per_second"]
+        try:
+            for i, chunk in enumerate(encoded):
+                if 0 < i < len(words):
+                    time.sleep(delay)
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # client stopped reading mid-stream
+
+
+def sse_event(payload) -> bytes:
+    data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+    return f"data: {data}\n\n".encode()
+
+
+class MockAzureServer:
+    """Threaded stand-in server; `profiles` maps deployment -> overrides of DEFAULT_PROFILE.
+
+    Without profiles every deployment name is accepted. With profiles, only the listed
+    names are (plus any name when a "*" profile is given); others get a 404 like Azure.
+    """
+
+    def __init__(self, profiles: dict = None, host: str = "127.0.0.1", port: int = 0,
+                 seed: int = 0, certfile: str = None, keyfile: str = None):
+        self.profiles = {
+            name: {**DEFAULT_PROFILE, **overrides}
+            for name, overrides in (profiles or {"*": {}}).items()
+        }
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_prompt = {}
+        self._forced = []
+        self.connections_opened = 0
+        self.requests = []
+        self.httpd = ThreadingHTTPServer((host, port), MockAzureHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.scheme = "http"
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+            self.scheme = "https"
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"{self.scheme}://{host}:{port}"
+
+    def start(self) -> str:
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.endpoint
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def deployment_names(self) -> list:
+        names = sorted(name for name in self.profiles if name != "*")
+        return names or ["gpt-4o"]
+
+    def profile_for(self, deployment: str):
+        return self.profiles.get(deployment) or self.profiles.get("*")
+
+    def fail_next(self, count: int, status: int = 429) -> None:
+        """Answer the next `count` completion requests with `status`, whatever the profile."""
+        with self._lock:
+            self._forced.extend([status] * count)
+
+    def injected_status(self, profile: dict):
+        with self._lock:
+            if self._forced:
+                return self._forced.pop(0)
+            roll = self._random.random()
+        if roll < profile["throttle_rate"]:
+            return 429
+        if roll < profile["throttle_rate"] + profile["error_rate"]:
+            return profile["error_status"]
+        return None
+
+    def usage_for(self, deployment: str, payload: dict, profile: dict) -> dict:
+        """Prompt tokens from the request; cached tokens from the prefix shared with the last one."""
+        prompt = json.dumps(payload.get("messages", []), ensure_ascii=False)
+        prompt_tokens = estimate_tokens(prompt)
+        with self._lock:
+            previous = self._last_prompt.get(deployment, "")
+            self._last_prompt[deployment] = prompt
+        shared = estimate_tokens(prompt[:common_prefix_len(prompt, previous)]) if previous else 0
+        cached = 0
+        if shared >= CACHE_MIN_TOKENS:
+            cached = shared // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+        return {
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def record_connection(self) -> None:
+        with self._lock:
+            self.connections_opened += 1
+
+    def record_request(self, deployment: str, request_bytes: int, status: int) -> None:
+        with self._lock:
+            self.requests.append({
+                "deployment": deployment, "request_bytes": request_bytes, "status": status,
+            })
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.connections_opened = 0
+            self.requests = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--profiles", help="JSON file: deployment name -> profile overrides")
+    parser.add_argument("--ttft", type=float, default=DEFAULT_PROFILE["ttft_s"])
+    parser.add_argument("--tps", type=float, default=DEFAULT_PROFILE["tokens_per_second"])
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    base = {
+        "ttft_s": args.ttft,
+        "tokens_per_second": args.tps,
+        "throttle_rate": args.throttle_rate,
+        "error_rate": args.error_rate,
+    }
+    profiles = {"*": {}}
+    if args.profiles:
+        with open(args.profiles, encoding="utf-8") as f:
+            profiles = json.load(f)
+    server = MockAzureServer(
+        {name: {**base, **overrides} for name, overrides in profiles.items()},
+        host=args.host, port=args.port, seed=args.seed,
+    )
+    print(f"Mock Azure OpenAI at {server.endpoint} "
+          f"(deployments: {', '.join(server.deployment_names())})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Server-side infrastructure of the portrait QA assistant (app.py holds the config)."""
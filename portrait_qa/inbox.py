@@ -0,0 +1,283 @@
+"""Delivery of finished evaluations to live sessions, over HTTP or a drop directory."""
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from watchdog.observers import Observer  # optional: event-driven drop directory
+except ImportError:
+    Observer = None
+
+logger = logging.getLogger(__name__)
+
+
+def request_session_rerun(runtime_session_id: str) -> bool:
+    """Ask Streamlit to rerun a browser session's script, from any thread.
+
+    Uses the runtime internals Streamlit itself uses for run-on-save (see
+    missing_rerun_internals); returns False where they are not available.
+    """
+    try:
+        from streamlit.runtime import Runtime
+
+        runtime = Runtime.instance()
+        info = runtime._session_mgr.get_active_session_info(runtime_session_id)
+        if info is None:
+            return False
+        session = info.session
+        runtime._get_async_objs().eventloop.call_soon_threadsafe(
+            session.request_rerun, session._client_state
+        )
+        return True
+    except Exception:
+        return False
+
+
+def missing_rerun_internals(session=None) -> list:
+    """The Streamlit internals request_session_rerun relies on that this version lacks
+    (checked on `session`, an AppSession, when given)."""
+    try:
+        from streamlit.runtime import Runtime
+        from streamlit.runtime.app_session import AppSession
+        from streamlit.runtime.session_manager import SessionManager
+    except ImportError as e:
+        return [str(e)]
+    required = [
+        (Runtime, "instance"), (Runtime, "_get_async_objs"),
+        (SessionManager, "get_active_session_info"), (AppSession, "request_rerun"),
+    ]
+    if session is not None:
+        required.append((session, "_client_state"))
+    if Runtime.exists():
+        required.append((Runtime.instance(), "_session_mgr"))
+    return [
+        f"{getattr(owner, '__name__', type(owner).__name__)}.{name}"
+        for owner, name in required if not hasattr(owner, name)
+    ]
+
+
+def parse_evaluation_payload(payload) -> tuple:
+    """(qa_scores_json, user_id, portrait_id) from a delivered evaluation: the object
+    itself, or {"qa_scores_json": {...}, "user_id": ..., "portrait_id": ...} with optional
+    ids. Raises ValueError if unusable."""
+    user_id = portrait_id = None
+    if isinstance(payload, dict) and isinstance(payload.get("qa_scores_json"), dict):
+        user_id = payload.get("user_id")
+        portrait_id = payload.get("portrait_id")
+        payload = payload["qa_scores_json"]
+    if not isinstance(payload, dict) or not payload:
+        raise ValueError("Expected a non-empty qa_scores_json object.")
+    for value in (user_id, portrait_id):
+        if value is not None and (not isinstance(value, str) or not value):
+            raise ValueError("user_id and portrait_id must be non-empty strings.")
+    return payload, user_id, portrait_id
+
+
+class EvaluationInbox:
+    """Process-wide mailbox for finished evaluations, keyed by the app's session id.
+
+    deliver() keeps the newest evaluation per session and wakes its browser session, which
+    collects it with take(). Sessions in the middle of a turn are not woken (a rerun would
+    cut off the streaming reply); they collect it when the turn ends.
+    """
+
+    def __init__(self, max_pending: int, store):
+        self.max_pending = max_pending
+        self.store = store
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._sessions = OrderedDict()  # app session id -> Streamlit session id
+        self._busy = set()
+        self.http_endpoint = None
+        self.http_error = None
+        self.drop_dir = None
+
+    def register(self, session_id: str, runtime_session_id: str) -> None:
+        with self._lock:
+            self._sessions[session_id] = runtime_session_id
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_pending:
+                self._sessions.popitem(last=False)
+
+    def accept(self, session_id: str, payload) -> bool:
+        """parse_evaluation_payload, save it to the store when it names a user and a
+        portrait, and deliver it to `session_id` (if given). Raises ValueError."""
+        qa_scores_json, user_id, portrait_id = parse_evaluation_payload(payload)
+        if user_id and portrait_id:
+            self.store.put(user_id, portrait_id, qa_scores_json)
+        elif not session_id:
+            raise ValueError("Without a session id, user_id and portrait_id are required.")
+        if not session_id:
+            return False
+        return self.deliver(session_id, qa_scores_json, portrait_id)
+
+    def deliver(self, session_id: str, qa_scores_json: dict, portrait_id: str = None) -> bool:
+        """Keep the evaluation for the session; returns whether a live session was woken."""
+        with self._lock:
+            self._pending[session_id] = {
+                "qa_scores_json": qa_scores_json, "portrait_id": portrait_id,
+            }
+            self._pending.move_to_end(session_id)
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+            runtime_session_id = self._sessions.get(session_id)
+            busy = session_id in self._busy
+        if runtime_session_id is None or busy:
+            return False
+        return request_session_rerun(runtime_session_id)
+
+    def has_pending(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._pending
+
+    def take(self, session_id: str):
+        """{"qa_scores_json", "portrait_id"} delivered for the session, or None."""
+        with self._lock:
+            return self._pending.pop(session_id, None)
+
+    def turn_started(self, session_id: str) -> None:
+        with self._lock:
+            self._busy.add(session_id)
+
+    def turn_finished(self, session_id: str) -> None:
+        with self._lock:
+            self._busy.discard(session_id)
+
+    # ---- channels ----
+
+    def serve_http(self, host: str, port: int, max_body_bytes: int) -> None:
+        try:
+            server = ThreadingHTTPServer((host, port), EvaluationIngestHandler)
+        except OSError as e:
+            self.http_error = str(e)
+            return
+        server.daemon_threads = True
+        server.inbox = self
+        server.max_body_bytes = max_body_bytes
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.http_endpoint = f"http://{host}:{server.server_address[1]}/evaluations/"
+
+    def watch_directory(self, directory: str, scan_interval_s: float) -> None:
+        """Ingest files dropped into `directory`: watchdog events, or a scan every
+        `scan_interval_s` without watchdog."""
+        os.makedirs(directory, exist_ok=True)
+        self.drop_dir = directory
+        self.scan_directory()
+        if Observer is not None:
+            observer = Observer()
+            observer.schedule(_DropDirectoryHandler(self), directory, recursive=False)
+            observer.daemon = True
+            observer.start()
+            return
+
+        def scan_forever():
+            failure = None
+            while True:
+                time.sleep(scan_interval_s)
+                try:
+                    self.scan_directory()
+                    failure = None
+                except Exception as e:
+                    # Keep scanning (the directory may come back); log each new failure once.
+                    if repr(e) != failure:
+                        logger.exception("Scanning %s failed", self.drop_dir)
+                    failure = repr(e)
+
+        threading.Thread(target=scan_forever, daemon=True).start()
+
+    def scan_directory(self) -> None:
+        for entry in os.scandir(self.drop_dir):
+            if entry.name.endswith(".json"):
+                self.ingest_file(entry.path)
+
+    def ingest_file(self, path: str) -> None:
+        """Deliver <session id>.json and remove it. Unusable files are renamed *.rejected
+        once they are a few seconds old (a younger one may still be being written)."""
+        session_id = os.path.basename(path)[:-len(".json")]
+        try:
+            with open(path, encoding="utf-8") as f:
+                payload = json.load(f)
+            parse_evaluation_payload(payload)
+        except FileNotFoundError:
+            return  # already taken by a concurrent scan
+        except ValueError:
+            try:
+                if time.time() - os.path.getmtime(path) > 5:
+                    os.replace(path, path + ".rejected")
+            except FileNotFoundError:
+                pass
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self.accept(session_id, payload)
+
+
+class _DropDirectoryHandler:
+    """watchdog event handler: files created in or moved into the drop directory."""
+
+    def __init__(self, inbox: EvaluationInbox):
+        self.inbox = inbox
+
+    def dispatch(self, event) -> None:
+        if event.is_directory or event.event_type not in ("created", "moved", "modified", "closed"):
+            return
+        path = getattr(event, "dest_path", "") or event.src_path
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if path.endswith(".json"):
+            try:
+                self.inbox.ingest_file(path)
+            except Exception:
+                # An exception here would stop the watchdog observer thread.
+                logger.exception("Ingesting %s failed", path)
+
+
+class EvaluationIngestHandler(BaseHTTPRequestHandler):
+    """POST /evaluations/<session id> with the evaluation as the body (see
+    parse_evaluation_payload), or POST /evaluations with user_id and portrait_id to
+    only save it to the store."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if parts[0] != "evaluations" or len(parts) > 2 or (len(parts) == 2 and not parts[1]):
+            self.send_json(404, {"error": "POST /evaluations or /evaluations/<session id>"})
+            return
+        session_id = parts[1] if len(parts) == 2 else None
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_json(411, {"error": "Content-Length is required"})
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_json(400, {"error": "Invalid Content-Length"})
+            return
+        if length > self.server.max_body_bytes:
+            self.send_json(413, {"error": f"At most {self.server.max_body_bytes} bytes"})
+            return
+        body = self.rfile.read(length)
+        try:
+            woken = self.server.inbox.accept(session_id, json.loads(body or b"null"))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, {"session_id": session_id, "session_woken": woken})
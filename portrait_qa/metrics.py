@@ -0,0 +1,224 @@
+"""Live metrics of the server process, as rows for the admin page and Prometheus text."""
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+
+def sample_quantile(samples, q: float):
+    """The q-quantile of `samples`, or None without samples."""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def prometheus_labels(**labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class MetricsRegistry:
+    """Counters and latency samples of the whole server process, fed by every session.
+
+    Quantiles cover the last `window` samples per series; sums and counts are cumulative.
+    """
+
+    def __init__(self, window: int, quantiles: tuple, prefix: str, active_session_s: float,
+                 runtime=None, scheduler=None, activity=None):
+        self.window = window
+        self.quantiles = quantiles
+        self.prefix = prefix
+        self.active_session_s = active_session_s
+        self.runtime = runtime
+        self.scheduler = scheduler
+        self.activity = activity
+        self.started = time.time()
+        self.http_endpoint = None
+        self.http_error = None
+        self._lock = threading.Lock()
+        self._requests = {}  # (deployment, outcome) -> count
+        self._turns = {}     # (priority, outcome) -> count
+        self._latency = {}   # (metric, label) -> {"samples", "count", "sum"}
+
+    def _observe(self, metric: str, label: str, seconds: float) -> None:
+        series = self._latency.setdefault(
+            (metric, label), {"samples": deque(maxlen=self.window), "count": 0, "sum": 0.0})
+        series["samples"].append(seconds)
+        series["count"] += 1
+        series["sum"] += seconds
+
+    def record_request(self, deployment: str, outcome: str, ttft_s: float = None,
+                       total_s: float = None) -> None:
+        """One Azure attempt; `outcome` is "ok" or the error type (describe_api_error)."""
+        with self._lock:
+            key = (deployment, outcome)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if ttft_s is not None:
+                self._observe("ttft", deployment, ttft_s)
+            if total_s is not None:
+                self._observe("request", deployment, total_s)
+
+    def record_turn(self, priority: str, outcome: str, total_s: float) -> None:
+        """One turn: outcome "model", "cached", "local", "speculation" or "error"."""
+        with self._lock:
+            key = (priority, outcome)
+            self._turns[key] = self._turns.get(key, 0) + 1
+            self._observe("turn", priority, total_s)
+
+    def gauges(self) -> dict:
+        deployments = self.scheduler.snapshot() if self.scheduler else {}
+        return {
+            "in_flight": self.runtime.in_flight if self.runtime else 0,
+            "max_in_flight": self.runtime.max_in_flight if self.runtime else 0,
+            "queued": sum(d["queued"] for d in deployments.values()),
+            "active_sessions": (
+                self.activity.active(self.active_session_s) if self.activity else 0),
+            "deployments": deployments,
+        }
+
+    def _copy(self) -> tuple:
+        with self._lock:
+            return (
+                dict(self._requests), dict(self._turns),
+                {key: {**s, "samples": list(s["samples"])} for key, s in self._latency.items()},
+            )
+
+    def snapshot(self) -> dict:
+        """Rows per deployment and per turn priority for the admin page, plus the gauges."""
+        requests, turns, latency = self._copy()
+        gauges = self.gauges()
+
+        def quantiles_ms(metric: str, label: str, prefix: str) -> dict:
+            samples = latency.get((metric, label), {}).get("samples", [])
+            return {
+                f"{prefix}_p{round(q * 100)}_ms": (
+                    round(sample_quantile(samples, q) * 1000) if samples else None)
+                for q in self.quantiles
+            }
+
+        deployments = sorted({d for d, _ in requests} | set(gauges["deployments"]))
+        rows = []
+        for deployment in deployments:
+            outcomes = {o: n for (d, o), n in requests.items() if d == deployment}
+            total = sum(outcomes.values())
+            errors = total - outcomes.get("ok", 0)
+            live = gauges["deployments"].get(deployment, {})
+            rows.append({
+                "deployment": deployment,
+                "requests": total,
+                "errors": errors,
+                "error_rate": round(errors / total, 3) if total else None,
+                "rate_limited_429": outcomes.get("rate_limited", 0),
+                "rate_limited_rate": (
+                    round(outcomes.get("rate_limited", 0) / total, 3) if total else None),
+                **quantiles_ms("ttft", deployment, "ttft"),
+                **quantiles_ms("request", deployment, "total"),
+                "in_flight": live.get("active", 0),
+                "queued": live.get("queued", 0),
+            })
+        turn_rows = []
+        for priority in sorted({p for p, _ in turns}):
+            outcomes = {o: n for (p, o), n in turns.items() if p == priority}
+            turn_rows.append({
+                "priority": priority,
+                "turns": sum(outcomes.values()),
+                **{o: outcomes.get(o, 0)
+                   for o in ("model", "cached", "local", "speculation", "error")},
+                **quantiles_ms("turn", priority, "total"),
+            })
+        return {
+            "deployments": rows,
+            "turns": turn_rows,
+            "gauges": {k: v for k, v in gauges.items() if k != "deployments"},
+            "uptime_s": round(time.time() - self.started),
+        }
+
+    def prometheus_text(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        requests, turns, latency = self._copy()
+        gauges = self.gauges()
+        p = self.prefix
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+
+        def summary(name: str, metric: str, label_name: str, help_text: str) -> None:
+            family(name, "summary", help_text)
+            for (m, label), series in sorted(latency.items()):
+                if m != metric:
+                    continue
+                for q in self.quantiles:
+                    labels = prometheus_labels(**{label_name: label, "quantile": q})
+                    lines.append(f"{p}_{name}{labels} {sample_quantile(series['samples'], q):.6f}")
+                labels = prometheus_labels(**{label_name: label})
+                lines.append(f"{p}_{name}_sum{labels} {series['sum']:.6f}")
+                lines.append(f"{p}_{name}_count{labels} {series['count']}")
+
+        family("azure_requests_total", "counter",
+               "Azure OpenAI chat requests (attempts) by deployment and outcome.")
+        for (deployment, outcome), count in sorted(requests.items()):
+            lines.append(f"{p}_azure_requests_total"
+                         f"{prometheus_labels(deployment=deployment, outcome=outcome)} {count}")
+        summary("azure_ttft_seconds", "ttft", "deployment",
+                "Time from sending a request to its first content chunk.")
+        summary("azure_request_seconds", "request", "deployment",
+                "Time from sending a request to the end of its stream.")
+        family("turns_total", "counter", "Pipeline turns by request priority and outcome.")
+        for (priority, outcome), count in sorted(turns.items()):
+            lines.append(f"{p}_turns_total"
+                         f"{prometheus_labels(priority=priority, outcome=outcome)} {count}")
+        summary("turn_seconds", "turn", "priority",
+                "Time from the start of a turn to its last chunk.")
+        family("azure_in_flight", "gauge", "Azure requests being sent or streamed.")
+        lines.append(f"{p}_azure_in_flight {gauges['in_flight']}")
+        family("deployment_active", "gauge", "Requests holding a deployment slot.")
+        for deployment, live in gauges["deployments"].items():
+            lines.append(f"{p}_deployment_active"
+                         f"{prometheus_labels(deployment=deployment)} {live['active']}")
+        family("deployment_queued", "gauge", "Requests waiting for a deployment slot.")
+        for deployment, live in gauges["deployments"].items():
+            lines.append(f"{p}_deployment_queued"
+                         f"{prometheus_labels(deployment=deployment)} {live['queued']}")
+        family("active_sessions", "gauge",
+               f"Sessions used within the last {self.active_session_s:g} seconds.")
+        lines.append(f"{p}_active_sessions {gauges['active_sessions']}")
+        family("start_time_seconds", "gauge", "Start time of the process, in Unix seconds.")
+        lines.append(f"{p}_start_time_seconds {self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def serve_http(self, host: str, port: int) -> None:
+        try:
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            self.http_error = str(e)
+            return
+        server.daemon_threads = True
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.http_endpoint = f"http://{host}:{server.server_address[1]}/metrics"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics: MetricsRegistry.prometheus_text for a Prometheus scraper."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0].rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,192 @@
+"""Client-side admission of requests per Azure deployment."""
+import asyncio
+from collections import OrderedDict, deque
+import threading
+import time
+import uuid
+
+
+class DeploymentRateLimiter:
+    """Requests- and tokens-per-minute token buckets per deployment.
+
+    Reservations are taken at once (buckets may go into debt) and the caller sleeps for
+    the returned delay, so concurrent callers queue in order. `pause` holds back everyone.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._paused_until = {}
+
+    def _bucket(self, deployment: str, now: float) -> dict:
+        bucket = self._buckets.get(deployment)
+        limits = self.limits.get(deployment) or self.limits["default"]
+        rpm, tpm = limits["requests_per_minute"], limits["tokens_per_minute"]
+        if bucket is None:
+            bucket = {"requests": rpm, "tokens": tpm, "updated": now}
+            self._buckets[deployment] = bucket
+        elapsed = now - bucket["updated"]
+        bucket["requests"] = min(rpm, bucket["requests"] + elapsed * rpm / 60)
+        bucket["tokens"] = min(tpm, bucket["tokens"] + elapsed * tpm / 60)
+        bucket["updated"] = now
+        bucket["rpm"], bucket["tpm"] = rpm, tpm
+        return bucket
+
+    def reserve(self, deployment: str, tokens: int, max_wait_s: float):
+        """Seconds to wait before sending, or None (nothing reserved) if above max_wait_s."""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(deployment, now)
+            tokens = min(tokens, bucket["tpm"])
+            wait = max(
+                0.0,
+                self._paused_until.get(deployment, 0.0) - now,
+                (1 - bucket["requests"]) * 60 / bucket["rpm"],
+                (tokens - bucket["tokens"]) * 60 / bucket["tpm"],
+            )
+            if wait > max_wait_s:
+                return None
+            bucket["requests"] -= 1
+            bucket["tokens"] -= tokens
+            return wait
+
+    def pause(self, deployment: str, seconds: float) -> None:
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._paused_until[deployment] = max(
+                until, self._paused_until.get(deployment, 0.0))
+
+
+class QueueTicket:
+    """Who a request is for (fairness key), its priority, and its live place in the queue.
+
+    `position` is 1-based while the request waits for a deployment slot and 0 otherwise;
+    `sent` counts the requests actually issued to Azure under this ticket.
+    """
+
+    def __init__(self, session_id: str = None, priority: str = "turn"):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.priority = priority
+        self.deployment = None
+        self.position = 0
+        self.queued = 0
+        self.sent = 0
+
+
+class DeploymentScheduler:
+    """Fair admission of outbound requests per deployment, for the whole server process.
+
+    A deployment runs at most its limits' max_concurrency requests at once. Waiters are
+    admitted by priority (`priorities` order) and, within one, round-robin across
+    sessions. Only used on the shared event loop; `snapshot` may be called from any thread.
+    """
+
+    def __init__(self, limits: dict, priorities: tuple):
+        self.limits = limits
+        self.priorities = priorities
+        self._lock = threading.Lock()
+        self._active = {}
+        # deployment -> priority -> OrderedDict(session_id -> deque of (ticket, future))
+        self._waiting = {}
+
+    def _max_concurrency(self, deployment: str) -> int:
+        limits = self.limits.get(deployment) or self.limits["default"]
+        return limits.get("max_concurrency", self.limits["default"]["max_concurrency"])
+
+    def _has_waiters(self, deployment: str) -> bool:
+        return any(self._waiting.get(deployment, {}).values())
+
+    def _order(self, deployment: str) -> list:
+        """Waiting (ticket, future) pairs in the order they will be admitted."""
+        order = []
+        queues = self._waiting.get(deployment, {})
+        for priority in self.priorities:
+            sessions = [list(waiters) for waiters in queues.get(priority, {}).values()]
+            for rank in range(max(map(len, sessions), default=0)):
+                order.extend(waiters[rank] for waiters in sessions if rank < len(waiters))
+        return order
+
+    def _refresh_positions(self, deployment: str) -> None:
+        order = self._order(deployment)
+        for i, (ticket, _) in enumerate(order):
+            ticket.position = i + 1
+            ticket.queued = len(order)
+
+    def _next_waiter(self, deployment: str):
+        queues = self._waiting.get(deployment, {})
+        for priority in self.priorities:
+            sessions = queues.get(priority)
+            if sessions:
+                session_id, waiters = next(iter(sessions.items()))
+                entry = waiters.popleft()
+                del sessions[session_id]
+                if waiters:
+                    sessions[session_id] = waiters  # back of the round-robin
+                return entry
+        return None
+
+    def _admit(self, deployment: str) -> None:
+        while self._active.get(deployment, 0) < self._max_concurrency(deployment):
+            entry = self._next_waiter(deployment)
+            if entry is None:
+                break
+            ticket, future = entry
+            if future.done():
+                continue
+            ticket.position = 0
+            self._active[deployment] = self._active.get(deployment, 0) + 1
+            future.set_result(None)
+        self._refresh_positions(deployment)
+
+    async def acquire(self, deployment: str, ticket: QueueTicket) -> float:
+        """Wait for a slot on `deployment`; returns the seconds spent queued."""
+        with self._lock:
+            ticket.deployment = deployment
+            if (
+                self._active.get(deployment, 0) < self._max_concurrency(deployment)
+                and not self._has_waiters(deployment)
+            ):
+                self._active[deployment] = self._active.get(deployment, 0) + 1
+                return 0.0
+            future = asyncio.get_running_loop().create_future()
+            sessions = self._waiting.setdefault(deployment, {}).setdefault(
+                ticket.priority, OrderedDict())
+            sessions.setdefault(ticket.session_id, deque()).append((ticket, future))
+            self._refresh_positions(deployment)
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if future.done() and not future.cancelled():
+                    # Admitted just before the cancellation: hand the slot on.
+                    self._active[deployment] -= 1
+                else:
+                    waiters = self._waiting[deployment][ticket.priority].get(ticket.session_id)
+                    if waiters is not None:
+                        waiters.remove((ticket, future))
+                        if not waiters:
+                            del self._waiting[deployment][ticket.priority][ticket.session_id]
+                self._admit(deployment)
+            ticket.position = 0
+            raise
+        return time.perf_counter() - started
+
+    def release(self, deployment: str) -> None:
+        with self._lock:
+            self._active[deployment] -= 1
+            self._admit(deployment)
+
+    def snapshot(self) -> dict:
+        """{deployment: {"active": n, "queued": n}} for deployments in use or with waiters."""
+        with self._lock:
+            deployments = sorted(set(self._active) | set(self._waiting))
+            return {
+                name: {
+                    "active": self._active.get(name, 0),
+                    "queued": len(self._order(name)),
+                }
+                for name in deployments
+                if self._active.get(name, 0) or self._has_waiters(name)
+            }
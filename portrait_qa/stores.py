@@ -0,0 +1,590 @@
+"""Stores shared by the sessions of the server process."""
+from collections import OrderedDict, deque
+import difflib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from portrait_qa.inbox import request_session_rerun
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def fill_prompt_template(template: str, history_text: str, qa_json: str) -> str:
+    return (
+        template.replace("{conversation_history}", history_text)
+        .replace("{qa_scores_json}", qa_json)
+    )
+
+
+class ResponseCache:
+    """Completed replies keyed on a hash of the full request, each with its own TTL.
+
+    An in-memory LRU in front of one JSON file per entry under `directory`; the oldest
+    files are evicted beyond max_disk_bytes.
+    """
+
+    def __init__(self, directory: str, memory_entries: int, max_disk_bytes: int):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._disk_bytes = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    @staticmethod
+    def make_key(deployment: str, api_messages: list, params: dict) -> str:
+        """`params` are the request's completion_params (sampling, caps, reasoning effort)."""
+        payload = json.dumps(
+            {
+                "deployment": deployment,
+                "messages": api_messages,
+                "params": {k: v for k, v in params.items() if k != "stream_options"},
+            },
+            ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> tuple:
+        """Returns (response, tier) with tier "memory" or "disk", or (None, None)."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry["expires_at"] > now:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry["response"], "memory"
+            self._memory.pop(key, None)
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            entry = None
+        with self._lock:
+            if entry is None or entry.get("expires_at", 0) <= now:
+                self.counters["misses"] += 1
+                return None, None
+            self._remember(key, entry)
+            self.counters["disk_hits"] += 1
+        return entry["response"], "disk"
+
+    def _remember(self, key: str, entry: dict):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key: str, response: str, ttl_s: float) -> None:
+        entry = {"response": response, "expires_at": time.time() + ttl_s}
+        with self._lock:
+            self._remember(key, entry)
+            self.counters["stores"] += 1
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _scan_disk(self) -> tuple:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                files.append((info.st_mtime, info.st_size, path))
+        return files, sum(size for _, size, _ in files)
+
+    def _evict_disk(self):
+        files, total = self._scan_disk()
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            counters["memory_entries"] = len(self._memory)
+        lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        counters["hit_rate"] = hits / lookups if lookups else 0.0
+        return counters
+
+
+class PipelineLogStore:
+    """Per-conversation pipeline log: append-only JSONL on disk, small tail in memory.
+
+    Turn records keep only what changed: the template and the evaluation are written once
+    as content-addressed blobs, the chat as the messages added since the previous turn and
+    the conversation_history slot as a line diff against the previous prompt's. Step fields
+    that repeat the turn's (the response, prompt tokens, state) are not written twice.
+    `reconstruct` replays the file to rebuild any turn's exact request.
+    """
+
+    # Step field -> the log entry field it usually repeats.
+    SHARED_STEP_FIELDS = {
+        "response": "assistant_response",
+        "prompt_tokens": "prompt_tokens",
+        "conversation_state": "conversation_state",
+    }
+
+    def __init__(self, directory: str, conversation_id: str, memory_tail: int):
+        self.path = os.path.join(directory, f"{conversation_id}.jsonl")
+        self.conversation_id = conversation_id
+        self._tail = deque(maxlen=memory_tail)
+        self._blob_hashes = set()
+        self._transcript_len = 0
+        self._last_message_hash = None
+        self._history_lines = []
+        self.turns = 0
+        self.usage_totals = {"turns": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    @classmethod
+    def resume(cls, directory: str, conversation_id: str, memory_tail: int) -> "PipelineLogStore":
+        """A store continuing an existing log file (counters, blobs and tail replayed)."""
+        store = cls(directory, conversation_id, memory_tail)
+        for record in store.iter_records():
+            kind = record.pop("kind")
+            if kind == "blob":
+                store._blob_hashes.add(record["hash"])
+            elif kind == "messages":
+                if record["reset"]:
+                    store._transcript_len = 0
+                store._transcript_len += len(record["messages"])
+                if record["messages"]:
+                    store._last_message_hash = store._message_hash(record["messages"][-1])
+            elif kind == "turn":
+                for step in record["steps"]:
+                    if "prompt" in step:
+                        store._history_lines = store._apply_history_delta(
+                            store._history_lines, step["prompt"]["history_delta"])
+                store.turns += 1
+                store._tail.append(record)
+                store._count_usage(record.get("usage"))
+        return store
+
+    def __len__(self) -> int:
+        return self.turns
+
+    def _write(self, records: list) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+
+    def _blob(self, text: str, records: list) -> str:
+        digest = content_hash(text)
+        if digest not in self._blob_hashes:
+            self._blob_hashes.add(digest)
+            records.append({"kind": "blob", "hash": digest, "text": text})
+        return digest
+
+    def _messages_delta(self, messages: list, records: list) -> None:
+        """Record messages added since the last turn (or the full list if they diverged)."""
+        known = self._transcript_len
+        continues = len(messages) >= known and (
+            known == 0 or self._message_hash(messages[known - 1]) == self._last_message_hash
+        )
+        new = messages[known:] if continues else messages
+        if new or not continues:
+            records.append({"kind": "messages", "reset": not continues, "messages": new})
+        self._transcript_len = len(messages)
+        self._last_message_hash = self._message_hash(messages[-1]) if messages else None
+
+    @staticmethod
+    def _message_hash(message: dict) -> str:
+        return content_hash(json.dumps(message, ensure_ascii=False))
+
+    def _history_delta(self, text: str) -> list:
+        """`text` as ops on the previous history's lines: [start, end] copies a range of
+        them, a list of strings adds new lines."""
+        lines = text.split("\n")
+        matcher = difflib.SequenceMatcher(None, self._history_lines, lines, autojunk=False)
+        ops = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                ops.append([i1, i2])
+            elif j2 > j1:
+                ops.append({"lines": lines[j1:j2]})
+        self._history_lines = lines
+        return ops
+
+    @staticmethod
+    def _apply_history_delta(previous: list, ops: list) -> list:
+        lines = []
+        for op in ops:
+            lines.extend(op["lines"] if isinstance(op, dict) else previous[op[0]:op[1]])
+        return lines
+
+    def append(self, log_entry: dict, messages: list) -> dict:
+        """Store one process_user_message log entry; `messages` is the conversation it answered."""
+        messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+        records = []
+        self._messages_delta(messages, records)
+        steps = []
+        for step in log_entry.get("steps", []):
+            step = dict(step)
+            parts = step.pop("prompt_parts", None)
+            step.pop("system_prompt", None)
+            sent = step.pop("conversation_messages", None)
+            if parts is not None:
+                step["prompt"] = {
+                    "template": self._blob(parts["template"], records),
+                    "qa_scores_json": self._blob(parts["qa_scores_json"], records),
+                    "history_delta": self._history_delta(parts["conversation_history"]),
+                }
+            if sent is not None:
+                step["messages_range"] = [len(messages) - len(sent), len(messages)]
+            shared = [
+                key for key, entry_key in self.SHARED_STEP_FIELDS.items()
+                if key in step and entry_key in log_entry and step[key] == log_entry[entry_key]
+            ]
+            for key in shared:
+                del step[key]
+            if shared:
+                step["shared"] = shared
+            steps.append(step)
+        record = {**log_entry, "steps": steps, "turn": self.turns + 1}
+        records.append({"kind": "turn", **record})
+        self._write(records)
+        self.turns += 1
+        self._tail.append(record)
+        self._count_usage(log_entry.get("usage"))
+        return record
+
+    def _count_usage(self, usage) -> None:
+        if usage:
+            self.usage_totals["turns"] += 1
+            self.usage_totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            self.usage_totals["cached_tokens"] += usage.get("cached_tokens", 0)
+
+    def tail(self) -> list:
+        return list(self._tail)
+
+    def latest(self):
+        return self._tail[-1] if self._tail else None
+
+    def iter_records(self):
+        """Compact records from disk: blobs, message deltas and turns, in order."""
+        try:
+            f = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def iter_full_entries(self):
+        """Every turn as originally logged, with system_prompt and conversation_messages."""
+        blobs = {}
+        transcript = []
+        history = []
+        for record in self.iter_records():
+            kind = record.pop("kind")
+            if kind == "blob":
+                blobs[record["hash"]] = record["text"]
+            elif kind == "messages":
+                if record["reset"]:
+                    transcript = []
+                transcript.extend(record["messages"])
+            elif kind == "turn":
+                record.pop("turn", None)
+                steps = []
+                for step in record["steps"]:
+                    if "prompt" in step:
+                        history = self._apply_history_delta(
+                            history, step["prompt"]["history_delta"])
+                    steps.append(self._expand_step(step, record, blobs, transcript, history))
+                record["steps"] = steps
+                yield record
+
+    def _expand_step(
+        self, step: dict, entry: dict, blobs: dict, transcript: list, history: list,
+    ) -> dict:
+        step = dict(step)
+        prompt = step.pop("prompt", None)
+        messages_range = step.pop("messages_range", None)
+        for key in step.pop("shared", []):
+            step[key] = entry[self.SHARED_STEP_FIELDS[key]]
+        if prompt is not None:
+            step["system_prompt"] = fill_prompt_template(
+                blobs[prompt["template"]],
+                "\n".join(history),
+                blobs[prompt["qa_scores_json"]],
+            )
+        if messages_range is not None:
+            start, end = messages_range
+            step["conversation_messages"] = transcript[start:end]
+        return step
+
+    def reconstruct(self, turn: int) -> dict:
+        """The full log entry of turn number `turn` (1-based), including the exact prompt."""
+        for number, entry in enumerate(self.iter_full_entries(), start=1):
+            if number == turn:
+                return entry
+        raise KeyError(turn)
+
+
+class EvaluationStore:
+    """Evaluations in SQLite, one row per portrait, indexed by (user_id, created_at).
+
+    Parsed objects are kept in an LRU shared between sessions and must not be mutated.
+    """
+
+    def __init__(self, path: str, cache_entries: int):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                portrait_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                qa_scores_json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS evaluations_by_user
+                ON evaluations (user_id, created_at);
+        """)
+        self._lock = threading.Lock()
+        self._parsed = OrderedDict()
+        self.cache_entries = cache_entries
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, user_id: str, portrait_id: str, qa_scores_json: dict,
+            created_at: float = None) -> None:
+        text = json.dumps(qa_scores_json, ensure_ascii=False)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO evaluations VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (portrait_id) DO UPDATE SET user_id = excluded.user_id, "
+                    "created_at = excluded.created_at, qa_scores_json = excluded.qa_scores_json",
+                    (portrait_id, user_id, created_at or time.time(), text),
+                )
+            self._parsed.pop(portrait_id, None)
+
+    def get(self, portrait_id: str):
+        """The parsed evaluation of `portrait_id`, or None."""
+        with self._lock:
+            parsed = self._parsed.get(portrait_id)
+            if parsed is not None:
+                self._parsed.move_to_end(portrait_id)
+                self.hits += 1
+                return parsed
+            row = self._db.execute(
+                "SELECT qa_scores_json FROM evaluations WHERE portrait_id = ?", (portrait_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        parsed = json.loads(row[0])
+        with self._lock:
+            self.misses += 1
+            parsed = self._parsed.setdefault(portrait_id, parsed)
+            self._parsed.move_to_end(portrait_id)
+            while len(self._parsed) > self.cache_entries:
+                self._parsed.popitem(last=False)
+        return parsed
+
+    def list_portraits(self, user_id: str, limit: int) -> list:
+        """[(portrait_id, created_at)] of a user's evaluations, newest first (no JSON parsed)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT portrait_id, created_at FROM evaluations WHERE user_id = ? "
+                "ORDER BY created_at DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+
+    def latest(self, user_id: str):
+        portraits = self.list_portraits(user_id, 1)
+        return portraits[0][0] if portraits else None
+
+
+class SessionStore:
+    """Conversations in SQLite: one row per session plus its messages by sequence number."""
+
+    SESSION_FIELDS = (
+        "user_id", "conversation_started", "resolved_model", "portrait_id",
+        "qa_scores_json", "log_id", "conversation_state",
+    )
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                user_id TEXT,
+                conversation_started INTEGER NOT NULL DEFAULT 0,
+                resolved_model TEXT,
+                portrait_id TEXT,
+                qa_scores_json TEXT,
+                log_id TEXT,
+                conversation_state TEXT
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                extra TEXT,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID;
+        """)
+        self._lock = threading.Lock()
+
+    def save(self, session_id: str, fields: dict, messages: list = (),
+             start_seq: int = 0, replace: bool = False) -> None:
+        """Append `messages` from sequence number `start_seq` and update `fields`.
+        `replace` first drops every stored message (a new or loaded conversation)."""
+        now = time.time()
+        columns = [name for name in self.SESSION_FIELDS if name in fields]
+        rows = []
+        for seq, m in enumerate(messages, start=start_seq):
+            extra = {k: m[k] for k in ("intent", "confidence") if k in m}
+            rows.append((session_id, seq, m["role"], m["content"],
+                         json.dumps(extra) if extra else None))
+        with self._lock, self._db:
+            if replace:
+                self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.execute(
+                f"INSERT INTO sessions (session_id, created_at, updated_at"
+                f"{''.join(', ' + c for c in columns)}) "
+                f"VALUES (?, ?, ?{', ?' * len(columns)}) "
+                f"ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at"
+                f"{''.join(f', {c} = excluded.{c}' for c in columns)}",
+                (session_id, now, now, *(fields[c] for c in columns)),
+            )
+
+    def load(self, session_id: str):
+        """The session row as a dict, or None."""
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT * FROM sessions WHERE session_id = ?", (session_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def load_messages(self, session_id: str, before: int = None, limit: int = None) -> tuple:
+        """(messages, first_seq): up to `limit` messages before sequence number `before`
+        (default: the newest), oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, role, content, extra FROM messages "
+                "WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (session_id, before if before is not None else 2 ** 62,
+                 limit if limit is not None else -1),
+            ).fetchall()
+        rows.reverse()
+        messages = []
+        for _, role, content, extra in rows:
+            message = {"role": role, "content": content}
+            if extra:
+                message.update(json.loads(extra))
+            messages.append(message)
+        return messages, rows[0][0] if rows else (before or 0)
+
+    def count_shown(self, session_id: str, before: int, hidden_prefix: str) -> int:
+        """Messages before sequence number `before` the chat shows (no user messages
+        starting with `hidden_prefix`)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM messages WHERE session_id = ? AND seq < ? "
+                "AND (role = 'assistant' OR (role = 'user' AND substr(content, 1, ?) != ?))",
+                (session_id, before, len(hidden_prefix), hidden_prefix),
+            ).fetchone()[0]
+
+
+class SessionActivity:
+    """Last activity per live session; sessions idle for `idle_s` are woken to drop
+    their conversation from memory."""
+
+    def __init__(self, idle_s: float):
+        self.idle_s = idle_s
+        self._lock = threading.Lock()
+        self._sessions = {}  # app session id -> [Streamlit session id, last active]
+        self._evict = set()
+
+    def touch(self, session_id: str, runtime_session_id: str) -> None:
+        with self._lock:
+            self._sessions[session_id] = [runtime_session_id, time.time()]
+
+    def forget(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def active(self, within_s: float) -> int:
+        """Sessions used within the last `within_s` seconds."""
+        cutoff = time.time() - within_s
+        with self._lock:
+            return sum(1 for _, last in self._sessions.values() if last >= cutoff)
+
+    def take_eviction(self, session_id: str) -> bool:
+        with self._lock:
+            if session_id in self._evict:
+                self._evict.discard(session_id)
+                self._sessions.pop(session_id, None)
+                return True
+            return False
+
+    def sweep(self) -> None:
+        cutoff = time.time() - self.idle_s
+        with self._lock:
+            idle = [
+                (session_id, runtime_session_id)
+                for session_id, (runtime_session_id, last) in self._sessions.items()
+                if last < cutoff and session_id not in self._evict
+            ]
+        for session_id, runtime_session_id in idle:
+            with self._lock:
+                self._evict.add(session_id)
+            if not request_session_rerun(runtime_session_id):
+                # Gone (Streamlit drops disconnected sessions itself).
+                with self._lock:
+                    self._evict.discard(session_id)
+                    self._sessions.pop(session_id, None)
+
+    def start(self, interval_s: float) -> None:
+        def sweep_forever():
+            while True:
+                time.sleep(interval_s)
+                self.sweep()
+
+        threading.Thread(target=sweep_forever, daemon=True).start()
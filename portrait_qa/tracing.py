@@ -0,0 +1,143 @@
+"""Per-turn spans and their export to an OpenTelemetry collector."""
+from contextlib import contextmanager
+import json
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+
+class Trace:
+    """Spans of one turn, kept JSON-ready in `data` (log_entry["trace"]); offsets in ms."""
+
+    def __init__(self, name: str = "turn"):
+        self._t0 = time.perf_counter()
+        self.data = {"trace_id": uuid.uuid4().hex, "start_unix_ns": time.time_ns(), "spans": []}
+        self.root = None
+        self.root = self.begin(name)
+
+    def _ms(self, t: float) -> float:
+        return round((t - self._t0) * 1000, 2)
+
+    def begin(self, name: str, parent: dict = None, **attributes) -> dict:
+        parent = parent or self.root
+        span = {
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": parent["span_id"] if parent else None,
+            "name": name,
+            "start_ms": self._ms(time.perf_counter()),
+            "duration_ms": None,
+            "attributes": attributes,
+        }
+        self.data["spans"].append(span)
+        return span
+
+    def end(self, span: dict, **attributes) -> None:
+        span["duration_ms"] = round(self._ms(time.perf_counter()) - span["start_ms"], 2)
+        span["attributes"].update(attributes)
+
+    def add(self, name: str, start: float, end: float, parent: dict = None, **attributes) -> dict:
+        """A finished span from two time.perf_counter() readings."""
+        span = self.begin(name, parent, **attributes)
+        span["start_ms"] = self._ms(start)
+        span["duration_ms"] = round((end - start) * 1000, 2)
+        return span
+
+    @contextmanager
+    def span(self, name: str, parent: dict = None, **attributes):
+        span = self.begin(name, parent, **attributes)
+        try:
+            yield span
+        finally:
+            self.end(span)
+
+    def finish(self) -> None:
+        """End (or extend) the root span at the current time."""
+        self.end(self.root)
+
+
+def otlp_attributes(attributes: dict) -> list:
+    values = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            values.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            values.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            values.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            values.append({"key": key, "value": {"stringValue": str(value)}})
+    return values
+
+
+def trace_to_otlp(trace: dict) -> list:
+    """OTLP/JSON spans for one log_entry["trace"]."""
+    spans = []
+    for span in trace["spans"]:
+        start = trace["start_unix_ns"] + int(span["start_ms"] * 1e6)
+        duration = span["duration_ms"] or 0.0
+        otlp = {
+            "traceId": trace["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 3 if span["name"] == "attempt" else 1,  # CLIENT / INTERNAL
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(start + int(duration * 1e6)),
+            "attributes": otlp_attributes(span["attributes"]),
+        }
+        if span["parent_id"]:
+            otlp["parentSpanId"] = span["parent_id"]
+        if span["attributes"].get("error"):
+            otlp["status"] = {"code": 2, "message": str(span["attributes"]["error"])}
+        spans.append(otlp)
+    return spans
+
+
+class OtlpTraceExporter:
+    """Posts finished traces to an OTLP/HTTP collector in batches; drops them if it is away."""
+
+    def __init__(self, endpoint: str, service_name: str, batch_size: int, interval_s: float,
+                 max_queue: int = 1000):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval_s = interval_s
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.exported = 0
+        self.dropped = 0
+        threading.Thread(target=self._run, name="otlp-exporter", daemon=True).start()
+
+    def export(self, trace: dict) -> None:
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval_s
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            body = json.dumps({"resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "portrait-qa.pipeline"},
+                    "spans": [span for trace in batch for span in trace_to_otlp(trace)],
+                }],
+            }]}).encode("utf-8")
+            request = urllib.request.Request(
+                self.endpoint, data=body, headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request, timeout=5):
+                    pass
+                self.exported += len(batch)
+            except (OSError, urllib.error.URLError):
+                self.dropped += len(batch)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+import streamlit.logger
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+streamlit.logger.set_log_level("error")  # no ScriptRunContext warnings outside `streamlit run`
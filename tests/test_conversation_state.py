@@ -0,0 +1,67 @@
+import app
+
+QA = app.DEFAULT_QA_SCORES_JSON
+
+CONVERSATION = [
+    {"role": "assistant", "content": "Hallo! Deine Bewertung ist fertig. Was möchtest du wissen?"},
+    {"role": "user", "content": "Warum sind meine Proportionen so schlecht bewertet?"},
+    {"role": "assistant", "content": "Die Proportionen des Gesichts sind etwas verschoben. "
+                                     "Möchtest du wissen, wie du das übst?"},
+    {"role": "user", "content": "Wer bist du eigentlich?"},
+    {"role": "assistant", "content": "Ich bin Curaay und habe dein Porträt bewertet."},
+    {"role": "user", "content": "Hast du Fußball gesehen?"},
+    {"role": "assistant", "content": app.OFF_TOPIC_VARIANTS[3][1]},
+    {"role": "user", "content": "Und das Licht?"},
+    {"role": "assistant", "content": "Die Schatten am Hals sind zu hart."},
+]
+
+
+def test_update_tracks_language_follow_ups_variants_and_categories():
+    state = app.ConversationState.from_messages(CONVERSATION, QA)
+    assert state.to_dict() == {
+        "messages_seen": 9,
+        "language": "de",
+        "follow_ups_used": 2,  # the identity answer and the off-topic variant do not count
+        "off_topic_variants_used": [3],
+        "categories_discussed": ["Proportions and Anatomy", "Use of Light and Shadow"],
+    }
+
+
+def test_new_evaluation_event_clears_discussed_categories_but_keeps_language():
+    state = app.ConversationState.from_messages(CONVERSATION, QA)
+    state.update({"role": "user", "content": app.EVALUATION_READY_EVENT})
+    assert state.categories_discussed == [] and state.language == "de"
+
+
+def test_sync_folds_in_only_new_messages():
+    state = app.ConversationState.from_messages(CONVERSATION[:5], QA)
+    state.sync(CONVERSATION)
+    assert state.to_dict() == app.ConversationState.from_messages(CONVERSATION, QA).to_dict()
+
+
+def test_sync_starts_over_when_the_history_was_edited():
+    state = app.ConversationState.from_messages(CONVERSATION, QA)
+    edited = CONVERSATION[:4] + [{"role": "assistant", "content": "Ich bin Curaay."}]
+    state.sync(edited)
+    assert state.to_dict() == app.ConversationState.from_messages(edited, QA).to_dict()
+    state.sync(CONVERSATION[:3])  # shorter than what was seen
+    assert state.messages_seen == 3 and state.follow_ups_used == 1
+
+
+def test_sync_with_offset_continues_a_resumed_session():
+    state = app.ConversationState.from_messages(CONVERSATION[:7], QA)
+    loaded = CONVERSATION[4:]  # the 4 oldest messages are not loaded
+    state.sync(loaded, offset=4)
+    assert state.to_dict() == app.ConversationState.from_messages(CONVERSATION, QA).to_dict()
+
+
+def test_snapshot_round_trip_continues_like_the_original():
+    original = app.ConversationState.from_messages(CONVERSATION[:6], QA)  # user message pending
+    restored = app.ConversationState.from_snapshot(original.snapshot())
+    assert restored.snapshot() == original.snapshot()
+    for message in CONVERSATION[6:]:
+        original.update(message)
+        restored.update(message)
+    assert restored.to_dict() == original.to_dict()
+    restored.sync(CONVERSATION)  # nothing new
+    assert restored.messages_seen == len(CONVERSATION)
@@ -0,0 +1,77 @@
+import app
+
+
+class Catalog:
+    """Stand-in for DeploymentCatalog: deployment -> model as listed by the resource."""
+
+    def __init__(self, models: dict):
+        self._models = models
+
+    def models(self, endpoint: str) -> dict:
+        return dict(self._models)
+
+
+def profiles(models: dict = None) -> app.DeploymentProfiles:
+    return app.DeploymentProfiles(app.DEPLOYMENT_PROFILES, Catalog(models or {}))
+
+
+def rejected(message: str) -> dict:
+    return {"status": 400, "message": message}
+
+
+def test_profile_by_name_deployment_model_and_default():
+    deployments = profiles({"my-reasoner": "gpt-5-mini"})
+    assert deployments.get("gpt-4o")["source"] == "configured"
+    assert deployments.get("gpt-5-mini-eu")["reasoning_effort"] == "minimal"
+    assert deployments.get("gpt-5-mini-eu")["source"] == "name"
+    assert deployments.get("my-reasoner")["reasoning_effort"] == "minimal"
+    assert deployments.get("my-reasoner")["source"] == "deployment model"
+    assert deployments.get("custom")["source"] == "default"
+
+
+def test_completion_params_for_non_reasoning_and_reasoning_models():
+    deployments = profiles()
+    assert app.completion_params(deployments.get("gpt-4o"), 0.2) == {
+        "max_tokens": app.RESPONSE_MAX_TOKENS,
+        "temperature": 0.2,
+        "stream_options": {"include_usage": True},
+    }
+    assert app.completion_params(deployments.get("gpt-5"), 0.2, 100) == {
+        "max_completion_tokens": 100 + app.REASONING_TOKEN_ALLOWANCE["minimal"],
+        "reasoning_effort": "minimal",
+        "stream_options": {"include_usage": True},
+    }
+    assert app.completion_params(deployments.get("gpt-5.4"), 0.2) == {
+        "max_completion_tokens": app.RESPONSE_MAX_TOKENS,
+        "reasoning_effort": "none",
+        "stream_options": {"include_usage": True},
+    }
+
+
+def test_learn_corrects_the_parameter_named_in_a_400():
+    deployments = profiles()
+    assert deployments.learn("gpt-4o", rejected(
+        "Unsupported parameter: 'max_tokens' is not supported with this model. "
+        "Use 'max_completion_tokens' instead."))
+    assert deployments.learn("gpt-4o", rejected("Unsupported value: 'temperature' does not support 0.2"))
+    assert deployments.learn("gpt-4o", rejected("Unrecognized request argument: stream_options"))
+    profile = deployments.get("gpt-4o")
+    assert profile["source"] == "learned"
+    assert app.completion_params(profile, 0.2) == {"max_completion_tokens": app.RESPONSE_MAX_TOKENS}
+
+
+def test_learn_steps_reasoning_effort_up_then_drops_it():
+    deployments = profiles()
+    assert deployments.learn("gpt-5.2", rejected(
+        "Unsupported value: 'reasoning_effort' does not support 'none' with this model."))
+    assert deployments.get("gpt-5.2")["reasoning_effort"] == "minimal"
+    assert deployments.learn("gpt-5.2", rejected("Unknown parameter: 'reasoning_effort'."))
+    assert deployments.get("gpt-5.2")["reasoning_effort"] is None
+
+
+def test_learn_ignores_other_errors():
+    deployments = profiles()
+    assert not deployments.learn("gpt-4o", {"status": 429, "message": "temperature"})
+    assert not deployments.learn("gpt-4o", rejected("The prompt is too long"))
+    assert not deployments.learn("gpt-5", rejected("'temperature' is not supported"))  # already off
+    assert deployments.get("gpt-4o")["source"] == "configured"
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+import app
+
+MESSAGES = [
+    {"role": "assistant", "content": "Hallo!"},
+    {"role": "user", "content": "Wie war mein Licht?", "intent": "A", "confidence": 0.9},
+    {"role": "assistant", "content": "Sehr gut."},
+]
+STATE = {"language": "de", "follow_ups_used": 1}
+
+
+def test_json_export_is_the_plain_message_array():
+    exported = json.loads(app.get_download_conversation_json(MESSAGES))
+    assert exported == MESSAGES
+
+
+def test_both_export_shapes_load_back():
+    plain = app.get_download_conversation_json(MESSAGES)
+    wrapped = app.get_download_conversation_json(MESSAGES, STATE)
+    assert json.loads(wrapped) == {"messages": MESSAGES, "conversation_state": STATE}
+    assert app.parse_conversation_json(plain) == MESSAGES
+    assert app.parse_conversation_json(wrapped) == MESSAGES
+
+
+def test_parse_keeps_only_chat_messages():
+    loaded = [{"role": "system", "content": "prompt"}, *MESSAGES, {"role": "tool", "content": "x"}]
+    assert app.parse_conversation_json(json.dumps(loaded)) == MESSAGES
+
+
+@pytest.mark.parametrize("text", ["[]", "{}", '{"messages": []}', '[{"role": "system", "content": "x"}]'])
+def test_parse_rejects_conversations_without_messages(text):
+    with pytest.raises(ValueError):
+        app.parse_conversation_json(text)
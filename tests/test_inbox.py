@@ -0,0 +1,66 @@
+import http.client
+import json
+
+import pytest
+
+from portrait_qa.inbox import EvaluationInbox, missing_rerun_internals, parse_evaluation_payload
+
+EVALUATION = {"Overall Impact": {"score": 7, "feedback": "Strong."}}
+
+
+class MemoryStore:
+    def __init__(self):
+        self.saved = []
+
+    def put(self, user_id, portrait_id, qa_scores_json):
+        self.saved.append((user_id, portrait_id, qa_scores_json))
+
+
+def test_installed_streamlit_has_the_rerun_internals():
+    # A Streamlit upgrade that drops them would make sessions poll instead of being woken.
+    assert missing_rerun_internals() == []
+
+
+def test_parse_evaluation_payload():
+    assert parse_evaluation_payload(EVALUATION) == (EVALUATION, None, None)
+    wrapped = {"qa_scores_json": EVALUATION, "user_id": "u1", "portrait_id": "p1"}
+    assert parse_evaluation_payload(wrapped) == (EVALUATION, "u1", "p1")
+    for bad in (None, [], {}, {"qa_scores_json": EVALUATION, "user_id": ""}):
+        with pytest.raises(ValueError):
+            parse_evaluation_payload(bad)
+
+
+@pytest.fixture
+def inbox():
+    inbox = EvaluationInbox(10, MemoryStore())
+    inbox.serve_http("127.0.0.1", 0, max_body_bytes=1024)
+    return inbox
+
+
+def post(inbox, path: str, body: bytes = None, headers: dict = None) -> tuple:
+    port = int(inbox.http_endpoint.split(":")[2].split("/")[0])
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.putrequest("POST", path)
+    for name, value in (headers or {}).items():
+        connection.putheader(name, value)
+    connection.endheaders(body)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_ingest_delivers_and_stores(inbox):
+    body = json.dumps({"qa_scores_json": EVALUATION, "user_id": "u1", "portrait_id": "p1"}).encode()
+    status, reply = post(inbox, "/evaluations/s1", body, {"Content-Length": str(len(body))})
+    assert (status, reply) == (202, {"session_id": "s1", "session_woken": False})
+    assert inbox.take("s1") == {"qa_scores_json": EVALUATION, "portrait_id": "p1"}
+    assert inbox.store.saved == [("u1", "p1", EVALUATION)]
+
+
+@pytest.mark.parametrize("length, status", [
+    (None, 411), ("abc", 400), ("-1", 400), ("1025", 413), ("4", 400),
+])
+def test_ingest_rejects_bad_requests(inbox, length, status):
+    headers = {} if length is None else {"Content-Length": length}
+    body = b"null" if length == "4" else None
+    assert post(inbox, "/evaluations/s1", body, headers)[0] == status
+    assert not inbox.has_pending("s1")
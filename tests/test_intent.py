@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import app
+
+QA = app.DEFAULT_QA_SCORES_JSON
+GREETING = [{"role": "assistant", "content": "Hallo! Deine Bewertung ist fertig."}]
+
+
+@pytest.mark.parametrize("text, intent", [
+    ("Why is my proportion score so low?", "A"),
+    ("Чому така низька оцінка за пропорції?", "A"),
+    ("Was soll ich verbessern?", "B"),
+    ("Is my portrait good?", "C"),
+    ("Who won the football match yesterday?", "D"),
+    ("Ich mag Pizza sehr gern, und du auch?", "D"),
+    ("Tell me more", "E"),
+    ("Wer bist du?", "F"),
+    ("Are you an AI?", "F"),
+])
+def test_classify_intent(text, intent):
+    assert app.classify_intent(text)[0] == intent
+
+
+def test_unclear_messages_and_app_events():
+    assert app.classify_intent("ok") == ("E", 0.5)
+    assert app.classify_intent(app.EVALUATION_READY_EVENT) == (None, 0.0)
+
+
+def test_fast_reply_rotates_variants_in_the_users_language():
+    state = app.ConversationState.from_messages(GREETING, QA)
+    state.update({"role": "user", "content": "Hast du gestern Fußball gesehen?"})
+    assert state.language == "de"
+    used = []
+    for _ in app.OFF_TOPIC_VARIANTS:
+        number, text = app.off_topic_fast_reply(state)
+        assert text == app.OFF_TOPIC_VARIANTS[number][app.VARIANT_LANGUAGES.index("de")]
+        used.append(number)
+        state.update({"role": "assistant", "content": text})
+    assert used == list(app.OFF_TOPIC_VARIANTS)
+    assert app.off_topic_fast_reply(state) is None
+
+    state = app.ConversationState.from_messages(GREETING, QA)  # nothing written yet: English
+    assert app.off_topic_fast_reply(state) == (1, app.OFF_TOPIC_VARIANTS[1][0])
+
+
+def test_answer_off_topic_locally_logs_the_fast_path():
+    messages = GREETING + [{"role": "user", "content": "Чи бачив ти вчора футбол?"}]
+    state = app.ConversationState.from_messages(messages, QA)
+    state.off_topic_variants = [1]
+    chunks, log_entry = app.answer_off_topic_locally(messages, "gpt-4o", state, 0.9)
+
+    async def collect():
+        return "".join([piece async for piece in chunks])
+
+    text = asyncio.run(collect())
+    assert text == app.OFF_TOPIC_VARIANTS[2][2] == log_entry["assistant_response"]
+    assert log_entry["intent"] == {"type": "D", "confidence": 0.9, "fast_path": True}
+    assert log_entry["deployment_used"] is None and log_entry["error"] is None
+    assert log_entry["steps"][0]["variant"] == 2 and log_entry["steps"][0]["language"] == "uk"
+
+    state.off_topic_variants = list(app.OFF_TOPIC_VARIANTS)
+    assert app.answer_off_topic_locally(messages, "gpt-4o", state, 0.9) is None
+
+
+def test_off_topic_turn_is_answered_without_azure():
+    messages = GREETING + [{"role": "user", "content": "Who won the football match yesterday?"}]
+    response, log_entry = app.process_user_message(QA, messages, "gpt-4o")
+    assert response == app.OFF_TOPIC_VARIANTS[1][0]
+    assert log_entry["intent"]["fast_path"] and log_entry["deployment_used"] is None
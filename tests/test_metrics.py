@@ -0,0 +1,69 @@
+import re
+
+from portrait_qa.metrics import MetricsRegistry, prometheus_labels, sample_quantile
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def registry() -> MetricsRegistry:
+    metrics = MetricsRegistry(1000, QUANTILES, "pqa", 300)
+    for ms in range(1, 101):  # 1..100 ms
+        metrics.record_request("gpt-4o", "ok", ms / 1000, ms / 100)
+    metrics.record_request("gpt-4o", "rate_limited")
+    metrics.record_request("gpt-4o", "rate_limited")
+    metrics.record_request("gpt-4o", "server_error")
+    metrics.record_turn("turn", "model", 1.5)
+    metrics.record_turn("turn", "error", 0.5)
+    return metrics
+
+
+def test_quantiles_of_a_known_sample():
+    samples = [ms / 1000 for ms in range(100, 0, -1)]
+    assert [sample_quantile(samples, q) for q in QUANTILES] == [0.051, 0.096, 0.1]
+    assert sample_quantile([], 0.5) is None
+
+    row = registry().snapshot()["deployments"][0]
+    assert (row["ttft_p50_ms"], row["ttft_p95_ms"], row["ttft_p99_ms"]) == (51, 96, 100)
+    assert (row["total_p50_ms"], row["total_p99_ms"]) == (510, 1000)
+
+
+def test_snapshot_counts_errors_and_429s():
+    snapshot = registry().snapshot()
+    row = snapshot["deployments"][0]
+    assert (row["requests"], row["errors"], row["rate_limited_429"]) == (103, 3, 2)
+    assert row["error_rate"] == round(3 / 103, 3)
+    assert snapshot["turns"] == [{
+        "priority": "turn", "turns": 2, "model": 1, "cached": 0, "local": 0,
+        "speculation": 0, "error": 1,
+        "total_p50_ms": 1500, "total_p95_ms": 1500, "total_p99_ms": 1500,
+    }]
+    assert snapshot["gauges"] == {"in_flight": 0, "max_in_flight": 0, "queued": 0,
+                                  "active_sessions": 0}
+
+
+def test_prometheus_exposition_format():
+    text = registry().prometheus_text()
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    sample = re.compile(r'^[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? -?[0-9.e+]+$')
+    for line in lines:
+        assert line.startswith(("# HELP pqa_", "# TYPE pqa_")) or sample.match(line), line
+    assert "# TYPE pqa_azure_requests_total counter" in lines
+    assert "# TYPE pqa_azure_ttft_seconds summary" in lines
+    assert 'pqa_azure_requests_total{deployment="gpt-4o",outcome="ok"} 100' in lines
+    assert 'pqa_azure_requests_total{deployment="gpt-4o",outcome="rate_limited"} 2' in lines
+    assert 'pqa_azure_requests_total{deployment="gpt-4o",outcome="server_error"} 1' in lines
+    assert 'pqa_azure_ttft_seconds{deployment="gpt-4o",quantile="0.5"} 0.051000' in lines
+    assert 'pqa_azure_ttft_seconds{deployment="gpt-4o",quantile="0.99"} 0.100000' in lines
+    assert 'pqa_azure_ttft_seconds_sum{deployment="gpt-4o"} 5.050000' in lines
+    assert 'pqa_azure_ttft_seconds_count{deployment="gpt-4o"} 100' in lines
+    assert 'pqa_turns_total{priority="turn",outcome="error"} 1' in lines
+    assert "pqa_active_sessions 0" in lines
+    # Every family is declared once, before its samples.
+    types = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert len(types) == len(set(types))
+
+
+def test_label_values_are_escaped():
+    assert prometheus_labels(deployment='my "gpt"\\\n') == '{deployment="my \\"gpt\\"\\\\\\n"}'
+    assert prometheus_labels() == ""
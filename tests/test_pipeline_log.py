@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from portrait_qa.stores import PipelineLogStore, fill_prompt_template
+
+TEMPLATE = "Instructions.\n### History\n{conversation_history}\n### Input\n{qa_scores_json}"
+QA_JSON = json.dumps({"Overall Impact": {"score": 7, "feedback": "Strong."}})
+
+
+def log_entry(messages: list, sent: int, history: str) -> dict:
+    """A process_user_message log entry whose request carried the last `sent` messages."""
+    parts = {"template": TEMPLATE, "conversation_history": history, "qa_scores_json": QA_JSON}
+    return {
+        "model": "gpt-4o",
+        "usage": {"prompt_tokens": 120, "cached_tokens": 64},
+        "assistant_response": "reply",
+        "steps": [{
+            "step": "portrait_qa",
+            "prompt_parts": parts,
+            "system_prompt": fill_prompt_template(TEMPLATE, history, QA_JSON),
+            "conversation_messages": messages[-sent:],
+            "response": "reply",
+        }],
+    }
+
+
+def expected(entry: dict) -> dict:
+    steps = [{k: v for k, v in step.items() if k != "prompt_parts"} for step in entry["steps"]]
+    return {**entry, "steps": steps}
+
+
+def digest(turn: int) -> str:
+    """A history slot like the compact mode's: a state line, then one line per older message."""
+    lines = [f"State: turn {turn}.", "Earlier turns, condensed:"]
+    lines += [f"#{i + 1} user: question {i}" for i in range(turn)]
+    return "\n".join(lines)
+
+
+def conversation(turns: int) -> list:
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "assistant", "content": f"answer {i}"})
+        messages.append({"role": "user", "content": f"question {i}"})
+    return messages
+
+
+def test_reconstruct_round_trips_every_turn(tmp_path):
+    store = PipelineLogStore(str(tmp_path), "conv", memory_tail=2)
+    entries = []
+    for turn in range(1, 5):
+        messages = conversation(turn)
+        entry = log_entry(messages, sent=min(3, len(messages)), history=f"{turn - 1} older turns")
+        store.append(entry, messages)
+        entries.append(entry)
+
+    assert len(store) == 4
+    assert [r["turn"] for r in store.tail()] == [3, 4]
+    for turn, entry in enumerate(entries, start=1):
+        assert store.reconstruct(turn) == expected(entry)
+    assert list(store.iter_full_entries()) == [expected(e) for e in entries]
+
+
+def test_blobs_are_written_once_and_history_resets_on_divergence(tmp_path):
+    store = PipelineLogStore(str(tmp_path), "conv", memory_tail=5)
+    first = conversation(2)
+    store.append(log_entry(first, sent=4, history="h1"), first)
+    loaded = [{"role": "user", "content": "a loaded conversation"}]
+    store.append(log_entry(loaded, sent=1, history="h2"), loaded)
+
+    records = list(store.iter_records())
+    assert sum(r["kind"] == "blob" for r in records) == 2  # template and evaluation
+    resets = [r["reset"] for r in records if r["kind"] == "messages"]
+    assert resets == [False, True]
+    assert store.reconstruct(2)["steps"][0]["conversation_messages"] == loaded
+
+
+def test_resume_continues_the_log(tmp_path):
+    store = PipelineLogStore(str(tmp_path), "conv", memory_tail=5)
+    messages = conversation(1)
+    store.append(log_entry(messages, sent=2, history="h1"), messages)
+
+    resumed = PipelineLogStore.resume(str(tmp_path), "conv", memory_tail=5)
+    assert len(resumed) == 1
+    assert resumed.usage_totals == store.usage_totals
+    messages = conversation(2)
+    entry = log_entry(messages, sent=2, history="h2")
+    resumed.append(entry, messages)
+
+    records = list(resumed.iter_records())
+    assert sum(r["kind"] == "blob" for r in records) == 2
+    assert [r["reset"] for r in records if r["kind"] == "messages"] == [False, False]
+    assert resumed.reconstruct(2) == expected(entry)
+
+
+def test_turn_records_hold_only_the_history_lines_that_changed(tmp_path):
+    store = PipelineLogStore(str(tmp_path), "conv", memory_tail=5)
+    entries = []
+    for turn in range(1, 41):
+        messages = conversation(turn)
+        entry = log_entry(messages, sent=2, history=digest(turn))
+        store.append(entry, messages)
+        entries.append(entry)
+        if turn == 20:
+            store = PipelineLogStore.resume(str(tmp_path), "conv", memory_tail=5)
+
+    turns = [r for r in store.iter_records() if r["kind"] == "turn"]
+    step = turns[-1]["steps"][0]
+    assert "response" not in step and step["shared"] == ["response"]
+    added = [line for op in step["prompt"]["history_delta"] if isinstance(op, dict)
+             for line in op["lines"]]
+    assert added == ["State: turn 40.", "#40 user: question 39"]
+    sizes = [len(json.dumps(r["steps"])) for r in turns]
+    assert sizes[-1] == sizes[10]
+    assert list(store.iter_full_entries()) == [expected(e) for e in entries]
+
+
+def test_reconstruct_unknown_turn_raises(tmp_path):
+    store = PipelineLogStore(str(tmp_path), "conv", memory_tail=5)
+    with pytest.raises(KeyError):
+        store.reconstruct(1)
@@ -0,0 +1,57 @@
+import app
+
+QA = app.DEFAULT_QA_SCORES_JSON
+
+
+def conversation(turns: int, words: int = 60) -> list:
+    messages = [{"role": "assistant", "content": "Hallo! Deine Bewertung ist fertig."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Frage {i}: " + "Schatten " * words})
+        messages.append({"role": "assistant", "content": f"Antwort {i}: " + "Licht " * words})
+    messages.append({"role": "user", "content": "Und was jetzt?"})
+    return messages
+
+
+def test_prompt_within_the_limit_is_left_alone():
+    messages = conversation(3)
+    built, tokens, guard = app.fit_prompt_to_limit(QA, messages, 10 ** 6)
+    assert guard == {"limit": 10 ** 6, "history_mode": app.PROMPT_HISTORY_MODE,
+                     "actions": [], "fits": True}
+    assert built == app.build_prompt_messages(QA, messages)
+    assert tokens["total"] == app.prompt_token_breakdown(built[2], built[1])["total"]
+
+
+def test_history_is_compacted_until_the_prompt_fits():
+    messages = conversation(80)
+    full = app.fit_prompt_to_limit(QA, messages, 10 ** 6)[1]["total"]
+    minimal = app.build_prompt_messages(QA, messages, "compact", app.MIN_HISTORY_TOKEN_BUDGET, 0)
+    floor = app.prompt_token_breakdown(minimal[2], minimal[1])["total"]
+
+    built, tokens, guard = app.fit_prompt_to_limit(QA, messages, (full + floor) // 2)
+    assert guard["fits"] and tokens["total"] < full
+    assert [a.split("=")[0] for a in guard["actions"]] == ["digest_lines"] * len(guard["actions"])
+
+    built, tokens, guard = app.fit_prompt_to_limit(QA, messages, floor)
+    assert guard["fits"] and tokens["total"] == floor
+    assert "digest_lines=0" in guard["actions"]
+    assert guard["actions"][-1] == f"history_token_budget={app.MIN_HISTORY_TOKEN_BUDGET}"
+    kinds = [action.split("=")[0] for action in guard["actions"]]
+    assert kinds == sorted(kinds, key=["digest_lines", "history_token_budget"].index)
+    chat = built[1]
+    assert chat[-1] == {"role": "user", "content": "Und was jetzt?"}
+    assert chat == [{"role": m["role"], "content": m["content"]} for m in messages[-len(chat):]]
+
+
+def test_full_history_mode_switches_to_compact_first(monkeypatch):
+    monkeypatch.setattr(app, "PROMPT_HISTORY_MODE", "full")
+    messages = conversation(20)
+    full = app.fit_prompt_to_limit(QA, messages, 10 ** 6)[1]["total"]
+    built, tokens, guard = app.fit_prompt_to_limit(QA, messages, full - 1)
+    assert guard["actions"][0] == "history_mode=compact"
+    assert guard["history_mode"] == "compact" and guard["fits"]
+
+
+def test_unreachable_limit_reports_that_it_does_not_fit():
+    built, tokens, guard = app.fit_prompt_to_limit(QA, conversation(10), 10)
+    assert not guard["fits"]
+    assert guard["actions"][-1] == f"history_token_budget={app.MIN_HISTORY_TOKEN_BUDGET}"
@@ -0,0 +1,50 @@
+import os
+import time
+
+from portrait_qa.stores import ResponseCache
+
+MESSAGES = [{"role": "system", "content": "prompt"}, {"role": "user", "content": "Hi"}]
+
+
+def test_response_cache_key_covers_the_request():
+    params = {"temperature": 0.2, "max_tokens": 800}
+    key = ResponseCache.make_key("gpt-4o", MESSAGES, params)
+    assert key == ResponseCache.make_key(
+        "gpt-4o", MESSAGES,
+        {"max_tokens": 800, "temperature": 0.2, "stream_options": {"include_usage": True}})
+    assert key != ResponseCache.make_key("gpt-5-mini", MESSAGES, params)
+    assert key != ResponseCache.make_key("gpt-4o", MESSAGES[:1], params)
+    assert key != ResponseCache.make_key("gpt-4o", MESSAGES, {**params, "temperature": 0.0})
+
+
+def test_response_cache_memory_lru_falls_back_to_disk(tmp_path):
+    cache = ResponseCache(str(tmp_path), memory_entries=2, max_disk_bytes=10 ** 6)
+    for name in ("a", "b", "c"):
+        cache.put(name * 64, f"reply {name}", ttl_s=60)
+
+    assert cache.get("c" * 64) == ("reply c", "memory")
+    assert cache.get("a" * 64) == ("reply a", "disk")  # evicted from memory, not from disk
+    assert cache.get("a" * 64) == ("reply a", "memory")
+    assert cache.get("d" * 64) == (None, None)
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (2, 1, 1)
+    assert stats["memory_entries"] == 2
+
+
+def test_response_cache_expires_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path), memory_entries=2, max_disk_bytes=10 ** 6)
+    cache.put("e" * 64, "stale", ttl_s=-1)
+    assert cache.get("e" * 64) == (None, None)
+
+
+def test_response_cache_evicts_oldest_files_beyond_the_disk_limit(tmp_path):
+    cache = ResponseCache(str(tmp_path), memory_entries=1, max_disk_bytes=1000)
+    keys = [f"{i:02d}" * 32 for i in range(10)]
+    for i, key in enumerate(keys):
+        cache.put(key, "x" * 200, ttl_s=60)
+        os.utime(cache._path(key), (time.time() - 100 + i, time.time() - 100 + i))
+
+    files = [name for _, _, names in os.walk(tmp_path) for name in names]
+    assert 0 < len(files) < len(keys)
+    assert f"{keys[-1]}.json" in files
+    assert f"{keys[0]}.json" not in files
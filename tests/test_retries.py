@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+import app
+from benchmarks.mock_azure import MockAzureServer
+
+FAST = {"ttft_s": 0.0, "tokens_per_second": 0, "reply": "Antwort.", "retry_after_s": 0.2}
+MESSAGES = [{"role": "system", "content": "Test."}, {"role": "user", "content": "Hallo"}]
+
+
+@pytest.fixture(scope="module")
+def server():
+    # Separate deployments per test: a 429 pauses its deployment in the shared limiter.
+    names = ["gpt-4o-r429", "gpt-4o-r5xx", "gpt-4o-r400", "gpt-4o-rlong", "gpt-4o-fallback"]
+    profiles = {name: FAST for name in names}
+    profiles["gpt-4o-rlong"] = {**FAST, "retry_after_s": 60}
+    with MockAzureServer(profiles) as server:
+        yield server
+
+
+@pytest.fixture
+def azure(server, monkeypatch):
+    monkeypatch.setattr(app, "AZURE_ENDPOINT", server.endpoint)
+    monkeypatch.setattr(app, "AZURE_API_KEY", "test-key")
+    server.reset_stats()
+    return server
+
+
+def stream(model: str, fallbacks: list) -> tuple:
+    stats = {}
+
+    async def collect():
+        chunks = app.stream_azure_api_async(MESSAGES, model, stats=stats, fallbacks=fallbacks)
+        return "".join([piece async for piece in chunks])
+
+    return app.run_async(collect()), stats
+
+
+def statuses(server) -> list:
+    return [(r["deployment"], r["status"]) for r in server.requests]
+
+
+def test_429_is_retried_after_retry_after(azure):
+    azure.fail_next(1, 429)
+    started = time.perf_counter()
+    text, stats = stream("gpt-4o-r429", ["gpt-4o-fallback"])
+    assert text == "Antwort." and stats["error"] is None
+    assert stats["deployment"] == "gpt-4o-r429"
+    assert time.perf_counter() - started >= 0.2
+    [attempt] = stats["attempts"]
+    assert (attempt["type"], attempt["status"], attempt["retry_after_s"]) == ("rate_limited", 429, 0.2)
+    assert statuses(azure) == [("gpt-4o-r429", 429), ("gpt-4o-r429", 200)]
+
+
+def test_long_retry_after_moves_to_the_fallback(azure):
+    azure.fail_next(1, 429)
+    text, stats = stream("gpt-4o-rlong", ["gpt-4o-fallback"])
+    assert text == "Antwort." and stats["deployment"] == "gpt-4o-fallback"
+    assert statuses(azure) == [("gpt-4o-rlong", 429), ("gpt-4o-fallback", 200)]
+
+
+def test_server_errors_fall_back_after_the_retries(azure, monkeypatch):
+    monkeypatch.setattr(app, "AZURE_MAX_RETRIES", 1)
+    monkeypatch.setattr(app, "AZURE_BACKOFF_BASE_S", 0.01)
+    azure.fail_next(2, 503)
+    text, stats = stream("gpt-4o-r5xx", ["gpt-4o-fallback"])
+    assert text == "Antwort." and stats["error"] is None
+    assert stats["deployment"] == "gpt-4o-fallback"
+    assert [a["type"] for a in stats["attempts"]] == ["server_error", "server_error"]
+    assert statuses(azure) == [("gpt-4o-r5xx", 503), ("gpt-4o-r5xx", 503), ("gpt-4o-fallback", 200)]
+
+
+def test_400_is_not_retried(azure):
+    azure.fail_next(1, 400)
+    text, stats = stream("gpt-4o-r400", ["gpt-4o-fallback"])
+    assert text == ""
+    assert (stats["error"]["type"], stats["error"]["status"]) == ("api_error", 400)
+    assert not stats["error"]["retryable"]
+    assert statuses(azure) == [("gpt-4o-r400", 400)]
+
+
+def test_missing_deployment_moves_to_the_next(azure):
+    text, stats = stream("gpt-4o-missing", ["gpt-4o-fallback"])
+    assert text == "Antwort." and stats["deployment"] == "gpt-4o-fallback"
+    assert stats["attempts"][0]["status"] == 404
+    assert statuses(azure) == [("gpt-4o-missing", 404), ("gpt-4o-fallback", 200)]
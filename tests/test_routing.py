@@ -0,0 +1,83 @@
+import app
+
+QUESTION = "Warum ist meine Proportion so niedrig bewertet worden?"
+
+
+def route(model, message=QUESTION, intent="A", history=4, latency=None, deployed=None):
+    return app.route_turn(model, message, intent, 0.9, history, latency, deployed)
+
+
+def test_tiers_never_rank_above_the_conversation_model():
+    assert app.tier_deployments("gpt-5") == [
+        ("small", "gpt-4o-mini"), ("medium", "gpt-5-mini"), ("large", "gpt-5")]
+    assert app.tier_deployments("gpt-5-mini") == [("small", "gpt-4o-mini"), ("medium", "gpt-5-mini")]
+    assert app.tier_deployments("gpt-4o-mini") == [("small", "gpt-4o-mini")]
+    assert app.tier_deployments("gpt-5-nano") == [("large", "gpt-5-nano")]
+    assert app.tier_deployments("my-custom-deployment") == [("large", "my-custom-deployment")]
+
+
+def test_non_reasoning_model_is_not_routed_to_a_reasoning_tier():
+    assert app.tier_deployments("gpt-4o") == [("small", "gpt-4o-mini"), ("large", "gpt-4o")]
+    routing = route("gpt-4o", intent="C")
+    assert routing["deployment"] == "gpt-4o"
+    assert routing["reasons"] == ["intent C", "medium not below gpt-4o"]
+
+
+def test_turns_above_the_cap_stay_on_the_conversation_model():
+    routing = route("gpt-5-nano", intent="C")
+    assert routing["deployment"] == "gpt-5-nano"
+    routing = route("gpt-5-mini", intent="A")
+    assert (routing["tier"], routing["deployment"]) == ("medium", "gpt-5-mini")
+    assert routing["reasons"] == ["intent A", "capped at gpt-5-mini"]
+
+
+def test_tier_missing_from_the_resource_moves_up():
+    deployed = ["gpt-5", "gpt-5-mini"]
+    assert app.tier_deployments("gpt-5", deployed) == [("medium", "gpt-5-mini"), ("large", "gpt-5")]
+    routing = route("gpt-5", "ok", "E", deployed=deployed)
+    assert routing["deployment"] == "gpt-5-mini"
+    assert routing["reasons"] == ["short message (1 words)", "small not deployed"]
+
+
+def test_short_messages_go_small_only_for_follow_ups_and_off_topic():
+    assert route("gpt-5", "ok danke", "E")["tier"] == "small"
+    assert route("gpt-5", "Wetter heute?", "D")["tier"] == "small"
+    assert route("gpt-5", "Wer bist du?", "F")["reasons"] == ["intent F"]
+    assert route("gpt-5", "Warum so?", "A")["tier"] == "large"
+
+
+def test_long_history_bumps_small_turns_a_tier():
+    routing = route("gpt-5", "ok", "E", history=app.ROUTING_LONG_HISTORY_MESSAGES)
+    assert routing["tier"] == "medium"
+    assert routing["reasons"][-1] == f"history {app.ROUTING_LONG_HISTORY_MESSAGES} messages"
+
+
+def test_tier_over_the_slo_hands_the_turn_down():
+    latency = app.LatencyTracker(10)
+    for _ in range(5):
+        latency.record("gpt-5", app.ROUTING_TTFT_SLO_S + 2)
+        latency.record("gpt-5-mini", 0.5)
+    routing = route("gpt-5", latency=latency)
+    assert (routing["tier"], routing["deployment"]) == ("medium", "gpt-5-mini")
+    assert routing["reasons"][-1].startswith("gpt-5 TTFT p90")
+    assert routing["expected_ttft_s"] == 0.5
+
+    # No demotion when the tier below misses the SLO too.
+    for _ in range(10):
+        latency.record("gpt-5-mini", app.ROUTING_TTFT_SLO_S + 1)
+    assert route("gpt-5", latency=latency)["deployment"] == "gpt-5"
+
+
+def test_outcome_records_fallback_and_feeds_the_tracker():
+    latency = app.LatencyTracker(10)
+    routing = route("gpt-5", "ok", "E")
+    log_entry = {"deployment_used": "gpt-5", "timings": {"time_to_first_token_s": 0.8}}
+    app.record_routing_outcome(routing, log_entry, latency)
+    assert routing["outcome"] == {
+        "deployment_used": "gpt-5", "fell_back": True, "ttft_s": 0.8,
+        "within_slo": True, "error": None,
+    }
+    assert latency.quantile("gpt-5", 0.5) == 0.8
+
+    app.record_routing_outcome(routing, dict(log_entry, cached=True), latency)
+    assert latency.quantile("gpt-5", 0.9) == 0.8 and len(latency._samples["gpt-5"]) == 1
@@ -0,0 +1,80 @@
+import asyncio
+
+from portrait_qa.scheduler import DeploymentScheduler, QueueTicket
+
+LIMITS = {"default": {"requests_per_minute": 60, "tokens_per_minute": 10_000, "max_concurrency": 1}}
+PRIORITIES = ("turn", "greeting", "speculation")
+
+
+async def admission_order(requests: list) -> list:
+    """Labels of `requests` ((label, session, priority)) in the order they get the slot,
+    all queued behind one request that holds it."""
+    scheduler = DeploymentScheduler(LIMITS, PRIORITIES)
+    await scheduler.acquire("gpt-4o", QueueTicket("holder"))
+    order = []
+
+    async def request(label, session_id, priority):
+        await scheduler.acquire("gpt-4o", QueueTicket(session_id, priority))
+        order.append(label)
+        await asyncio.sleep(0)
+        scheduler.release("gpt-4o")
+
+    tasks = []
+    for args in requests:
+        tasks.append(asyncio.create_task(request(*args)))
+        await asyncio.sleep(0)  # queue in this order
+    scheduler.release("gpt-4o")
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_priorities_first_then_round_robin_across_sessions():
+    order = asyncio.run(admission_order([
+        ("spec", "a", "speculation"),
+        ("a1", "a", "turn"),
+        ("a2", "a", "turn"),
+        ("greet", "c", "greeting"),
+        ("a3", "a", "turn"),
+        ("b1", "b", "turn"),
+    ]))
+    assert order == ["a1", "b1", "a2", "a3", "greet", "spec"]
+
+
+def test_positions_and_snapshot_follow_the_queue():
+    async def run():
+        scheduler = DeploymentScheduler(LIMITS, PRIORITIES)
+        await scheduler.acquire("gpt-4o", QueueTicket("holder"))
+        late = QueueTicket("a", "speculation")
+        early = QueueTicket("b", "turn")
+        tasks = [asyncio.create_task(scheduler.acquire("gpt-4o", t)) for t in (late, early)]
+        await asyncio.sleep(0)
+        positions = (early.position, late.position, late.queued)
+        snapshot = scheduler.snapshot()
+        scheduler.release("gpt-4o")
+        await asyncio.sleep(0)
+        after = (early.position, late.position)
+        scheduler.release("gpt-4o")
+        await asyncio.gather(*tasks)
+        return positions, snapshot, after
+
+    positions, snapshot, after = asyncio.run(run())
+    assert positions == (1, 2, 2)
+    assert snapshot == {"gpt-4o": {"active": 1, "queued": 2}}
+    assert after == (0, 1)
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def run():
+        scheduler = DeploymentScheduler(LIMITS, PRIORITIES)
+        await scheduler.acquire("gpt-4o", QueueTicket("holder"))
+        cancelled = asyncio.create_task(scheduler.acquire("gpt-4o", QueueTicket("a")))
+        waiting = asyncio.create_task(scheduler.acquire("gpt-4o", QueueTicket("b")))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        scheduler.release("gpt-4o")
+        await asyncio.wait_for(waiting, 1)
+        scheduler.release("gpt-4o")
+        return scheduler.snapshot()
+
+    assert asyncio.run(run()) == {}
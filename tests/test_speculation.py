@@ -0,0 +1,103 @@
+import asyncio
+from concurrent.futures import Future
+
+import app
+
+QA = app.DEFAULT_QA_SCORES_JSON
+MESSAGES = [{"role": "assistant", "content": "Hallo! Deine Bewertung ist fertig."}]
+
+
+def state(language="de", follow_ups_used=0) -> app.ConversationState:
+    state = app.ConversationState.from_messages(MESSAGES, QA)
+    state.language = language
+    state.follow_ups_used = follow_ups_used
+    return state
+
+
+def finished(response: str, prompt_tokens=100, completion_tokens=20) -> Future:
+    future = Future()
+    future.set_result((response, {
+        "response": response, "error": None,
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+    }))
+    return future
+
+
+def speculator(*entries) -> app.Speculator:
+    """A Speculator with `entries` ((candidate, future, ticket)) pending after MESSAGES."""
+    speculator = app.Speculator(10_000)
+    speculator._prefix = speculator._prefix_key(QA, MESSAGES, "gpt-4o")
+    speculator._prompt_estimate = 500
+    speculator._pending = [
+        (candidate, app.normalize_message(candidate), 600, future, ticket or app.QueueTicket())
+        for candidate, future, ticket in entries
+    ]
+    return speculator
+
+
+def user(text: str) -> list:
+    return MESSAGES + [{"role": "user", "content": text}]
+
+
+def test_predictions_follow_language_and_follow_up_line():
+    assert app.predict_next_messages(state("de"), 2) == ["Was soll ich verbessern?", "Erzähl mir mehr"]
+    assert app.predict_next_messages(state("uk"), 1) == ["Що мені покращити?"]
+    assert app.predict_next_messages(state(None), 1) == ["What should I improve?"]
+    assert app.predict_next_messages(state("en", follow_ups_used=10), 2) == [
+        "What are my strengths?", "What should I improve?"]
+
+
+def test_take_serves_a_close_match_and_writes_off_the_rest():
+    spec = speculator(("Warum?", finished("Weil...", 100, 20), None),
+                      ("Ja", finished("Gut.", 80, 10), None))
+    response, log_entry = spec.take(QA, user("warum"), "gpt-4o")
+    assert response == "Weil..."
+    assert log_entry["speculation"]["hit"] and log_entry["speculation"]["candidate"] == "Warum?"
+    assert (spec.hits, spec.misses) == (1, 0)
+    assert spec.tokens_spent == 210 and spec.tokens_wasted == 90
+    assert spec.take(QA, user("warum"), "gpt-4o") is None  # nothing left pending
+
+
+def test_take_misses_below_the_threshold_or_after_another_prefix():
+    spec = speculator(("Was soll ich verbessern?", finished("Die Schatten."), None))
+    assert spec.take(QA, user("Was kostet ein Pinsel?"), "gpt-4o") is None
+    assert (spec.hits, spec.misses, spec.tokens_wasted) == (0, 1, 120)
+
+    spec = speculator(("Ja", finished("Gut."), None))
+    assert spec.take(QA, user("Ja"), "gpt-5") is None
+    assert spec.misses == 1
+
+
+def test_late_match_is_cancelled_and_counted():
+    pending = Future()
+    spec = speculator(("Ja", pending, None))
+    assert spec.take(QA, user("Ja"), "gpt-4o") is None
+    assert (spec.late, spec.misses) == (1, 1)
+    assert pending.cancelled()
+
+
+def test_discard_charges_only_speculations_that_were_sent():
+    sent = app.QueueTicket(priority="speculation")
+    sent.sent = 1
+    spec = speculator(("Ja", Future(), sent), ("Warum?", Future(), None),
+                      ("Mehr", finished("..."), None))
+    spec.discard()
+    assert spec.tokens_spent == 500 + 120 and spec.tokens_wasted == 500 + 120
+    assert spec._pending == []
+
+
+def test_start_stays_within_the_token_budget(monkeypatch):
+    launched = []
+
+    async def never_done(qa_scores_json, messages, model, state_snapshot, ticket):
+        launched.append(messages[-1]["content"])
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(app, "_speculate", never_done)
+    monkeypatch.setattr(app, "SPECULATION_TOP_K", 3)
+    cap = app.output_token_cap(app.get_deployment_profiles().get("gpt-4o"))
+    spec = app.Speculator(token_budget=2 * (1000 + cap) + 1)
+    spec.start(QA, MESSAGES, "gpt-4o", state("de"), "session", 1000)
+    assert spec.launched == 2 and len(spec._pending) == 2
+    spec.discard()
+    assert spec.tokens_spent == 0  # cancelled before any request went out
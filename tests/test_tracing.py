@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from portrait_qa.tracing import OtlpTraceExporter, Trace, trace_to_otlp
+
+
+def sample_trace() -> Trace:
+    trace = Trace()
+    with trace.span("build_prompt", prompt_tokens=1200):
+        pass
+    attempt = trace.begin("attempt", deployment="gpt-4o", attempt=1)
+    queued = time.perf_counter()
+    time.sleep(0.01)
+    trace.add("queue_wait", queued, time.perf_counter(), attempt)
+    with trace.span("backoff", parent=attempt, delay_s=0.5) as backoff:
+        backoff["attributes"]["skipped"] = True
+    trace.end(attempt, error="rate_limited", status=429)
+    trace.finish()
+    return trace
+
+
+def test_spans_nest_under_the_root_or_the_given_parent():
+    trace = sample_trace()
+    spans = {span["name"]: span for span in trace.data["spans"]}
+    assert list(spans) == ["turn", "build_prompt", "attempt", "queue_wait", "backoff"]
+    root = spans["turn"]
+    assert root["parent_id"] is None and trace.root is root
+    assert spans["build_prompt"]["parent_id"] == root["span_id"]
+    assert spans["attempt"]["parent_id"] == root["span_id"]
+    assert spans["queue_wait"]["parent_id"] == spans["attempt"]["span_id"]
+    assert spans["backoff"]["parent_id"] == spans["attempt"]["span_id"]
+    assert spans["queue_wait"]["duration_ms"] >= 10
+    assert spans["queue_wait"]["start_ms"] >= spans["attempt"]["start_ms"]
+    assert spans["backoff"]["attributes"] == {"delay_s": 0.5, "skipped": True}
+    assert spans["attempt"]["attributes"]["status"] == 429
+    assert all(span["duration_ms"] is not None for span in spans.values())
+    attempt_end = spans["attempt"]["start_ms"] + spans["attempt"]["duration_ms"]
+    assert root["start_ms"] + root["duration_ms"] >= attempt_end - 0.02  # rounded to 0.01 ms
+    json.dumps(trace.data)  # stored as-is in log_entry["trace"]
+
+
+def test_trace_to_otlp():
+    trace = sample_trace().data
+    spans = {span["name"]: span for span in trace_to_otlp(trace)}
+    assert {span["traceId"] for span in spans.values()} == {trace["trace_id"]}
+    assert "parentSpanId" not in spans["turn"]
+    assert spans["attempt"]["parentSpanId"] == spans["turn"]["spanId"]
+    assert spans["queue_wait"]["parentSpanId"] == spans["attempt"]["spanId"]
+    assert spans["attempt"]["kind"] == 3 and spans["build_prompt"]["kind"] == 1
+    assert spans["attempt"]["status"] == {"code": 2, "message": "rate_limited"}
+    assert "status" not in spans["build_prompt"]
+
+    queue_wait = spans["queue_wait"]
+    start, end = int(queue_wait["startTimeUnixNano"]), int(queue_wait["endTimeUnixNano"])
+    wait = next(span for span in trace["spans"] if span["name"] == "queue_wait")
+    assert start == trace["start_unix_ns"] + int(wait["start_ms"] * 1e6)
+    assert end - start == int(wait["duration_ms"] * 1e6)
+    assert spans["attempt"]["attributes"] == [
+        {"key": "deployment", "value": {"stringValue": "gpt-4o"}},
+        {"key": "attempt", "value": {"intValue": "1"}},
+        {"key": "error", "value": {"stringValue": "rate_limited"}},
+        {"key": "status", "value": {"intValue": "429"}},
+    ]
+    assert spans["backoff"]["attributes"] == [
+        {"key": "delay_s", "value": {"doubleValue": 0.5}},
+        {"key": "skipped", "value": {"boolValue": True}},
+    ]
+
+
+class Collector(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.path, json.loads(body)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.server.event.set()
+
+
+def test_exporter_posts_a_batch_to_the_collector():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Collector)
+    server.received, server.event = [], threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        endpoint = f"http://127.0.0.1:{server.server_address[1]}/v1/traces"
+        exporter = OtlpTraceExporter(endpoint, "portrait-qa-test", batch_size=2, interval_s=5.0)
+        traces = [sample_trace().data, sample_trace().data]
+        for trace in traces:
+            exporter.export(trace)
+        assert server.event.wait(5)
+    finally:
+        server.shutdown()
+        server.server_close()
+    [(path, body)] = server.received
+    assert path == "/v1/traces"
+    [resource] = body["resourceSpans"]
+    assert resource["resource"]["attributes"] == [
+        {"key": "service.name", "value": {"stringValue": "portrait-qa-test"}}]
+    spans = resource["scopeSpans"][0]["spans"]
+    assert len(spans) == 10
+    assert {span["traceId"] for span in spans} == {trace["trace_id"] for trace in traces}